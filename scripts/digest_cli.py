@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""段階実行用 CLI。各ステージは前段の成果物を state/pipeline/<stage>.json から読み、自分の成果物を書く。
+
+    python -m scripts.digest_cli fetch | tag | analyze | compose | normalize | post
+    python -m scripts.digest_cli run [--resume | --from STAGE]
+
+SDK (Telethon / Gemini / requests) は必要なステージでだけ import されるので、
+normalize や compose の再実行は取得や解析をやり直さずにすぐ始まる。
+"""
+import argparse
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import scripts.run_digest_job as job
+from src import metrics
+
+PIPELINE_DIR = job.STATE_DIR / "pipeline"
+STAGES = ("fetch", "tag", "analyze", "compose", "normalize", "post")
+
+
+def artifact_path(stage: str) -> Path:
+    return PIPELINE_DIR / f"{stage}.json"
+
+
+def read_artifact(stage: str) -> Optional[Dict[str, Any]]:
+    path = artifact_path(stage)
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+
+def require_artifact(stage: str) -> Dict[str, Any]:
+    data = read_artifact(stage)
+    if data is None:
+        raise SystemExit(f"[fatal] {artifact_path(stage).relative_to(ROOT)} がありません。先に `{stage}` を実行してください")
+    return data
+
+
+def write_artifact(stage: str, data: Dict[str, Any]) -> Path:
+    PIPELINE_DIR.mkdir(parents=True, exist_ok=True)
+    path = artifact_path(stage)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(path)
+    return path
+
+
+def _selected(digests: List[Dict[str, Any]], only: Optional[str]) -> List[Dict[str, Any]]:
+    if not only:
+        return digests
+    picked = [d for d in digests if d["name"] == only]
+    if not picked:
+        raise SystemExit(f"[fatal] digest '{only}' は定義されていません: {[d['name'] for d in digests]}")
+    return picked
+
+
+def stage_fetch(settings: Dict[str, Any], digests: List[Dict[str, Any]], args: argparse.Namespace) -> Dict[str, Any]:
+    import asyncio
+    from src.ai.analysis import union_specs
+    from src.shard_plan import load_volumes, save_volumes
+    from src.telegram_pull import CHECKPOINT_FILE, fetch_sharded
+
+    digest_specs = {d["name"]: d["specs"] for d in digests}
+    union = union_specs(digest_specs)
+    total_hours = max(settings["hours_24"], settings["context_window_days"] * 24)
+    now = job.utcnow()
+    with metrics.span("fetch", hours=total_hours, specs=len(union)) as sp:
+        rows, spec_chats = asyncio.run(fetch_sharded(total_hours, union, settings["string_sessions"],
+                                                     settings["api_id"], settings["api_hash"],
+                                                     load_volumes(job.STATE_DIR),
+                                                     job.STATE_DIR / CHECKPOINT_FILE))
+        save_volumes(job.STATE_DIR, rows)
+        sp["attrs"]["msgs"] = len(rows)
+    return {
+        "run_id": metrics.run_id(),
+        "now": now.isoformat(),
+        "digest_specs": digest_specs,
+        "spec_chats": spec_chats,
+        "rows": rows,
+    }
+
+
+def stage_tag(settings, digests, args) -> Dict[str, Any]:
+    from src.ai.analysis import prepass_enrich
+
+    fetched = require_artifact("fetch")
+    with metrics.span("tag", msgs=len(fetched["rows"])):
+        msgs = prepass_enrich(fetched.pop("rows"))
+    return {**fetched, "msgs": msgs}
+
+
+def stage_analyze(settings, digests, args) -> Dict[str, Any]:
+    from src.ai.analysis import GeminiQuotaExceededError, analyze_groups, digest_groups
+
+    tagged = require_artifact("tag")
+    # クォータ切れは run_digest_job と同じく analysis を None にして、compose でクォータ通知にする
+    analyses: Dict[str, Any] = {name: None for name in tagged["digest_specs"]}
+    try:
+        analyses.update(analyze_groups(
+            settings["google_api_key"],
+            settings["gemini_model"],
+            tagged["msgs"],
+            digest_groups(tagged["digest_specs"], tagged["spec_chats"]),
+            settings["hours_24"],
+            settings["hours_recent"],
+            settings["use_response_schema"],
+            job.STATE_DIR,
+            datetime.fromisoformat(tagged["now"]),
+        ))
+    except GeminiQuotaExceededError as exc:
+        print(f"[warn] Gemini quota exhausted: {exc}")
+    return {"run_id": tagged["run_id"], "now": tagged["now"], "analyses": analyses}
+
+
+def stage_compose(settings, digests, args) -> Dict[str, Any]:
+    analyzed = require_artifact("analyze")
+    now = datetime.fromisoformat(analyzed["now"])
+    previous = read_artifact("compose") or {}
+    composed = dict(previous.get("digests") or {}) if previous.get("run_id") == analyzed["run_id"] else {}
+    for digest in _selected(digests, args.digest):
+        analysis = analyzed["analyses"].get(digest["name"])
+        composed[digest["name"]] = job.compose_for_digest(digest, analysis, settings, now)
+    return {"run_id": analyzed["run_id"], "now": analyzed["now"], "digests": composed}
+
+
+def stage_normalize(settings, digests, args) -> Dict[str, Any]:
+    from src.delivery.normalize import normalize_digest
+
+    composed = require_artifact("compose")
+    normalized: Dict[str, Any] = {}
+    for name, item in composed["digests"].items():
+        if args.digest and name != args.digest:
+            continue
+        markdown = item["markdown"]
+        if not item["quota_notice"]:
+            markdown = normalize_digest(markdown).to_markdown()
+        normalized[name] = {"markdown": markdown, "quota_notice": item["quota_notice"]}
+    return {"run_id": composed["run_id"], "now": composed["now"], "digests": normalized}
+
+
+def stage_post(settings, digests, args) -> Dict[str, Any]:
+    from src.delivery.normalize import parse_digest
+
+    analyzed = require_artifact("analyze")
+    composed = require_artifact("compose")
+    normalized = require_artifact("normalize")
+    if not (analyzed["run_id"] == composed["run_id"] == normalized["run_id"]):
+        raise SystemExit("[fatal] analyze / compose / normalize の成果物が別の実行のものです。compose から再実行してください")
+    now = datetime.fromisoformat(normalized["now"])
+    posted: Dict[str, str] = {}
+    for digest in _selected(digests, args.digest):
+        item = normalized["digests"].get(digest["name"])
+        if item is None:
+            print(f"[warn] {digest['name']}: normalize の成果物がありません。スキップします")
+            continue
+        document = None if item["quota_notice"] else parse_digest(item["markdown"])
+        job.publish_digest(digest, composed["digests"][digest["name"]], document,
+                           analyzed["analyses"].get(digest["name"]), settings, now)
+        posted[digest["name"]] = job.utcnow().isoformat()
+    return {"run_id": normalized["run_id"], "now": normalized["now"], "posted": posted}
+
+
+STAGE_FUNCS = {
+    "fetch": stage_fetch,
+    "tag": stage_tag,
+    "analyze": stage_analyze,
+    "compose": stage_compose,
+    "normalize": stage_normalize,
+    "post": stage_post,
+}
+
+
+def resume_point() -> str:
+    """最後に成功したステージの次を返す。成果物の run_id が fetch と揃っている所までを有効とみなす。"""
+    fetched = read_artifact("fetch")
+    if fetched is None:
+        return "fetch"
+    for stage in STAGES[1:]:
+        data = read_artifact(stage)
+        if data is None or data.get("run_id") != fetched.get("run_id"):
+            return stage
+        # --digest で一部だけ実行した段は未完了とみなす
+        done = data.get("digests") or data.get("posted")
+        if done is not None and set(fetched.get("digest_specs") or {}) - set(done):
+            return stage
+    return "fetch"  # 全段完了済みなら新しい実行を始める
+
+
+def run_stage(stage: str, settings, digests, args) -> None:
+    with metrics.span(f"stage.{stage}"):
+        data = STAGE_FUNCS[stage](settings, digests, args)
+        path = write_artifact(stage, data)
+    print(f"[info] {stage}: {path.relative_to(ROOT)}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="crypto-digest staged pipeline")
+    parser.add_argument("stage", choices=STAGES + ("run",))
+    parser.add_argument("--digest", help="compose / normalize / post を 1 ダイジェストに限定する")
+    parser.add_argument("--from", dest="from_stage", choices=STAGES, help="run をこのステージから始める")
+    parser.add_argument("--resume", action="store_true", help="run を最後に成功したステージの次から再開する")
+    args = parser.parse_args(argv)
+
+    settings, digests = job.load_settings()
+    metrics.reset_run()
+    try:
+        with metrics.span("run", stage=args.stage):
+            if args.stage != "run":
+                run_stage(args.stage, settings, digests, args)
+                return
+            start = args.from_stage or (resume_point() if args.resume else "fetch")
+            print(f"[info] run from stage: {start}")
+            for stage in STAGES[STAGES.index(start):]:
+                run_stage(stage, settings, digests, args)
+    finally:
+        report_path = metrics.write_run_report(job.STATE_DIR)
+        metrics.print_summary()
+        print(f"[info] run report: {report_path.relative_to(ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""緊急メッセージのリアルタイム通知。SOURCE_SPECS (または DIGESTS_FILE の全 spec) の新着を監視し、
+rules の emergency に当たったものを ALERT_WEBHOOK_URL へ数秒以内に送る。"""
+import os
+import sys
+import asyncio
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from telethon import TelegramClient
+from telethon.sessions import StringSession
+
+import scripts.run_digest_job as job
+from src.ai.analysis import union_specs
+from src.alerts import attach_alert_stream
+
+
+def alert_options() -> dict:
+    return {
+        'webhook_url': os.getenv('ALERT_WEBHOOK_URL', ''),
+        'debounce': float(os.getenv('ALERT_DEBOUNCE_SEC', '15')),
+        'cooldown': float(os.getenv('ALERT_COOLDOWN_SEC', '600')),
+    }
+
+
+async def run_stream() -> None:
+    settings, digests = job.load_settings()
+    options = alert_options()
+    if not options['webhook_url']:
+        print('[fatal] ALERT_WEBHOOK_URL が空です')
+        sys.exit(1)
+    specs = union_specs({d['name']: d['specs'] for d in digests})
+    async with TelegramClient(StringSession(settings['string_sessions'][0]), settings['api_id'], settings['api_hash']) as client:
+        task = await attach_alert_stream(client, specs, **options)
+        try:
+            await client.run_until_disconnected()
+        finally:
+            task.cancel()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(run_stream())
+    except KeyboardInterrupt:
+        print('[info] alert stream stopped')
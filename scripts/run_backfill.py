@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""過去ログのバックフィル。SOURCE_SPECS (または DIGESTS_FILE の全 spec) を期間指定で取得し、
+state/backfill/day=YYYY-MM-DD/ 以下に Parquet (または Arrow IPC) で保存する。
+
+    python scripts/run_backfill.py --days 30
+    python scripts/run_backfill.py --since 2025-09-01 --until 2025-10-01 --format arrow
+    python scripts/run_backfill.py            # 前回の期間の続きから再開
+
+タグ付け (rules.tag_message) は取得と並行して --workers 個のプロセスで行う。pyarrow が必要。
+"""
+import argparse
+import asyncio
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from telethon import TelegramClient
+from telethon.sessions import StringSession
+
+import scripts.run_digest_job as job
+from src import metrics
+from src.ai.analysis import union_specs
+from src.backfill import FORMATS, backfill_channel, load_progress, save_progress
+from src.telegram_pull import resolve_source_map
+
+UTC = timezone.utc
+
+
+def _parse_day(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=UTC)
+
+
+def backfill_range(args: argparse.Namespace, progress: dict):
+    """(start, end, progress) を返す。期間の指定が無ければ前回の期間を続ける。
+
+    期間が変わっても既存のファイルは消さない。新しい開始が前回の期間内にあれば (--days の再実行など)
+    チャンネルごとに前回の続きの id から取り、そうでなければ先頭から取って既存の id 範囲は飛ばす。
+    """
+    if not (args.days or args.since):
+        if not progress.get('start'):
+            raise SystemExit('[fatal] --days か --since を指定してください (再開できる進捗がありません)')
+        return datetime.fromisoformat(progress['start']), datetime.fromisoformat(progress['end']), progress
+    end = _parse_day(args.until) if args.until else job.utcnow()
+    start = _parse_day(args.since) if args.since else end - timedelta(days=args.days)
+    if progress.get('start') == start.isoformat() and progress.get('end') == end.isoformat():
+        return start, end, progress
+    channels = {}
+    if progress.get('start') and datetime.fromisoformat(progress['start']) <= start <= datetime.fromisoformat(progress['end']):
+        channels = {chat: {'last_id': saved.get('last_id') or 0, 'done': False}
+                    for chat, saved in (progress.get('channels') or {}).items()}
+        print(f"[info] 前回の期間の続きから取得します ({len(channels)} chats)")
+    elif progress.get('channels'):
+        print('[info] 前回と期間が重ならないため先頭から取得します (取得済みの id は飛ばします)')
+    return start, end, {'format': progress.get('format', args.format), 'start': start.isoformat(),
+                        'end': end.isoformat(), 'channels': channels}
+
+
+async def run_backfill(args: argparse.Namespace) -> None:
+    settings, digests = job.load_settings()
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    start, end, progress = backfill_range(args, load_progress(out_dir))
+    fmt = progress.get('format', args.format)
+    save_progress(out_dir, progress)
+    specs = union_specs({d['name']: d['specs'] for d in digests})
+    print(f"[info] backfill {start:%Y-%m-%d %H:%M} .. {end:%Y-%m-%d %H:%M} UTC -> {out_dir} ({fmt})")
+
+    async with TelegramClient(StringSession(settings['string_sessions'][0]),
+                              settings['api_id'], settings['api_hash']) as client:
+        by_spec, _ = await resolve_source_map(client, specs)
+        entities = []
+        for entity in by_spec.values():
+            if entity is not None and all(entity.id != e.id for e in entities):
+                entities.append(entity)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            total = 0
+            for entity in entities:
+                with metrics.span('backfill.channel', chat=getattr(entity, 'title', '') or str(entity.id)):
+                    total += await backfill_channel(client, entity, start, end, out_dir, progress, pool, fmt)
+    print(f"[info] backfill done: {total} msgs from {len(entities)} chats")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='crypto-digest history backfill')
+    parser.add_argument('--days', type=int, help='終了時刻から遡る日数')
+    parser.add_argument('--since', help='開始日 (YYYY-MM-DD, UTC)')
+    parser.add_argument('--until', help='終了日 (YYYY-MM-DD, UTC, 既定は現在)')
+    parser.add_argument('--out', default=str(job.STATE_DIR / 'backfill'))
+    parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BACKFILL_WORKERS', '0')) or os.cpu_count())
+    args = parser.parse_args()
+
+    metrics.reset_run()
+    try:
+        with metrics.span('run', stage='backfill'):
+            asyncio.run(run_backfill(args))
+    finally:
+        metrics.print_summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""常駐版。TelegramClient を 1 本つないだまま、DAEMON_SCHEDULE (cron 5 フィールド, UTC) ごとに
+run_digest_job と同じパイプラインを実行する。ダイアログ索引と取得済みメッセージはメモリに保持し、
+2 回目以降は差分だけを取得する。"""
+import os
+import sys
+import asyncio
+import traceback
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from telethon import TelegramClient
+from telethon.sessions import StringSession
+
+import scripts.run_digest_job as job
+from scripts.run_alert_stream import alert_options
+from src.ai.analysis import union_specs
+from src.alerts import attach_alert_stream
+from src.scheduler import next_fire, parse_cron
+from src.telegram_pull import WarmFetcher
+
+UTC = timezone.utc
+
+
+async def run_daemon() -> None:
+    schedule = os.getenv('DAEMON_SCHEDULE', '0 */6 * * *')
+    fields = parse_cron(schedule)
+    dialog_ttl = int(os.getenv('DAEMON_DIALOG_TTL', '3600'))
+    run_on_start = os.getenv('DAEMON_RUN_ON_START', '0') == '1'
+
+    api_id = int(os.getenv('TG_API_ID', '0'))
+    api_hash = os.getenv('TG_API_HASH', '')
+    # 常駐版は 1 アカウント (TG_STRING_SESSIONS があれば先頭) の接続を使い回す
+    string_session = job.parse_string_sessions()[0]
+
+    loop = asyncio.get_running_loop()
+    async with TelegramClient(StringSession(string_session), api_id, api_hash) as client:
+        warm = WarmFetcher(client, dialog_ttl=dialog_ttl)
+
+        def fetcher(hours, specs):
+            # ジョブはワーカースレッドで動くので、取得だけクライアントのいるループへ投げる
+            return asyncio.run_coroutine_threadsafe(warm.fetch(hours, specs), loop).result()
+
+        # ALERT_WEBHOOK_URL があれば同じ接続で緊急アラートも流す
+        options = alert_options()
+        alert_task = None
+        if options['webhook_url']:
+            _, digests = job.load_settings()
+            specs = union_specs({d['name']: d['specs'] for d in digests})
+            alert_task = await attach_alert_stream(client, specs, index=await warm.dialog_index(), **options)
+
+        print(f"[info] daemon started: schedule='{schedule}' (UTC)")
+        pending_now = run_on_start
+        while True:
+            if not pending_now:
+                fire_at = next_fire(fields, datetime.now(UTC))
+                print(f"[info] next run at {fire_at.strftime('%Y-%m-%d %H:%M')} UTC")
+                await asyncio.sleep(max(0.0, (fire_at - datetime.now(UTC)).total_seconds()))
+            pending_now = False
+            try:
+                await loop.run_in_executor(None, job.main, fetcher)
+            except SystemExit as exc:
+                print(f"[warn] run exited: {exc}")
+            except Exception as exc:
+                # 1 回の失敗で常駐を止めない
+                print('[warn] run failed:', type(exc).__name__, str(exc)[:300])
+                traceback.print_exc()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(run_daemon())
+    except KeyboardInterrupt:
+        print('[info] daemon stopped')
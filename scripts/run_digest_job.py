@@ -3,23 +3,29 @@ import os
 import sys
 import json
 import asyncio
+import contextvars
 from collections import Counter, defaultdict
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
 
+import yaml
 from dotenv import load_dotenv
 
-from src.telegram_pull import fetch_messages_smart
-from src.rules import tag_message
-from src.ai.analysis import analyze_digest, GeminiQuotaExceededError
-from src.delivery.discord import post_markdown
-from src.delivery.normalize import normalize_digest_markdown
+from src.ai.analysis import build_compose_payload, compose_digest, run_multi_analysis, GeminiQuotaExceededError
+from src.ai.thread_index import compute_deltas, load_index
+from src.provenance import attach_evidence, build_index
+from src.delivery.normalize import normalize_digest
+from src.render.html_report import archive_run
+from src import metrics
 
 ROOT = Path(__file__).resolve().parents[1]
 STATE_DIR = ROOT / "state"
 STATE_DIR.mkdir(parents=True, exist_ok=True)
 STATE_FILE = STATE_DIR / "state.json"
+ARCHIVE_DIR = STATE_DIR / "archive"
+DEFAULT_DIGEST = "default"
 
 load_dotenv(ROOT / '.env')
 
@@ -57,27 +63,22 @@ def dtfmt(dt: datetime) -> str:
     return dt.astimezone(UTC).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def load_state() -> Dict[str, Any]:
-    if STATE_FILE.exists():
+def load_state(path: Path = STATE_FILE) -> Dict[str, Any]:
+    if path.exists():
         try:
-            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
+            return json.loads(path.read_text(encoding="utf-8"))
         except Exception:
             pass
     return {}
 
 
-def save_state(state: Dict[str, Any]) -> None:
-    STATE_FILE.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+def save_state(state: Dict[str, Any], path: Path = STATE_FILE) -> None:
+    path.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
 def build_evidence_map(messages: List[Dict[str, Any]]) -> Dict[str, str]:
-    mapping: Dict[str, str] = {}
-    for msg in messages:
-        ts = msg.get('date')
-        link = msg.get('link')
-        if ts and ts not in mapping:
-            mapping[ts] = link
-    return mapping
+    # 時刻文字列をキーにすると同じ秒の投稿が衝突するので (チャット, メッセージ id) で引く
+    return {key: row.get('link') for key, row in build_index(messages).items() if row.get('link')}
 def flatten_titles(by_category: Dict[str, Any]) -> Set[str]:
     titles: Set[str] = set()
     if not isinstance(by_category, dict):
@@ -250,6 +251,58 @@ def parse_source_specs() -> list[str]:
     return specs
 
 
+def _digest_paths(name: str) -> Dict[str, Path]:
+    # 既定ダイジェストは従来どおり state/state.json と state/archive を使う
+    if name == DEFAULT_DIGEST:
+        return {'state_file': STATE_FILE, 'archive_dir': ARCHIVE_DIR}
+    return {'state_file': STATE_DIR / f"state.{name}.json", 'archive_dir': ARCHIVE_DIR / name}
+
+
+def load_digest_configs(base: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """DIGESTS_FILE (YAML) があれば複数ダイジェストを読む。無ければ環境変数から 1 件だけ作る。
+
+    各エントリ: name, source_specs, webhook_env または webhook_url, post_mode, digest_mode, html_report
+    (省略したキーは環境変数の値を引き継ぐ)
+    """
+    path_env = os.getenv('DIGESTS_FILE', '').strip()
+    if not path_env:
+        return [{**base, 'name': DEFAULT_DIGEST, **_digest_paths(DEFAULT_DIGEST)}]
+
+    path = Path(path_env)
+    if not path.is_absolute():
+        path = ROOT / path
+    data = yaml.safe_load(path.read_text(encoding='utf-8')) or {}
+    digests: List[Dict[str, Any]] = []
+    for i, entry in enumerate(data.get('digests') or []):
+        name = str(entry.get('name') or f"digest{i + 1}").strip()
+        specs = entry.get('source_specs') or base['specs']
+        if isinstance(specs, str):
+            specs = [s.strip() for s in specs.split(',') if s.strip()]
+        webhook = entry.get('webhook_url') or (os.getenv(entry['webhook_env'], '') if entry.get('webhook_env') else base['webhook'])
+        digest_mode = str(entry.get('digest_mode') or base['digest_mode']).strip().lower()
+        digests.append({
+            **base,
+            'name': name,
+            'specs': list(specs),
+            'webhook': webhook,
+            'post_mode': entry.get('post_mode') or base['post_mode'],
+            'digest_mode': digest_mode if digest_mode in {'lossless', 'compact'} else 'lossless',
+            'html_report': bool(entry.get('html_report', base['html_report'])),
+            **_digest_paths(name),
+        })
+    names = [d['name'] for d in digests]
+    if len(set(names)) != len(names):
+        raise ValueError(f"DIGESTS_FILE: digest name が重複しています: {names}")
+    return digests
+
+
+def parse_string_sessions() -> List[str]:
+    # TG_STRING_SESSIONS (カンマ/改行区切り) があれば複数アカウントで分担取得する
+    raw = os.getenv('TG_STRING_SESSIONS', '')
+    sessions = [s.strip() for s in raw.replace('\n', ',').split(',') if s.strip()]
+    return sessions or [os.getenv('TG_STRING_SESSION', '')]
+
+
 def build_markdown_v2(now: datetime, result: Dict[str, Any], evidence_map: Dict[str, str]) -> str:
     now_wib = now + WIB_OFFSET
     lines: List[str] = []
@@ -394,35 +447,151 @@ def build_quota_exceeded_markdown(now: datetime, hours_24: int, hours_recent: in
     return "\n".join(lines)
 
 
-def main() -> None:
+def main(fetcher=None) -> None:
+    metrics.reset_run()
+    try:
+        with metrics.span('run'):
+            run_job(fetcher)
+    finally:
+        report_path = metrics.write_run_report(STATE_DIR)
+        metrics.print_summary()
+        print(f"[info] run report: {report_path.relative_to(ROOT)}")
+
+
+def compose_for_digest(digest: Dict[str, Any], analysis: Optional[Dict[str, Any]], settings: Dict[str, Any],
+                       now: datetime) -> Dict[str, Any]:
+    """delta → COMPOSE。analysis が None (ANALYZE でクォータ切れ) ならクォータ通知を返す。"""
+    name = digest['name']
+    label = '' if name == DEFAULT_DIGEST else f"[{name}] "
+    hours_24 = settings['hours_24']
+    hours_recent = settings['hours_recent']
+    context_window_days = settings['context_window_days']
+
+    if analysis is not None:
+        try:
+            with metrics.span('delta', digest=name) as sp:
+                previous_state = load_state(digest['state_file'])
+                next_index, recent_delta = compute_deltas(analysis.get('threads') or [], load_index(previous_state), now)
+                sp['attrs'].update({k: len(recent_delta[k]) for k in ('new', 'updated', 'resolved')})
+            if not settings['quiet']:
+                print(f"[info] {label}delta: new={len(recent_delta['new'])} updated={len(recent_delta['updated'])} "
+                      f"resolved={len(recent_delta['resolved'])}{' (baseline)' if recent_delta['baseline'] else ''}")
+            compose_payload = build_compose_payload(analysis, hours_24, hours_recent, context_window_days,
+                                                    digest['specs'], digest['digest_mode'], now, recent_delta)
+            with metrics.span('digest', digest=name):
+                markdown = compose_digest(settings['google_api_key'], settings['gemini_model'], compose_payload)
+            return {
+                'markdown': markdown,
+                'quota_notice': False,
+                'recent_delta': recent_delta,
+                'next_index': next_index,
+            }
+        except GeminiQuotaExceededError as exc:
+            print(f"[warn] {label}Gemini quota exhausted: {exc}")
+
+    return {
+        'markdown': build_quota_exceeded_markdown(now, hours_24, hours_recent, context_window_days),
+        'quota_notice': True,
+        'recent_delta': {},
+        'next_index': {},
+    }
+
+
+def publish_digest(digest: Dict[str, Any], composed: Dict[str, Any], document: Any,
+                   analysis: Optional[Dict[str, Any]], settings: Dict[str, Any], now: datetime) -> None:
+    """Discord 投稿 → 状態保存 → HTML アーカイブ。document は正規化済みの DigestDocument。"""
+    from src.delivery.discord import post_digest, post_markdown
+
+    name = digest['name']
+    label = '' if name == DEFAULT_DIGEST else f"[{name}] "
+    if composed['quota_notice']:
+        metrics.set_value(f'digest_chars.{name}', len(composed['markdown']))
+        post_markdown(digest['webhook'], composed['markdown'], digest['post_mode'])
+    else:
+        if settings['include_evidence_in_output'] and analysis:
+            attached = attach_evidence(document, analysis.get('threads') or [])
+            metrics.set_value(f'evidence_topics.{name}', attached)
+        metrics.set_value(f'digest_chars.{name}', len(document.to_markdown()))
+        post_digest(digest['webhook'], document, digest['post_mode'])
+
+        # 投稿できた回だけ指紋インデックスを進める (クォータ切れの回は前回基準のまま)
+        save_state({
+            'timestamp': dtfmt(now),
+            'recent_delta': composed['recent_delta'],
+            'thread_index': composed['next_index'],
+        }, digest['state_file'])
+
+        # HTML アーカイブは副産物なので、失敗しても投稿・状態保存は済ませておく
+        if digest['html_report']:
+            try:
+                with metrics.span('render.html', digest=name):
+                    page = archive_run(digest['archive_dir'], metrics.run_id(), analysis or {}, document, now)
+                print(f"[info] {label}html report: {page.relative_to(ROOT)}")
+            except Exception as exc:
+                metrics.incr('render.html_errors')
+                print(f"[warn] {label}html report failed: {exc}")
+
+    if not settings['quiet']:
+        print(f"[ok] {label}posted {'quota notice' if composed['quota_notice'] else 'digest'}.")
+
+
+def deliver_digest(digest: Dict[str, Any], analysis: Optional[Dict[str, Any]], settings: Dict[str, Any],
+                   now: datetime) -> bool:
+    """1 ダイジェスト分の delta → COMPOSE → 正規化 → 投稿 → HTML。クォータ通知を出したら True。"""
+    composed = compose_for_digest(digest, analysis, settings, now)
+    document = None if composed['quota_notice'] else normalize_digest(composed['markdown'])
+    publish_digest(digest, composed, document, analysis, settings, now)
+    return composed['quota_notice']
+
+
+def load_settings() -> tuple:
+    """環境変数を読み、(共通設定, ダイジェスト定義のリスト) を返す。"""
     specs = parse_source_specs()
-    if not specs:
-        print('[fatal] SOURCE_SPECS/SOURCE_CHATS が空です')
-        sys.exit(1)
-
-    previous_state = load_state()
-
-    api_id = int(os.getenv('TG_API_ID', '0'))
-    api_hash = os.getenv('TG_API_HASH', '')
-    string_session = os.getenv('TG_STRING_SESSION', '')
-    google_api_key = os.getenv('GOOGLE_API_KEY', '')
-    gemini_model = os.getenv('GEMINI_MODEL', 'models/gemini-2.0-flash')
-    discord_webhook = os.getenv('DISCORD_WEBHOOK_URL', '')
-    hours_24 = int(os.getenv('HOURS_24', '6')) # 24h -> 6h
-    hours_recent = int(os.getenv('HOURS_RECENT', '6'))
-    quiet = os.getenv('QUIET_LOG', '0') == '1'
-    dry_run = os.getenv('DRY_RUN', '0') == '1'
-    no_filters = os.getenv('NO_FILTERS', '0') == '1'
-    render_style = os.getenv('RENDER_STYLE', 'default')
-    context_window_days = int(os.getenv('CONTEXT_WINDOW_DAYS', '1'))
-    include_evidence_in_output = os.getenv('INCLUDE_EVIDENCE_IN_OUTPUT', '0') == '1'
     digest_mode = (os.getenv('DIGEST_MODE', 'lossless') or 'lossless').strip().lower()
     if digest_mode not in {'lossless', 'compact'}:
         digest_mode = 'lossless'
+    settings = {
+        'api_id': int(os.getenv('TG_API_ID', '0')),
+        'api_hash': os.getenv('TG_API_HASH', ''),
+        'string_session': os.getenv('TG_STRING_SESSION', ''),
+        'string_sessions': parse_string_sessions(),
+        'google_api_key': os.getenv('GOOGLE_API_KEY', ''),
+        'gemini_model': os.getenv('GEMINI_MODEL', 'models/gemini-2.0-flash'),
+        'hours_24': int(os.getenv('HOURS_24', '6')),  # 24h -> 6h
+        'hours_recent': int(os.getenv('HOURS_RECENT', '6')),
+        'quiet': os.getenv('QUIET_LOG', '0') == '1',
+        'dry_run': os.getenv('DRY_RUN', '0') == '1',
+        'no_filters': os.getenv('NO_FILTERS', '0') == '1',
+        'render_style': os.getenv('RENDER_STYLE', 'default'),
+        'context_window_days': int(os.getenv('CONTEXT_WINDOW_DAYS', '1')),
+        'include_evidence_in_output': os.getenv('INCLUDE_EVIDENCE_IN_OUTPUT', '0') == '1',
+        'use_response_schema': os.getenv('ANALYZE_RESPONSE_SCHEMA', '1') == '1',
+    }
+    digests = load_digest_configs({
+        'specs': specs,
+        'webhook': os.getenv('DISCORD_WEBHOOK_URL', ''),
+        'post_mode': os.getenv('DISCORD_POST_MODE', 'markdown'),
+        'digest_mode': digest_mode,
+        'html_report': os.getenv('HTML_REPORT', '1') == '1',
+    })
+    digests = [d for d in digests if d['specs']]
+    if not digests:
+        print('[fatal] SOURCE_SPECS/SOURCE_CHATS (または DIGESTS_FILE) が空です')
+        sys.exit(1)
+    return settings, digests
+
+
+def run_job(fetcher=None) -> None:
+    settings, digests = load_settings()
+    metrics.set_value('digests', [d['name'] for d in digests])
+    hours_24 = settings['hours_24']
+    hours_recent = settings['hours_recent']
 
     now = utcnow()
 
-    if dry_run:
+    if settings['dry_run']:
+        from src.delivery.discord import post_markdown
+
         dummy = {
             'overall_24h': {
                 'summary': '(dry-run) 24h summary',
@@ -448,50 +617,43 @@ def main() -> None:
                 'resolved': []
             }
         }
-        markdown = build_markdown(now, dummy, {})
-        post_markdown(discord_webhook, markdown)
+        markdown = build_markdown(now, dummy, {}, set(), set(), set())
+        for digest in digests:
+            post_markdown(digest['webhook'], markdown, digest['post_mode'])
         return
 
-    # analyze_digest の呼び出し
-    quota_notice = False
+    # 取得・タグ付け・ANALYZE は全ダイジェストの和集合に対して 1 回だけ
+    analyses: Dict[str, Optional[Dict[str, Any]]] = {d['name']: None for d in digests}
     try:
-        markdown = analyze_digest(
-            google_api_key,
+        analyses.update(run_multi_analysis(
+            settings['google_api_key'],
             hours_24,
-            hours_recent,  # hours_recent を追加
-            context_window_days,
-            specs,
-            string_session,
-            api_id,
-            api_hash,
-            gemini_model,
-            digest_mode,
-        )
+            hours_recent,
+            settings['context_window_days'],
+            {d['name']: d['specs'] for d in digests},
+            settings['string_sessions'],
+            settings['api_id'],
+            settings['api_hash'],
+            settings['gemini_model'],
+            use_response_schema=settings['use_response_schema'],
+            state_dir=STATE_DIR,
+            now_dt=now,
+            fetcher=fetcher,
+        ))
     except GeminiQuotaExceededError as exc:
-        quota_notice = True
         print(f"[warn] Gemini quota exhausted: {exc}")
-        markdown = build_quota_exceeded_markdown(now, hours_24, hours_recent, context_window_days)
-        if not markdown.strip():  # 空のMarkdownが返された場合のフォールバック
-            print("[info] LLM returned empty narrative, using action-first fallback.")
-            markdown = "### セール/エアドロ速報（フォールバック）\n\n（情報なし）"
-
-    if not quota_notice:
-        markdown = normalize_digest_markdown(markdown)
-    post_markdown(discord_webhook, markdown)
-
-    # 旧スキーマに依存するため状態保存は一旦無効化
-    # state = {
-    #     'timestamp': dtfmt(now_dt),
-    #     'by_category': result.get('by_category', {}),
-    #     'recent_delta': delta,
-    # }
-    # save_state(state)
-
-    if not quiet:
-        if quota_notice:
-            print("[ok] posted quota notice.")
-        else:
-            print("[ok] posted digest.")
+
+    # COMPOSE と配信はダイジェストごとに並行実行する (スパンの親子関係を保つため context を引き継ぐ)
+    if len(digests) == 1:
+        quota_flags = [deliver_digest(digests[0], analyses[digests[0]['name']], settings, now)]
+    else:
+        with ThreadPoolExecutor(max_workers=len(digests)) as pool:
+            futures = [
+                pool.submit(contextvars.copy_context().run, deliver_digest, d, analyses[d['name']], settings, now)
+                for d in digests
+            ]
+            quota_flags = [f.result() for f in futures]
+    metrics.set_value('quota_notice', any(quota_flags))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,7 @@
 from __future__ import annotations
-import google.generativeai as genai
-from google.api_core import exceptions as google_exceptions
 import logging
-from typing import Dict, Any, List, List
+import os
+from typing import Dict, Any, List, List, Optional, TypedDict, Union
 import json # jsonモジュールを直接使用
 import json # jsonモジュールを直接使用
 
@@ -11,16 +10,40 @@ class GeminiQuotaExceededError(RuntimeError):
     pass
 
 
-from .json_utils import safe_json_loads # safe_json_loads は COMPOSE ステップで必要になる可能性があるので残す
-from .prompts import ANALYZE_PROMPT, COMPOSE_PROMPT
-from src.telegram_pull import fetch_messages_smart
+from .json_utils import safe_json_loads, tolerant_json_loads # safe_json_loads は COMPOSE ステップで必要になる可能性があるので残す
+from .prompts import ANALYZE_PROMPT, ANALYZE_RESPONSE_SCHEMA, COMPOSE_PROMPT
+from .chunk_tuning import chunk_size, load_chunk_budget, update_chunk_budget
+from .chunk_cache import cache_key, load_cached, prune_cache, store_cached
+from .stats import build_frame, corpus_stats, thread_mentions
+from .deadlines import build_calendar
+from .corpus_codec import RECENT_MARK, approx_tokens, corpus_text, corpus_title, encode_corpus
+from src.message_arena import text_bytes
+from src.provenance import apply_provenance, build_index, resolve_messages, row_chat, strip_provenance
+from src.shard_plan import load_volumes, save_volumes
 from src.rules import tag_message
+from src import metrics
 import asyncio
 import re
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
 WIB = timezone(timedelta(hours=7))
 
+
+def _google_exceptions():
+    # SDK は LLM を実際に呼ぶときだけ読み込む (tag / normalize だけの実行では import しない)
+    from google.api_core import exceptions
+    return exceptions
+
+MAX_OUTPUT_TOKENS = 8192
+# 出力上限で切れたチャンクを半分に割って再解析する最大の深さ
+MAX_SPLIT_DEPTH = 3
+# ANALYZE 入力の形式: compact (corpus_codec の圧縮表現) / plain (従来形式)
+PROMPT_CORPUS_CODEC = os.getenv('PROMPT_CORPUS_CODEC', 'compact').lower()
+# チャンクは UTC でこの時間ごとの区切りをまたがない (古いメッセージが窓から落ちても後ろのチャンクの
+# 境界が動かず、chunk_cache が次回実行でも当たるように)。0 で区切りなし
+CHUNK_ALIGN_HOURS = int(os.getenv('CHUNK_ALIGN_HOURS', '24'))
+
 RENDER_CONFIG = {
     'style': 'paragraph',
     'force_sections': ['Now', 'Heads-up', 'Context', 'その他'],
@@ -29,38 +52,110 @@ RENDER_CONFIG = {
     'header_template': '6hダイジェスト | 窓口: {start}-{end} WIB',
 }
 
-def extract_first_json_block(text: str) -> str | None:
-    if not text:
+SECTION_HINTS = ('Now', 'Heads-up', 'Context', 'その他')
+MESSAGE_TEXT_LIMIT = 500
+
+
+class ThreadMessage(TypedDict):
+    msg_id: str
+    time_wib: Optional[str]
+    text: str
+
+
+class TimeRange(TypedDict):
+    start_wib: Optional[str]
+    end_wib: Optional[str]
+
+
+class AnalysisThread(TypedDict):
+    thread_id: str
+    title: str
+    entity_refs: List[str]
+    messages: List[ThreadMessage]
+    facts: List[str]
+    notes: List[str]
+    risks: List[str]
+    section_hint: str
+    mention_count: int
+    time_range: TimeRange
+
+
+def _str_list(value: Any) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, (str, int, float)):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    return [str(v).strip() for v in value if v is not None and str(v).strip()]
+
+
+def _opt_hhmm(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
         return None
-    m_open = text.find('{')
-    m_close = text.rfind('}')
-    if m_open == -1 or m_close == -1 or m_close <= m_open:
+    value = value.strip()
+    if len(value) >= 5 and value[2] == ':' and value[:2].isdigit() and value[3:5].isdigit():
+        return value[:5]
+    return None
+
+
+def _validate_message(raw: Any) -> Optional[ThreadMessage]:
+    if isinstance(raw, str):
+        raw = {'text': raw}
+    if not isinstance(raw, dict):
         return None
-    return text[m_open:m_close + 1]
+    return {
+        'msg_id': str(raw.get('msg_id') if raw.get('msg_id') is not None else ''),
+        'time_wib': _opt_hhmm(raw.get('time_wib')),
+        'text': str(raw.get('text') or '')[:MESSAGE_TEXT_LIMIT],
+    }
 
 
-def normalize_thread(t: dict) -> dict:
-    t.setdefault('thread_id', t.get('thread_id') or 'auto_{}'.format(abs(hash(t.get('title', '')))))
-    t.setdefault('title', t.get('title') or 'Auto Fallback')
-    t.setdefault('entity_refs', list(t.get('entity_refs') or []))
-    t.setdefault('messages', list(t.get('messages') or []))
-    t.setdefault('facts', list(t.get('facts') or []))
-    t.setdefault('notes', list(t.get('notes') or []))
-    t.setdefault('risks', list(t.get('risks') or []))
-    t.setdefault('section_hint', t.get('section_hint') or 'その他')
-    if not t.get('mention_count'):
-        t['mention_count'] = len(t['messages'])
-    time_range = t.get('time_range') or {}
-    if not time_range:
-        time_range = {}
-    if not time_range.get('start_wib'):
-        time_range['start_wib'] = _infer_time_boundary(t['messages'], True)
-    if not time_range.get('end_wib'):
-        time_range['end_wib'] = _infer_time_boundary(t['messages'], False)
-    t['time_range'] = time_range
-    return t
+def validate_thread(raw: dict) -> AnalysisThread:
+    """ANALYZE のスレッド 1 件を型どおりに整える。ここで 1 回だけ通し、以降は再正規化しない。"""
+    messages = [m for m in (_validate_message(x) for x in (raw.get('messages') or [])) if m]
+    title = str(raw.get('title') or '').strip() or 'Auto Fallback'
+    section_hint = raw.get('section_hint')
+    if section_hint not in SECTION_HINTS:
+        section_hint = 'その他'
+    try:
+        mention_count = int(raw.get('mention_count') or 0)
+    except (TypeError, ValueError):
+        mention_count = 0
+    if mention_count <= 0:
+        mention_count = len(messages)
+    time_range = raw.get('time_range') if isinstance(raw.get('time_range'), dict) else {}
+    start_wib = _opt_hhmm(time_range.get('start_wib'))
+    end_wib = _opt_hhmm(time_range.get('end_wib'))
+    if start_wib is None or end_wib is None:
+        times = [m['time_wib'] for m in messages if m['time_wib']]
+        if times:
+            start_wib = start_wib or min(times)
+            end_wib = end_wib or max(times)
+    return {
+        'thread_id': str(raw.get('thread_id') or '').strip() or 'auto_{}'.format(abs(hash(title))),
+        'title': title,
+        'entity_refs': _str_list(raw.get('entity_refs')),
+        'messages': messages,
+        'facts': _str_list(raw.get('facts')),
+        'notes': _str_list(raw.get('notes')),
+        'risks': _str_list(raw.get('risks')),
+        'section_hint': section_hint,
+        'mention_count': mention_count,
+        'time_range': {'start_wib': start_wib, 'end_wib': end_wib},
+    }
 
 
+def validate_entity(raw: Any) -> Optional[dict]:
+    if not isinstance(raw, dict):
+        return None
+    canonical = str(raw.get('canonical') or '').strip()
+    if not canonical:
+        return None
+    entity = dict(raw)
+    entity['canonical'] = canonical
+    entity['aliases'] = _str_list(raw.get('aliases'))
+    return entity
 
 
 def _infer_time_boundary(messages: list[dict], first: bool) -> str | None:
@@ -80,7 +175,7 @@ def make_min_thread_from_raw(raw_msgs: list[dict]) -> dict:
         'time_wib': (m.get('time_short') or m.get('date') or '')[11:16] if (m.get('date') and len(m.get('date')) >= 16) else (m.get('time_short') or ''),
         'text': (m.get('text') or '')[:500]
     } for m in take]
-    thread = normalize_thread({
+    thread = validate_thread({
         'thread_id': 'auto_fallback_1',
         'title': 'Auto fallback: parse failure',
         'entity_refs': [],
@@ -103,36 +198,71 @@ def make_min_thread_from_raw(raw_msgs: list[dict]) -> dict:
 
 
 def safe_parse_analysis(text: str, raw_msgs: list[dict]) -> dict:
-    blk = extract_first_json_block(text or '')
-    if blk:
-        try:
-            data = json.loads(blk)
-            threads = data.get('threads') or []
-            if not threads:
-                return make_min_thread_from_raw(raw_msgs)
-            data['threads'] = [normalize_thread(t) for t in threads]
-            return data
-        except Exception:
-            pass
-    return make_min_thread_from_raw(raw_msgs)
+    data, info = tolerant_json_loads(text or '')
+    if data is None:
+        return make_min_thread_from_raw(raw_msgs)
+    threads = data.get('threads')
+    threads = [t for t in threads if isinstance(t, dict)] if isinstance(threads, list) else []
+    open_keys = info.get('open_keys') or []
+    if info.get('truncated') and len(open_keys) >= 3 and open_keys[1] == 'threads' and threads:
+        # 途中で切れたスレッドは閉じ括弧を補っても中身が欠けているので捨て、完結したものだけ残す
+        threads = threads[:-1]
+    if not threads:
+        return make_min_thread_from_raw(raw_msgs)
+    data['threads'] = [validate_thread(t) for t in threads]
+    entities = data.get('entities') if isinstance(data.get('entities'), list) else []
+    data['entities'] = [e for e in (validate_entity(x) for x in entities) if e]
+    if info.get('repaired'):
+        meta = data.get('meta') if isinstance(data.get('meta'), dict) else {}
+        meta['repaired'] = True
+        meta['truncated'] = bool(info.get('truncated'))
+        data['meta'] = meta
+    return data
 
 
 def load_msgs(hours_24: int, context_window_days: int, specs: List[str], string_session: str, api_id: int, api_hash: str) -> List[Dict[str, Any]]:
     # 過去 context_window_days 分のメッセージをロード
     # fetch_messages_smart は hours を引数にとるので、context_window_days * 24 を渡す
+    from src.telegram_pull import fetch_messages_smart
+
     total_hours = max(hours_24, context_window_days * 24)
-    return asyncio.run(fetch_messages_smart(total_hours, specs, string_session, api_id, api_hash))
+    with metrics.span('fetch', hours=total_hours) as sp:
+        rows = asyncio.run(fetch_messages_smart(total_hours, specs, string_session, api_id, api_hash))
+        sp['attrs']['msgs'] = len(rows)
+    return rows
+
+def setup_gemini(api_key: str, model: str = "models/gemini-2.0-flash", response_mime_type: str = None, response_schema: dict = None):
+    import google.generativeai as genai
 
-def setup_gemini(api_key: str, model: str = "models/gemini-2.0-flash", response_mime_type: str = None):
     genai.configure(api_key=api_key)
     config = {
         "temperature": 0.2,
-        "max_output_tokens": 8192
+        "max_output_tokens": MAX_OUTPUT_TOKENS
     }
     if response_mime_type:
         config["response_mime_type"] = response_mime_type
+    if response_schema:
+        config["response_schema"] = response_schema
     return genai.GenerativeModel(model, generation_config=config)
 
+def response_usage(resp: Any) -> Dict[str, Any]:
+    # usage_metadata / finish_reason は SDK バージョンやブロック時に欠けることがあるので全て任意扱い
+    usage = getattr(resp, 'usage_metadata', None)
+    finish_reason = None
+    candidates = getattr(resp, 'candidates', None) or []
+    if candidates:
+        reason = getattr(candidates[0], 'finish_reason', None)
+        if reason is not None:
+            finish_reason = getattr(reason, 'name', None) or str(reason)
+    return {
+        'prompt_tokens': int(getattr(usage, 'prompt_token_count', 0) or 0),
+        'output_tokens': int(getattr(usage, 'candidates_token_count', 0) or 0),
+        'total_tokens': int(getattr(usage, 'total_token_count', 0) or 0),
+        'finish_reason': finish_reason,
+        'output_limit': MAX_OUTPUT_TOKENS,
+    }
+
+
 def build_prompt(text_24h: str, text_recent: str, recent_hours: int) -> str:
     sections = [
         DIGEST_PROMPT.strip(),
@@ -162,22 +292,33 @@ def concat(summaries: List[str]) -> str:
 
     return "\n\n（ここから下は詳細）\n\n".join(processed_summaries)
 
-def chunk_by_time(messages: List[Dict[str, Any]], max_tokens: int = 4000) -> List[List[Dict[str, Any]]]:
+def _align_bucket(msg: Dict[str, Any], align_hours: int) -> int:
+    if align_hours <= 0:
+        return 0
+    dt = datetime.strptime(msg['date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return int(dt.timestamp()) // (align_hours * 3600)
+
+
+def chunk_by_time(messages: List[Dict[str, Any]], max_tokens: int = 4000,
+                  align_hours: int = CHUNK_ALIGN_HOURS) -> List[List[Dict[str, Any]]]:
     # トークン数に基づいてチャンクに分割するロジック
     # 簡易的に文字数（バイト数）をトークン数の代わりとして使用
+    # align_hours ごとの区切りでも切る (区切りの先頭から詰めるので、新着が増えても前のチャンクは変わらない)
     chunks = []
     current_chunk = []
     current_chunk_tokens = 0
+    current_bucket = None
 
     for msg in messages:
-        # processed_text が存在すればそれを使用、なければ元のtextを使用
-        msg_text = msg.get('processed_text') or msg.get('text', '')
-        msg_tokens = len(msg_text.encode('utf-8')) # バイト数をトークン数の代わりとする
+        # processed_text が存在すればそれを使用、なければ元のtextを使用 (バイト数をトークン数の代わりとする)
+        msg_tokens = text_bytes(msg)
+        bucket = _align_bucket(msg, align_hours)
 
-        if current_chunk_tokens + msg_tokens > max_tokens and current_chunk:
+        if current_chunk and (current_chunk_tokens + msg_tokens > max_tokens or bucket != current_bucket):
             chunks.append(current_chunk)
             current_chunk = []
             current_chunk_tokens = 0
+        current_bucket = bucket
 
         current_chunk.append(msg)
         current_chunk_tokens += msg_tokens
@@ -223,12 +364,16 @@ def prepass_enrich(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         enriched_messages.append(msg)
     return enriched_messages
 
-def build_prompt_corpus(messages: List[Dict[str, Any]]) -> str:
+def build_prompt_corpus(messages: List[Dict[str, Any]], recent_after: Optional[datetime] = None) -> str:
     rows: List[str] = []
+    recent_s = recent_after.strftime('%Y-%m-%d %H:%M:%S') if recent_after is not None else None
     for msg in messages:
-        text_single = (msg.get("text") or "").replace("\\n", " ")
-        title = msg.get("chat_title") or msg.get("chat_username") or msg.get("chat") or "unknown"
-        base = f"{msg.get('date')} {title}: {text_single}"
+        text_single = corpus_text(msg)
+        title = corpus_title(msg)
+        # #id は messages[].msg_id で返してもらい、provenance で元の行に戻す
+        base = f"{msg.get('date')} #{msg.get('id')} {title}: {text_single}"
+        if recent_s is not None and (msg.get('date') or '') >= recent_s:
+            base = RECENT_MARK + base
         tags = msg.get("tags", {})
         tag_parts: List[str] = []
         categories = tags.get("categories") or []
@@ -237,15 +382,31 @@ def build_prompt_corpus(messages: List[Dict[str, Any]]) -> str:
         topics = tags.get("topics") or []
         if topics:
             tag_parts.append("topics=" + ",".join(topics))
-        deadline = tags.get("deadline")
-        if deadline:
-            tag_parts.append("deadline=" + deadline)
         if tag_parts:
             rows.append(base + "\\n" + "TAGS: " + "; ".join(tag_parts))
         else:
             rows.append(base)
     return "\\n---\\n".join(rows)
 
+
+def _naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt is not None else None
+
+
+def prompt_corpus(messages: List[Dict[str, Any]], recent_after: Optional[datetime] = None) -> str:
+    """ANALYZE に渡す本文。PROMPT_CORPUS_CODEC=compact (既定) なら圧縮表現、plain なら従来形式。
+
+    recent_after (UTC) 以降のメッセージには行頭に直近窓の印 (*) を付ける。
+    """
+    naive = _naive_utc(recent_after)
+    if PROMPT_CORPUS_CODEC == 'compact':
+        try:
+            return encode_corpus(messages, naive)
+        except ValueError:
+            pass
+    return build_prompt_corpus(messages, naive)
+
+
 def _time_to_minutes(value: str | None) -> int | None:
     if not value:
         return None
@@ -293,54 +454,43 @@ def merge_analysis_results(results: list[dict]) -> dict:
                     aliases.append(alias)
             stored['aliases'] = aliases
 
+        # threads は safe_parse_analysis / make_min_thread_from_raw で検証済みなので、ここでは再正規化しない
         for thread in res.get('threads', []):
-            normalized = normalize_thread(thread)
-            entity_refs = tuple(sorted(normalized.get('entity_refs') or []))
-            section_key = normalized.get('section_hint') or 'その他'
-            title_key = (normalized.get('title') or '').strip().lower()
-            key = (entity_refs, section_key, title_key)
+            key = (tuple(sorted(thread['entity_refs'])), thread['section_hint'], thread['title'].strip().lower())
 
             existing = threads_index.get(key)
             if not existing:
-                new_thread = {
-                    'thread_id': normalized.get('thread_id') or 'thread_{}'.format(len(threads_index) + 1),
-                    'title': normalized.get('title'),
-                    'entity_refs': list(normalized.get('entity_refs', [])),
-                    'messages': list(normalized.get('messages', [])),
-                    'facts': list(normalized.get('facts', [])),
-                    'notes': list(normalized.get('notes', [])),
-                    'risks': list(normalized.get('risks', [])),
-                    'section_hint': section_key,
-                    'mention_count': normalized.get('mention_count') or len(normalized.get('messages', [])),
-                    'time_range': dict(normalized.get('time_range') or {}),
+                threads_index[key] = {
+                    **thread,
+                    'entity_refs': list(thread['entity_refs']),
+                    'messages': list(thread['messages']),
+                    'facts': list(thread['facts']),
+                    'notes': list(thread['notes']),
+                    'risks': list(thread['risks']),
+                    'time_range': dict(thread['time_range']),
                 }
-                threads_index[key] = new_thread
                 continue
 
-            existing.setdefault('messages', []).extend(normalized.get('messages', []))
-            existing.setdefault('facts', []).extend(normalized.get('facts', []))
-            existing.setdefault('notes', []).extend(normalized.get('notes', []))
-            existing.setdefault('risks', []).extend(normalized.get('risks', []))
+            existing['messages'].extend(thread['messages'])
+            existing['facts'].extend(thread['facts'])
+            existing['notes'].extend(thread['notes'])
+            existing['risks'].extend(thread['risks'])
 
-            refs = existing.setdefault('entity_refs', [])
-            for ref in normalized.get('entity_refs', []):
+            refs = existing['entity_refs']
+            for ref in thread['entity_refs']:
                 if ref not in refs:
                     refs.append(ref)
 
-            existing['mention_count'] = existing.get('mention_count', 0) + (
-                normalized.get('mention_count') or len(normalized.get('messages', []))
-            )
-            existing['time_range'] = _merge_time_range(existing.get('time_range'), normalized.get('time_range'))
+            existing['mention_count'] += thread['mention_count']
+            existing['time_range'] = _merge_time_range(existing['time_range'], thread['time_range'])
 
-    meta = results[0].get('meta', {}) if results else {}
+    meta = dict(results[0].get('meta') or {}) if results else {}
     meta['generated_at'] = datetime.now(timezone.utc).isoformat()
 
-    merged_threads = [normalize_thread(thread) for thread in threads_index.values()]
-
     return {
         'meta': meta,
         'entities': list(merged_entities.values()),
-        'threads': merged_threads,
+        'threads': list(threads_index.values()),
     }
 
 def _merge_entities(results: list[dict]) -> list[dict]:
@@ -368,59 +518,288 @@ def _merge_entities(results: list[dict]) -> list[dict]:
                     current[key] = value
     return list(merged_entities.values())
 
-def analyze_digest(api_key: str, hours_24: int, hours_recent: int, context_window_days: int, specs: List[str], string_session: str, api_id: int, api_hash: str, gemini_model: str, digest_mode: str = 'lossless') -> str:
+def make_analyze_caller(api_key: str, gemini_model: str, use_response_schema: bool = True):
+    """ANALYZE 用のモデル呼び出しを返す。response_schema が拒否されたら以降はスキーマ無しで呼ぶ。"""
+    google_exceptions = _google_exceptions()
+    state = {'schema': ANALYZE_RESPONSE_SCHEMA if use_response_schema else None}
+    state['model'] = setup_gemini(api_key, gemini_model, response_mime_type="application/json", response_schema=state['schema'])
+
+    def call(prompt: str, label: str):
+        try:
+            try:
+                return state['model'].generate_content(prompt)
+            except (TypeError, ValueError, KeyError, google_exceptions.InvalidArgument) as exc:
+                if state['schema'] is None:
+                    raise
+                # SDK / モデルが response_schema を受け付けない場合はスキーマ無しで続行する
+                logging.warning("ANALYZE response_schema rejected (%s); retrying without schema.", exc)
+                state['schema'] = None
+                state['model'] = setup_gemini(api_key, gemini_model, response_mime_type="application/json")
+                return state['model'].generate_content(prompt)
+        except google_exceptions.ResourceExhausted as exc:
+            logging.error("Gemini quota exhausted during analyze chunk %s: %s", label, exc)
+            raise GeminiQuotaExceededError("Gemini API quota exhausted") from exc
+
+    return call
+
+
+def window_messages(chunk: List[Dict[str, Any]], now_dt: datetime, hours: int) -> List[Dict[str, Any]]:
+    cutoff = (now_dt - timedelta(hours=hours)).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return [msg for msg in chunk if msg['date'] >= cutoff]
+
+
+def chunk_cache_key(chunk: List[Dict[str, Any]], now_dt: datetime, hours_24: int, hours_recent: int,
+                    gemini_model: str, use_response_schema: bool) -> str:
+    """ANALYZE 結果のキャッシュキー。now_dt 相対のプロンプト全文ではなく、窓内のメッセージの中身
+    (チャット・id・日時・本文・タグ) と直近窓の印の有無で決める。直近窓から外れたチャンクは一度だけ
+    解析し直し、その後は窓から落ちるまで同じキーになる。"""
+    recent = (now_dt - timedelta(hours=hours_recent)).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    content = json.dumps([
+        [str(row_chat(msg)), corpus_title(msg), msg.get('id'), msg.get('date'), msg.get('text'),
+         msg.get('tags') or {}, msg['date'] >= recent]
+        for msg in window_messages(chunk, now_dt, hours_24)
+    ], ensure_ascii=False, sort_keys=True, default=str)
+    header = f"{ANALYZE_PROMPT}\x1f{hours_24}\x1f{hours_recent}\x1f{PROMPT_CORPUS_CODEC}\x1f"
+    return cache_key(header + content, gemini_model, use_response_schema)
+
+
+def build_analyze_prompt(chunk: List[Dict[str, Any]], label: str, now_dt: datetime, hours_24: int, hours_recent: int) -> str:
+    # 過去 hours_24 時間のメッセージを 1 回だけ並べ、直近 hours_recent 時間のものには行頭に * を付ける
+    msgs_24h_in_chunk = window_messages(chunk, now_dt, hours_24)
+    recent_after = now_dt - timedelta(hours=hours_recent)
+    corpus = prompt_corpus(msgs_24h_in_chunk, recent_after)
+    if PROMPT_CORPUS_CODEC == 'compact':
+        # 圧縮の効果: 実際に送る本文と、同じメッセージ・同じ印で作った従来形式との概算トークン差
+        metrics.incr('corpus.tokens_plain', approx_tokens(build_prompt_corpus(msgs_24h_in_chunk, _naive_utc(recent_after))))
+        metrics.incr('corpus.tokens_compact', approx_tokens(corpus))
+
+    return (f"{ANALYZE_PROMPT.strip()}\n\n## 入力データ (チャンク {label})\n"
+            f"### 過去{hours_24}時間のイベント一覧 (行頭 {RECENT_MARK} = 直近{hours_recent}時間の重点イベント)\n{corpus}")
+
+
+def analyze_chunk(call, chunk: List[Dict[str, Any]], label: str, total: int, now_dt: datetime, hours_24: int,
+                  hours_recent: int, truncated_sizes: List[int], depth: int = 0) -> List[dict]:
+    """1 チャンクを解析する。出力上限で切れたら半分に割って再解析し、結果のリストを返す。"""
+    with metrics.span('analyze.chunk', label=label, depth=depth, msgs=len(chunk)) as sp:
+        analyze_prompt_input = build_analyze_prompt(chunk, f"{label}/{total}", now_dt, hours_24, hours_recent)
+        resp = call(analyze_prompt_input, label)
+        usage = response_usage(resp)
+        metrics.record_llm_call('analyze', usage, chunk=label)
+        resp_text = resp.text.strip() if resp.text else ""
+        parsed_analysis = safe_parse_analysis(resp_text, chunk)
+        meta = parsed_analysis.get('meta') or {}
+        fallback = bool(meta.get('fallback'))
+        # finish_reason が MAX_TOKENS、または JSON が閉じていなければ切り詰めとみなす
+        truncated = usage['finish_reason'] == 'MAX_TOKENS' or bool(meta.get('truncated'))
+        sp['attrs'].update(
+            prompt_chars=len(analyze_prompt_input),
+            response_chars=len(resp_text),
+            threads=len(parsed_analysis.get('threads') or []),
+            fallback=fallback,
+            truncated=truncated,
+            prompt_tokens=usage['prompt_tokens'],
+            output_tokens=usage['output_tokens'],
+            finish_reason=usage['finish_reason'],
+        )
+        metrics.incr('analyze.prompt_chars', len(analyze_prompt_input))
+
+    if truncated:
+        truncated_sizes.append(chunk_size(chunk))
+        metrics.incr('analyze.truncated_chunks')
+        if depth < MAX_SPLIT_DEPTH and len(chunk) > 1:
+            # 部分的な結果は捨て、半分ずつ解析し直す (同じメッセージを二重に数えないため)
+            mid = len(chunk) // 2
+            print(f"[info] analyze chunk {label} truncated; splitting into 2 x ~{mid} msgs")
+            metrics.incr('analyze.split_chunks')
+            return (
+                analyze_chunk(call, chunk[:mid], f"{label}.1", total, now_dt, hours_24, hours_recent, truncated_sizes, depth + 1)
+                + analyze_chunk(call, chunk[mid:], f"{label}.2", total, now_dt, hours_24, hours_recent, truncated_sizes, depth + 1)
+            )
+
+    if meta.get('repaired'):
+        metrics.incr('analyze.repaired_chunks')
+    if fallback:
+        metrics.incr('analyze.fallback_chunks')
+    return [parsed_analysis]
+
+
+def message_chat(msg: Dict[str, Any]) -> Any:
+    return row_chat(msg)
+
+
+def analyze_groups(api_key: str, gemini_model: str, enriched_msgs: List[Dict[str, Any]],
+                   groups: Dict[str, Optional[set]], hours_24: int, hours_recent: int,
+                   use_response_schema: bool = True, state_dir: Optional[Path] = None,
+                   now_dt: Optional[datetime] = None) -> Dict[str, dict]:
+    """チャンクを 1 度ずつ解析し、グループ (ダイジェスト) ごとに統合する。
+
+    groups はグループ名 -> 対象チャット集合 (None は全チャット)。グループが複数あるときだけ
+    チャンクをチャット単位で切り、グループ間で共有する (1 つなら従来どおりチャットをまたいで詰める)。
+    同じチャンクは実行間でも chunk_cache で共有する。
+    """
+    now_dt = now_dt or datetime.now(timezone.utc)
+
+    wanted: Optional[set] = set()
+    for chats in groups.values():
+        if chats is None:
+            wanted = None
+            break
+        wanted.update(chats)
+    per_chat = len(groups) > 1
+
+    by_chat: Dict[Any, List[Dict[str, Any]]] = {}
+    for msg in enriched_msgs:
+        chat = message_chat(msg)
+        if wanted is None or chat in wanted:
+            by_chat.setdefault(chat, []).append(msg)
+    # (チャット, メッセージ id) -> 行。apply_provenance で使う
+    index = build_index(msg for msgs in by_chat.values() for msg in msgs)
+
+    # 3. chunk_by_time (複数グループのときはチャットをまたがないように分割)
+    # 予算は過去の切り詰め実績から state/chunk_tuning.json で学習する
+    chunk_budget = load_chunk_budget(state_dir)
+    with metrics.span('chunk', budget=chunk_budget, chats=len(by_chat), per_chat=per_chat) as sp:
+        if per_chat:
+            chat_chunks = [(chat, chunk) for chat, msgs in by_chat.items()
+                           for chunk in chunk_by_time(msgs, max_tokens=chunk_budget)]
+        else:
+            selected = [msg for msg in enriched_msgs if wanted is None or message_chat(msg) in wanted]
+            chat_chunks = [(None, chunk) for chunk in chunk_by_time(selected, max_tokens=chunk_budget)]
+        sp['attrs']['chunks'] = len(chat_chunks)
+    pruned = prune_cache(state_dir)
+    if pruned:
+        metrics.incr('analyze.cache_pruned', pruned)
+
+    # ANALYZE ステップ (per_chat でなければ結果はすべて None の下にまとめる)
+    results_by_chat: Dict[Any, List[dict]] = {}
+    call = make_analyze_caller(api_key, gemini_model, use_response_schema)
+    truncated_sizes: List[int] = []
+    total = len(chat_chunks)
+
+    with metrics.span('analyze', chunks=total) as sp:
+        hits = 0
+        resolved = 0
+        for i, (chat, chunk) in enumerate(chat_chunks):
+            key = chunk_cache_key(chunk, now_dt, hours_24, hours_recent, gemini_model, use_response_schema)
+            results = load_cached(state_dir, key)
+            if results is None:
+                results = analyze_chunk(call, chunk, str(i + 1), total, now_dt, hours_24, hours_recent, truncated_sizes)
+                store_cached(state_dir, key, results)
+            else:
+                hits += 1
+            resolved += resolve_messages(results, chunk)
+            results_by_chat.setdefault(chat, []).extend(results)
+        sp['attrs']['cache_hits'] = hits
+        metrics.incr('analyze.cache_hits', hits)
+        metrics.incr('analyze.msg_refs_resolved', resolved)
+    next_budget = update_chunk_budget(state_dir, chunk_budget, truncated_sizes)
+    metrics.set_value('chunk_budget', {'used': chunk_budget, 'next': next_budget})
+
+    # グループごとに analysis_results を統合
+    merged: Dict[str, dict] = {}
+    for name, chats in groups.items():
+        with metrics.span('merge', group=name) as sp:
+            group_results = [res for chat, results in results_by_chat.items()
+                             if not per_chat or chats is None or chat in chats for res in results]
+            merged[name] = merge_analysis_results(group_results)
+            sp['attrs'].update(results=len(group_results), threads=len(merged[name].get('threads') or []))
+        # 言及数・発言者・時間別件数・時刻範囲・出典はローカルで数えて COMPOSE に渡す
+        with metrics.span('stats', group=name):
+            threads = merged[name].get('threads') or []
+            apply_provenance(threads, index)
+            group_msgs = [msg for chat, msgs in by_chat.items() if chats is None or chat in chats for msg in msgs]
+            frame = build_frame(group_msgs)
+            merged[name]['stats'] = corpus_stats(frame, now_dt, hours_24, hours_recent)
+            merged[name]['calendar'] = build_calendar(group_msgs, now_dt)
+            thread_mentions(frame, threads, now_dt - timedelta(hours=hours_24))
+    return merged
+
+
+def analyze_messages(api_key: str, gemini_model: str, enriched_msgs: List[Dict[str, Any]], hours_24: int, hours_recent: int,
+                     use_response_schema: bool = True, state_dir: Optional[Path] = None,
+                     now_dt: Optional[datetime] = None) -> dict:
+    return analyze_groups(api_key, gemini_model, enriched_msgs, {'default': None}, hours_24, hours_recent,
+                          use_response_schema, state_dir, now_dt)['default']
+
+
+def run_analysis(api_key: str, hours_24: int, hours_recent: int, context_window_days: int, specs: List[str], string_session: str, api_id: int, api_hash: str, gemini_model: str, use_response_schema: bool = True, state_dir: Optional[Path] = None, now_dt: Optional[datetime] = None) -> dict:
     # 1. load_msgs (過去 context_window_days 分のメッセージをロード)
     all_msgs = load_msgs(hours_24, context_window_days, specs, string_session, api_id, api_hash)
 
     # 2. prepass_enrich (タグ付け、用語保全など)
-    enriched_msgs = prepass_enrich(all_msgs)
+    with metrics.span('tag', msgs=len(all_msgs)):
+        enriched_msgs = prepass_enrich(all_msgs)
 
-    # 3. chunk_by_time (メッセージをチャンクに分割)
-    # TODO: max_tokens を適切に設定する
-    chunks = chunk_by_time(enriched_msgs, max_tokens=4000) # 仮のmax_tokens
+    return analyze_messages(api_key, gemini_model, enriched_msgs, hours_24, hours_recent,
+                            use_response_schema, state_dir, now_dt)
 
-    # ANALYZE ステップ
-    analysis_results = []
-    analyze_model = setup_gemini(api_key, gemini_model, response_mime_type="application/json")
 
-    now_dt = datetime.now(timezone.utc)
-    for i, chunk in enumerate(chunks):
-        # チャンク内のメッセージを時間でフィルタリングして text_24h と text_recent を生成
-        cutoff_24h = now_dt - timedelta(hours=hours_24)
-        msgs_24h_in_chunk = [
-            msg for msg in chunk
-            if datetime.strptime(msg['date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc) >= cutoff_24h
-        ]
-        text_24h_chunk = build_prompt_corpus(msgs_24h_in_chunk)
-
-        cutoff_recent = now_dt - timedelta(hours=hours_recent)
-        msgs_recent_in_chunk = [
-            msg for msg in chunk
-            if datetime.strptime(msg['date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc) >= cutoff_recent
-        ]
-        text_recent_chunk = build_prompt_corpus(msgs_recent_in_chunk)
-
-        # ANALYZE プロンプト
-        analyze_prompt_input = f"{ANALYZE_PROMPT.strip()}\n\n## 入力データ (チャンク {i+1}/{len(chunks)})\n### 過去{hours_24}時間のイベント一覧\n{text_24h_chunk}\n### 直近{hours_recent}時間の重点イベント\n{text_recent_chunk}"
-        
-        try:
-            resp = analyze_model.generate_content(analyze_prompt_input)
-        except google_exceptions.ResourceExhausted as exc:
-            logging.error("Gemini quota exhausted during analyze chunk %s: %s", i + 1, exc)
-            raise GeminiQuotaExceededError("Gemini API quota exhausted") from exc
-        parsed_analysis = safe_parse_analysis(resp.text.strip() if resp.text else "", chunk)
-        analysis_results.append(parsed_analysis)
+def union_specs(digest_specs: Dict[str, List[str]]) -> List[str]:
+    union: List[str] = []
+    for specs in digest_specs.values():
+        for spec in specs:
+            if spec not in union:
+                union.append(spec)
+    return union
 
-    # 複数の analysis_results を統合
-    merged_analysis_data = merge_analysis_results(analysis_results)
 
-    # COMPOSE ステップ
-    compose_model = setup_gemini(api_key, gemini_model)
+def analyze_fetched(api_key: str, all_msgs: List[Dict[str, Any]], spec_chats: Dict[str, Optional[int]],
+                    hours_24: int, hours_recent: int, digest_specs: Dict[str, List[str]], gemini_model: str,
+                    use_response_schema: bool = True, state_dir: Optional[Path] = None,
+                    now_dt: Optional[datetime] = None) -> Dict[str, dict]:
+    """取得済みメッセージをタグ付けし、ダイジェストごとの統合結果を返す。"""
+    with metrics.span('tag', msgs=len(all_msgs)):
+        enriched_msgs = prepass_enrich(all_msgs)
+
+    return analyze_groups(api_key, gemini_model, enriched_msgs, digest_groups(digest_specs, spec_chats), hours_24,
+                          hours_recent, use_response_schema, state_dir, now_dt)
+
 
+def digest_groups(digest_specs: Dict[str, List[str]], spec_chats: Dict[str, Optional[int]]) -> Dict[str, set]:
+    return {
+        name: {spec_chats[spec] for spec in specs if spec_chats.get(spec) is not None}
+        for name, specs in digest_specs.items()
+    }
+
+
+def run_multi_analysis(api_key: str, hours_24: int, hours_recent: int, context_window_days: int,
+                       digest_specs: Dict[str, List[str]], string_session: Union[str, List[str]], api_id: int, api_hash: str,
+                       gemini_model: str, use_response_schema: bool = True, state_dir: Optional[Path] = None,
+                       now_dt: Optional[datetime] = None, fetcher=None) -> Dict[str, dict]:
+    """複数ダイジェスト分の spec の和集合を 1 回取得・タグ付けし、ダイジェストごとの統合結果を返す。
+
+    fetcher(hours, specs) -> (rows, spec_chats) を渡すと取得をそれに任せる (常駐プロセスの接続済みクライアント用)。
+    """
+    union = union_specs(digest_specs)
+    total_hours = max(hours_24, context_window_days * 24)
+    with metrics.span('fetch', hours=total_hours, specs=len(union)) as sp:
+        if fetcher is not None:
+            all_msgs, spec_chats = fetcher(total_hours, union)
+        else:
+            # TG_STRING_SESSIONS で複数アカウントが渡されたらチャットを分担して並行取得する
+            from src.telegram_pull import CHECKPOINT_FILE, fetch_sharded
+            sessions = string_session if isinstance(string_session, list) else [string_session]
+            checkpoint_path = Path(state_dir) / CHECKPOINT_FILE if state_dir is not None else None
+            all_msgs, spec_chats = asyncio.run(fetch_sharded(total_hours, union, sessions, api_id, api_hash,
+                                                             load_volumes(state_dir), checkpoint_path))
+            save_volumes(state_dir, all_msgs)
+        sp['attrs']['msgs'] = len(all_msgs)
+
+    return analyze_fetched(api_key, all_msgs, spec_chats, hours_24, hours_recent, digest_specs, gemini_model,
+                           use_response_schema, state_dir, now_dt)
+
+
+def build_compose_payload(merged_analysis_data: dict, hours_24: int, hours_recent: int, context_window_days: int,
+                          specs: List[str], digest_mode: str = 'lossless', now_dt: Optional[datetime] = None,
+                          recent_delta: Optional[dict] = None) -> dict:
+    now_dt = now_dt or datetime.now(timezone.utc)
     window_start_wib = (now_dt - timedelta(hours=hours_recent)).astimezone(WIB)
     window_end_wib = now_dt.astimezone(WIB)
-    compose_payload = {
-        'analysis': merged_analysis_data,
+    # stats / calendar は別項目で渡し、ref / evidence はローカル専用なので送らない
+    analysis = strip_provenance({key: value for key, value in merged_analysis_data.items()
+                                 if key not in ('stats', 'calendar')})
+    return {
+        'analysis': analysis,
         'render_config': RENDER_CONFIG,
         'digest_mode': digest_mode or 'lossless',
         'time_window': {
@@ -435,20 +814,52 @@ def analyze_digest(api_key: str, hours_24: int, hours_recent: int, context_windo
         'source': {
             'specs': specs,
         },
+        # 前回実行との差分 (thread_index で算出済み)。初回は空
+        'recent_delta': recent_delta or {'new': [], 'updated': [], 'resolved': [], 'baseline': True},
+        # analyze_groups で数えた集計 (言及数・発言者・チャット別 / 時間別件数・急増)
+        'stats': merged_analysis_data.get('stats') or {},
+        # 締切カレンダー (プロジェクト単位で名寄せ済み)
+        'calendar': merged_analysis_data.get('calendar') or {'columns': [], 'rows': []},
     }
 
+
+def compose_digest(api_key: str, gemini_model: str, compose_payload: dict) -> str:
+    # COMPOSE ステップ
+    google_exceptions = _google_exceptions()
+    compose_model = setup_gemini(api_key, gemini_model)
+
     compose_prompt_input = f"{COMPOSE_PROMPT.strip()}\n\n{json.dumps(compose_payload, ensure_ascii=False, indent=2)}"
-    try:
-        resp = compose_model.generate_content(compose_prompt_input)
-    except google_exceptions.ResourceExhausted as exc:
-        logging.error("Gemini quota exhausted during compose step: %s", exc)
-        raise GeminiQuotaExceededError("Gemini API quota exhausted") from exc
+    with metrics.span('compose', prompt_chars=len(compose_prompt_input)) as sp:
+        try:
+            resp = compose_model.generate_content(compose_prompt_input)
+        except google_exceptions.ResourceExhausted as exc:
+            logging.error("Gemini quota exhausted during compose step: %s", exc)
+            raise GeminiQuotaExceededError("Gemini API quota exhausted") from exc
+        usage = response_usage(resp)
+        metrics.record_llm_call('compose', usage)
+        sp['attrs'].update(
+            response_chars=len(resp.text or ''),
+            prompt_tokens=usage['prompt_tokens'],
+            output_tokens=usage['output_tokens'],
+            finish_reason=usage['finish_reason'],
+        )
+        if usage['finish_reason'] == 'MAX_TOKENS':
+            logging.warning("COMPOSE hit max_output_tokens=%s; digest may be truncated.", MAX_OUTPUT_TOKENS)
     if resp.text:
         return resp.text.strip()
     logging.warning("LLM returned empty response for COMPOSE step.")
     return "（LLMからの応答がありませんでした。）"
 
 
+def analyze_digest(api_key: str, hours_24: int, hours_recent: int, context_window_days: int, specs: List[str], string_session: str, api_id: int, api_hash: str, gemini_model: str, digest_mode: str = 'lossless', use_response_schema: bool = True, state_dir: Optional[Path] = None) -> str:
+    now_dt = datetime.now(timezone.utc)
+    merged_analysis_data = run_analysis(api_key, hours_24, hours_recent, context_window_days, specs, string_session,
+                                        api_id, api_hash, gemini_model, use_response_schema, state_dir, now_dt)
+    compose_payload = build_compose_payload(merged_analysis_data, hours_24, hours_recent, context_window_days,
+                                            specs, digest_mode, now_dt)
+    return compose_digest(api_key, gemini_model, compose_payload)
+
+
 
 
 
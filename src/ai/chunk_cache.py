@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# チャンク単位の ANALYZE 結果キャッシュ。キーはチャンクの中身 (analysis.chunk_cache_key) とモデル名の
+# ハッシュなので、同じ実行内の別ダイジェストや、窓が重なる次回実行で同じチャンクを再解析しない。
+CACHE_DIR = 'chunk_cache'
+CACHE_TTL_HOURS = 48
+
+
+def cache_key(content: str, model: str, schema: bool) -> str:
+    h = hashlib.sha1()
+    h.update(f"{model}\x1f{int(schema)}\x1f".encode('utf-8'))
+    h.update(content.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _path(state_dir: Path, key: str) -> Path:
+    return Path(state_dir) / CACHE_DIR / f"{key}.json"
+
+
+def load_cached(state_dir: Optional[Path], key: str) -> Optional[List[dict]]:
+    if state_dir is None:
+        return None
+    path = _path(state_dir, key)
+    try:
+        data = json.loads(path.read_text(encoding='utf-8'))
+    except Exception:
+        return None
+    results = data.get('results') if isinstance(data, dict) else None
+    return results if isinstance(results, list) else None
+
+
+def store_cached(state_dir: Optional[Path], key: str, results: List[dict]) -> None:
+    if state_dir is None:
+        return
+    # フォールバック (LLM 失敗時の最小スレッド) はキャッシュしない
+    if any((res.get('meta') or {}).get('fallback') for res in results):
+        return
+    path = _path(state_dir, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps({'results': results}, ensure_ascii=False), encoding='utf-8')
+    tmp.replace(path)
+
+
+def prune_cache(state_dir: Optional[Path], ttl_hours: int = CACHE_TTL_HOURS) -> int:
+    if state_dir is None:
+        return 0
+    cache_dir = Path(state_dir) / CACHE_DIR
+    if not cache_dir.exists():
+        return 0
+    cutoff = time.time() - ttl_hours * 3600
+    removed = 0
+    for path in cache_dir.glob('*.json'):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
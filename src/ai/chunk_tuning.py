@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from src.message_arena import text_bytes
+
+# chunk_by_time の max_tokens (UTF-8 バイト数) の既定値・下限。
+DEFAULT_CHUNK_BUDGET = 4000
+MIN_CHUNK_BUDGET = 600
+# 切り詰めの無い実行が続いたら少しずつ既定値へ戻す
+GROWTH_FACTOR = 1.1
+# 切り詰めが起きたチャンクサイズに対して、次回以降使う割合
+SHRINK_FACTOR = 0.6
+
+TUNING_FILE = 'chunk_tuning.json'
+
+
+def chunk_size(chunk: List[Dict[str, Any]]) -> int:
+    # chunk_by_time と同じ尺度 (processed_text の UTF-8 バイト数)
+    return sum(text_bytes(msg) for msg in chunk)
+
+
+def load_chunk_budget(state_dir: Optional[Path], default: int = DEFAULT_CHUNK_BUDGET) -> int:
+    if state_dir is None:
+        return default
+    path = Path(state_dir) / TUNING_FILE
+    try:
+        data = json.loads(path.read_text(encoding='utf-8'))
+        budget = int(data.get('chunk_budget') or default)
+    except Exception:
+        return default
+    return max(MIN_CHUNK_BUDGET, min(budget, default))
+
+
+def update_chunk_budget(state_dir: Optional[Path], budget: int, truncated_sizes: List[int],
+                        default: int = DEFAULT_CHUNK_BUDGET) -> int:
+    """今回の実行結果から次回のチャンク予算を決めて保存する。"""
+    if truncated_sizes:
+        new_budget = min(budget, int(min(truncated_sizes) * SHRINK_FACTOR))
+    else:
+        new_budget = int(budget * GROWTH_FACTOR)
+    new_budget = max(MIN_CHUNK_BUDGET, min(new_budget, default))
+    if state_dir is not None:
+        path = Path(state_dir) / TUNING_FILE
+        payload = {
+            'chunk_budget': new_budget,
+            'previous_budget': budget,
+            'truncated_sizes': sorted(truncated_sizes),
+        }
+        path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding='utf-8')
+    return new_budget
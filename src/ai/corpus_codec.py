@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+# ANALYZE 入力の圧縮表現。チャンク先頭の対応表 (時刻の基準・チャット・URL) と、各行の
+# 相対時刻 (+分:秒)・短い ID・略号タグで、build_prompt_corpus の冗長な部分を削る。
+# decode_corpus で従来形式へ完全に戻せる (デバッグ用)。
+#
+#   T0=2025-10-19 11:01:00
+#   c1=Chat Title
+#   u1=https://example.com/x
+#   ---
+#   +0:00 c1 #123: text ¤u1 ¤t ad,dl|ETH,SOL
+#   *+95:10 c1 #124: 直近窓のメッセージは行頭に *
+#
+# 本文中のエスケープ: ¤¤ = ¤, ¤n = 改行, ¤u<k> = URL, ¤<n><c> = 文字 c の n 回の連続, 行末の " ¤t " 以降はタグ。
+ESC = '¤'
+RUN_MIN = 4
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+CATEGORY_ABBR = {
+    'emergency': 'em',
+    'market_news': 'mk',
+    'trading': 'tr',
+    'sales': 'sa',
+    'airdrops': 'ad',
+    'deadlines': 'dl',
+    'tech_updates': 'te',
+    'resources': 'rs',
+}
+CATEGORY_FULL = {abbr: name for name, abbr in CATEGORY_ABBR.items()}
+_URL_RE = re.compile(r"https?://\S+")
+_LINE_RE = re.compile(r"^(\*?)\+(\d+):(\d{2}) c(\d+) #(.*?): ")
+RECENT_MARK = '*'
+
+
+def corpus_title(msg: Dict[str, Any]) -> str:
+    return msg.get("chat_title") or msg.get("chat_username") or msg.get("chat") or "unknown"
+
+
+def corpus_text(msg: Dict[str, Any]) -> str:
+    return (msg.get("text") or "").replace("\\n", " ")
+
+
+def approx_tokens(text: str) -> int:
+    """おおよそのトークン数 (ASCII は 4 文字で 1、それ以外は 1 文字 1)。"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def _encode_segment(seg: str, out: List[str]) -> None:
+    i = 0
+    while i < len(seg):
+        ch = seg[i]
+        if ch == ESC:
+            out.append(ESC + ESC)
+            i += 1
+            continue
+        if ch == '\n':
+            out.append(ESC + 'n')
+            i += 1
+            continue
+        j = i
+        while j < len(seg) and seg[j] == ch:
+            j += 1
+        n = j - i
+        out.append(f"{ESC}{n}{ch}" if n >= RUN_MIN and not ch.isdigit() else ch * n)
+        i = j
+
+
+def _encode_text(text: str, url_ids: Dict[str, int]) -> str:
+    out: List[str] = []
+    pos = 0
+    for m in _URL_RE.finditer(text):
+        _encode_segment(text[pos:m.start()], out)
+        out.append(f"{ESC}u{url_ids.setdefault(m.group(0), len(url_ids) + 1)}")
+        pos = m.end()
+    _encode_segment(text[pos:], out)
+    return ''.join(out)
+
+
+def encode_corpus(messages: List[Dict[str, Any]], recent_after: Optional[datetime] = None) -> str:
+    """圧縮表現を返す。日時が読めないメッセージがあれば ValueError (呼び出し側で従来形式に戻す)。
+
+    recent_after (naive UTC) 以降のメッセージは行頭に * を付ける (decode でも残す)。
+    """
+    if not messages:
+        return ""
+    stamps = [datetime.strptime(msg.get('date') or '', TS_FORMAT) for msg in messages]
+    base = min(stamps)
+    chat_ids: Dict[str, int] = {}
+    url_ids: Dict[str, int] = {}
+    lines: List[str] = []
+    for msg, stamp in zip(messages, stamps):
+        chat = chat_ids.setdefault(corpus_title(msg), len(chat_ids) + 1)
+        minutes, seconds = divmod(int((stamp - base).total_seconds()), 60)
+        mark = RECENT_MARK if recent_after is not None and stamp >= recent_after else ''
+        line = f"{mark}+{minutes}:{seconds:02d} c{chat} #{msg.get('id')}: {_encode_text(corpus_text(msg), url_ids)}"
+        tags = msg.get("tags", {})
+        categories = [CATEGORY_ABBR.get(c, c) for c in tags.get("categories") or []]
+        topics = tags.get("topics") or []
+        if categories or topics:
+            line += f" {ESC}t {','.join(categories)}|{','.join(topics)}"
+        lines.append(line)
+
+    header = [f"T0={base.strftime(TS_FORMAT)}"]
+    for title, i in chat_ids.items():
+        encoded: List[str] = []
+        _encode_segment(title, encoded)
+        header.append(f"c{i}={''.join(encoded)}")
+    header += [f"u{i}={url}" for url, i in url_ids.items()]
+    return "\n".join(header + ["---"] + lines)
+
+
+def _decode_text(enc: str, urls: Dict[str, str]) -> tuple:
+    """(本文, タグ部分 or None) を返す。"""
+    out: List[str] = []
+    i = 0
+    while i < len(enc):
+        ch = enc[i]
+        if ch != ESC:
+            out.append(ch)
+            i += 1
+            continue
+        nxt = enc[i + 1]
+        if nxt == ESC:
+            out.append(ESC)
+            i += 2
+        elif nxt == 'n':
+            out.append('\n')
+            i += 2
+        elif nxt == 't':
+            # エンコード時に足した区切りの空白 1 つを戻す
+            out.pop()
+            return ''.join(out), enc[i + 3:]
+        elif nxt == 'u':
+            j = i + 2
+            while j < len(enc) and enc[j].isascii() and enc[j].isdigit():
+                j += 1
+            out.append(urls[enc[i + 2:j]])
+            i = j
+        else:
+            j = i + 1
+            while enc[j].isascii() and enc[j].isdigit():
+                j += 1
+            out.append(enc[j] * int(enc[i + 1:j]))
+            i = j + 1
+    return ''.join(out), None
+
+
+def decode_corpus(compact: str) -> str:
+    """encode_corpus の出力を build_prompt_corpus の従来形式 (同じ recent_after で作ったもの) に戻す。"""
+    if not compact:
+        return ""
+    head, _, body = compact.partition("\n---\n")
+    base = None
+    chats: Dict[str, str] = {}
+    urls: Dict[str, str] = {}
+    for line in head.split("\n"):
+        key, _, value = line.partition("=")
+        if key == "T0":
+            base = datetime.strptime(value, TS_FORMAT)
+        elif key.startswith("c"):
+            chats[key[1:]] = _decode_text(value, {})[0]
+        elif key.startswith("u"):
+            urls[key[1:]] = value
+    rows: List[str] = []
+    for line in body.split("\n"):
+        m = _LINE_RE.match(line)
+        stamp = base + timedelta(minutes=int(m.group(2)), seconds=int(m.group(3)))
+        text, tags = _decode_text(line[m.end():], urls)
+        row = f"{m.group(1)}{stamp.strftime(TS_FORMAT)} #{m.group(5)} {chats[m.group(4)]}: {text}"
+        if tags is not None:
+            cats, _, topics = tags.partition("|")
+            parts = []
+            if cats:
+                parts.append("categories=" + ",".join(CATEGORY_FULL.get(c, c) for c in cats.split(",")))
+            if topics:
+                parts.append("topics=" + topics)
+            row += "\\n" + "TAGS: " + "; ".join(parts)
+        rows.append(row)
+    return "\\n---\\n".join(rows)
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+from src.rules import deadline_keyword
+
+# 締切カレンダー。tag_message が拾った日付 (tags.deadlines, UTC) をプロジェクト単位で名寄せし、
+# COMPOSE には散らばった締切の発言ではなく 1 枚の表として渡す。
+UTC = timezone.utc
+WIB = timezone(timedelta(hours=7))
+CALENDAR_COLUMNS = ['utc', 'wib', 'project', 'kind', 'mentions', 'note']
+CALENDAR_LIMIT = 30
+PAST_HOURS = 24  # 過ぎた締切もこの時間までは載せる
+HORIZON_DAYS = 60
+NOTE_LIMIT = 80
+
+
+def _parse_utc(value: str) -> datetime:
+    fmt = '%Y-%m-%d %H:%M' if len(value) > 10 else '%Y-%m-%d'
+    return datetime.strptime(value, fmt).replace(tzinfo=UTC)
+
+
+def _note(text: str) -> str:
+    flat = ' '.join((text or '').split())
+    return flat[:NOTE_LIMIT] + ('…' if len(flat) > NOTE_LIMIT else '')
+
+
+def build_calendar(msgs: List[Dict[str, Any]], now_dt: datetime, past_hours: int = PAST_HOURS,
+                   horizon_days: int = HORIZON_DAYS, limit: int = CALENDAR_LIMIT) -> Dict[str, Any]:
+    """(プロジェクト, 日時) で重複を除いた締切の表を返す。
+
+    プロジェクトはメッセージの話題のうちグループ内で最も言及の多いもの (無ければチャット名)。
+    同じプロジェクト・同じ日付で時刻付きの項目があれば、日付だけの項目はそちらにまとめる。
+    """
+    freq = Counter(topic for msg in msgs for topic in (msg.get('tags') or {}).get('topics') or [])
+    start = now_dt - timedelta(hours=past_hours)
+    end = now_dt + timedelta(days=horizon_days)
+
+    entries: Dict[tuple, Dict[str, Any]] = {}
+    for msg in msgs:
+        tags = msg.get('tags') or {}
+        topics = tags.get('topics') or []
+        project = max(topics, key=lambda t: (freq[t], t)) if topics else (msg.get('chat') or '')
+        for value in tags.get('deadlines') or []:
+            when = _parse_utc(value)
+            # 日付だけの締切はその日の終わりまで有効とみなす
+            if (when + (timedelta(days=1) if len(value) <= 10 else timedelta())) < start or when > end:
+                continue
+            key = (project, value)
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = {
+                    'utc': value,
+                    'project': project,
+                    'kind': deadline_keyword(msg.get('text') or '') or '',
+                    'mentions': 0,
+                    'note': _note(msg.get('text') or ''),
+                }
+            entry['mentions'] += 1
+            if not entry['kind']:
+                entry['kind'] = deadline_keyword(msg.get('text') or '') or ''
+
+    # 日付だけの項目を同日の時刻付き項目へ寄せる
+    for (project, value), entry in list(entries.items()):
+        if len(value) > 10:
+            continue
+        timed = [e for (p, v), e in entries.items() if p == project and len(v) > 10 and v.startswith(value)]
+        if timed:
+            timed[0]['mentions'] += entry['mentions']
+            timed[0]['kind'] = timed[0]['kind'] or entry['kind']
+            del entries[(project, value)]
+
+    rows = sorted(entries.values(), key=lambda e: (e['utc'], -e['mentions'], e['project']))[:limit]
+    table = []
+    for entry in rows:
+        when = _parse_utc(entry['utc'])
+        wib = when.astimezone(WIB).strftime('%Y-%m-%d %H:%M') if len(entry['utc']) > 10 else entry['utc']
+        table.append([entry['utc'], wib, entry['project'], entry['kind'], entry['mentions'], entry['note']])
+    return {'columns': CALENDAR_COLUMNS, 'rows': table}
@@ -1,4 +1,7 @@
 import json, re
+from typing import Any, Dict, List, Optional, Tuple
+
+
 def strip_code_fences(text: str) -> str:
     if not isinstance(text, str): return text
     s = text.strip()
@@ -7,6 +10,8 @@ def strip_code_fences(text: str) -> str:
         if len(parts) >= 3:
             body = parts[1]
             return body.split("\n", 1)[-1].strip()
+        # 閉じフェンスが無い (出力が途中で切れた) 場合は先頭行だけ落とす
+        return s.split("\n", 1)[-1].strip()
     return s
 
 _SMART = { "\u201c": '"', "\u201d": '"', "\u201e": '"', "\u201f": '"',
@@ -17,26 +22,147 @@ def _clean(s: str) -> str:
     s = re.sub(r",\s*([\}\]])", r"\1", s)
     return s.strip()
 
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def _decode_key(text: str, span: Optional[Tuple[int, int]]) -> Optional[str]:
+    if span is None:
+        return None
+    try:
+        return json.loads(text[span[0]:span[1]])
+    except Exception:
+        return None
+
+
+def _scan_object(text: str, start: int) -> Tuple[str, int, Dict[str, Any]]:
+    """start の '{' から 1 パスで走査し、(修復済みJSON文字列, 走査終了位置, 情報) を返す。
+
+    文字列リテラル内の括弧は無視する。末尾カンマは捨て、途中で切れていれば最後に完結した要素の
+    直後で切って開いている配列・オブジェクトを閉じる。
+    """
+    stack: List[str] = []
+    key_stack: List[Optional[Tuple[int, int]]] = []
+    dropped: List[int] = []  # 捨てる末尾カンマの位置
+    in_string = False
+    escape = False
+    string_start = 0
+    last_string: Optional[Tuple[int, int]] = None
+    current_key: Optional[Tuple[int, int]] = None
+    pending_comma: Optional[int] = None
+    # (切断位置, その時点のスタック, キー, それまでに捨てたカンマ数)
+    safe_cut: Optional[Tuple[int, str, List[Optional[Tuple[int, int]]], int]] = None
+
+    i = start
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                last_string = (string_start, i + 1)
+            i += 1
+            continue
+        if ch in " \t\r\n":
+            i += 1
+            continue
+        if ch in "}]" and pending_comma is not None:
+            dropped.append(pending_comma)
+        if ch != ",":
+            pending_comma = None
+        if ch == '"':
+            in_string = True
+            string_start = i
+        elif ch == ":":
+            current_key = last_string
+        elif ch in "{[":
+            stack.append(ch)
+            key_stack.append(current_key)
+            current_key = None
+            safe_cut = (i + 1, "".join(stack), list(key_stack), len(dropped))
+        elif ch in "}]":
+            if not stack or _CLOSERS[stack[-1]] != ch:
+                break
+            stack.pop()
+            key_stack.pop()
+            current_key = None
+            if not stack:
+                return _without(text, start, i + 1, dropped), i + 1, {"truncated": False, "repaired": bool(dropped)}
+            safe_cut = (i + 1, "".join(stack), list(key_stack), len(dropped))
+        elif ch == ",":
+            if pending_comma is None and stack:
+                safe_cut = (i, "".join(stack), list(key_stack), len(dropped))
+            pending_comma = i
+            current_key = None
+        i += 1
+
+    if safe_cut is None:
+        return "", n, {"truncated": True, "repaired": False}
+    cut, open_stack, open_keys, n_dropped = safe_cut
+    body = _without(text, start, cut, dropped[:n_dropped]).rstrip().rstrip(",")
+    closers = "".join(_CLOSERS[c] for c in reversed(open_stack))
+    info = {
+        "truncated": True,
+        "repaired": True,
+        "dropped_chars": n - cut,
+        "open_keys": [_decode_key(text, span) for span in open_keys],
+    }
+    return body + closers, n, info
+
+
+def _without(text: str, start: int, end: int, dropped: List[int]) -> str:
+    if not dropped:
+        return text[start:end]
+    pieces: List[str] = []
+    pos = start
+    for idx in dropped:
+        if idx < start or idx >= end:
+            continue
+        pieces.append(text[pos:idx])
+        pos = idx + 1
+    pieces.append(text[pos:end])
+    return "".join(pieces)
+
+
+def tolerant_json_loads(raw: str) -> Tuple[Optional[dict], Dict[str, Any]]:
+    """LLM 出力から最初の JSON オブジェクトを線形時間で取り出す。途中切れは閉じて修復する。
+
+    戻り値の info には truncated / repaired と、修復時に開いていたコンテナのキー列 open_keys
+    (例: [None, "threads", None] = threads 配列の要素の途中で切れた) が入る。
+    """
+    text = strip_code_fences(raw or "")
+    try:
+        obj = json.loads(text)
+        if isinstance(obj, dict):
+            return obj, {"truncated": False, "repaired": False}
+    except Exception:
+        pass
+    pos = text.find("{")
+    while pos != -1:
+        candidate, end, info = _scan_object(text, pos)
+        if candidate:
+            try:
+                obj = json.loads(candidate)
+                if isinstance(obj, dict):
+                    return obj, info
+            except Exception:
+                pass
+        if info.get("truncated"):
+            break
+        pos = text.find("{", max(end, pos + 1))
+    return None, {"truncated": True, "repaired": False}
+
+
 def safe_json_loads(raw: str):
+    obj, _ = tolerant_json_loads(raw)
+    if obj is not None:
+        return obj
+    # 引用符の全角化など、構造以外の崩れは従来の置換で最後に一度だけ試す
     t = _clean(raw)
-    try:
-        obj = json.loads(t)
-        if isinstance(obj, dict): return obj
-    except Exception: pass
-    # bracket scan
-    stack, start, cands = [], None, []
-    for i,ch in enumerate(t):
-        if ch == "{":
-            if not stack: start = i
-            stack.append("{")
-        elif ch == "}":
-            if stack:
-                stack.pop()
-                if not stack and start is not None:
-                    cands.append(t[start:i+1]); start = None
-    for frag in cands or [t]:
-        try:
-            obj = json.loads(frag)
-            if isinstance(obj, dict): return obj
-        except Exception: continue
-    raise ValueError("no valid JSON found")
\ No newline at end of file
+    obj, _ = tolerant_json_loads(t)
+    if obj is not None:
+        return obj
+    raise ValueError("no valid JSON found")
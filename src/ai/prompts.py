@@ -18,17 +18,24 @@ Output format:
       "notes": ["Support escalated"],
       "risks": ["Users losing allocation"],
       "section_hint": "Now",
-      "mention_count": 5,
       "time_range": {"start_wib": "12:10", "end_wib": "14:20"}
     }
   ]
 }
 
+Input encoding (compact form):
+- Each chunk starts with a header: `T0=<UTC timestamp>`, `cN=<chat title>`, `uN=<URL>`, then `---`.
+- Each line is `+M:SS cN #<id>: <text>`; +M:SS is minutes:seconds after T0 (UTC).
+- Inside text: `¤uN` is URL uN, `¤n` a line break, `¤<count><char>` a repeated character, `¤¤` a literal ¤.
+- In either form, a leading `*` marks messages from the recent window; give them the emphasis the old "直近" section had (prefer section_hint "Now" for live issues among them).
+- A trailing ` ¤t cats|topics` holds tags; category codes: em=emergency, mk=market_news, tr=trading, sa=sales, ad=airdrops, dl=deadlines, te=tech_updates, rs=resources.
+
 Guidelines:
 - Always return valid JSON. Do not include Markdown or commentary outside JSON.
-- Every thread must include: thread_id, title, entity_refs, messages, facts, notes, risks, section_hint, mention_count, time_range.
+- Every thread must include: thread_id, title, entity_refs, messages, facts, notes, risks, section_hint, time_range.
 - section_hint must be one of ["Now", "Heads-up", "Context", "その他"]. Choose based on urgency: live fire for Now, upcoming actions for Heads-up, background for Context, everything else for その他.
-- mention_count should reflect how many source messages refer to the topic. Derive it from the provided chunk if the model cannot infer a number precisely.
+- messages[].msg_id must be the number after `#` on the source line (e.g. "123" for `#123`); never invent ids.
+- Do not count mentions; mention counts are computed locally from entity_refs, so list every entity the thread is about.
 - time_range.start_wib / end_wib should capture earliest and latest WIB hh:mm observed in the thread; leave null when unavailable.
 - Never drop critical details such as amounts, fees, KYC, FCFS instructions, error messages, or platform-specific steps.
 - For malformed or empty chunks, create a fallback thread via make_min_thread_from_raw with section_hint="その他" so nothing is lost.
@@ -43,15 +50,83 @@ You receive:
 - render_config: formatting hints (sections, chunk limit, header template)
 - digest_mode: currently `lossless`
 - time_window: coverage window in WIB
+- recent_delta: titles that are new / updated / resolved since the previous run (already computed; do not re-derive)
+- calendar: deadline table (columns: utc, wib, project, kind, mentions, note) extracted and deduplicated locally from every message
+- stats: exact counts from the source messages — topics (count / recent / chats), speakers, per-chat and hourly activity, bursts (hours where a topic spiked)
 
 Produce Markdown that satisfies every rule below:
 1. Header: output a single bold header using render_config.header_template with time_window.start_wib and time_window.end_wib. Never use 「今日」.
 2. Sections: emit `## Now`, `## Heads-up`, `## Context`, `## その他` in that order. If a section has no material, write `該当なし` under it. Do not create extra sections unless you must; place any extras after the forced four headings.
 3. Topics: within each section, list at most 12 topics. Begin each topic with a bold headline like `**Legion — Direct contract / refund**` (entity + ndash + theme). Merge redundant threads so the same theme appears only once. If many minor notes remain, consolidate them into a single themed topic.
 4. Body: follow the headline with a dense paragraph (2–6 sentences) that preserves every critical detail: numbers, time ranges, fees, requirements, outages, causes, mitigation, and calls to action. Longer paragraphs are acceptable only when essential—avoid repetition.
-5. Provenance footer: end every topic with `（言及×N / HH:MM–HH:MM WIB）`. Use the earliest and latest WIB timestamps available; if the end time is unknown, output `（言及×N / HH:MM WIB）` instead. Use half-width digits.
+5. Provenance footer: end every topic with `（言及×N / HH:MM–HH:MM WIB）`, where N is the thread's mention_count (sum them when merging threads). Take every number about activity (mentions, speakers, message volume, spikes) from stats or mention_count; never estimate counts yourself. Use the earliest and latest WIB timestamps available; if the end time is unknown, output `（言及×N / HH:MM WIB）` instead. Use half-width digits.
 6. Language: write in Japanese while keeping expected English terms alongside their Japanese counterparts when clarity benefits (例: "直コン (Direct contract)"). Maintain a neutral, factual tone focused on operational relevance. Do not include evidence URLs or message IDs. Avoid vague phrases like “〜が議論されています” — explicitly capture who/what/impact. When source detail is sparse, quote the key line or state what is unknown.
 7. Keep each paragraph information-dense: weave multiple facts together, optionally using `・` inside sentences for clarity.
 8. Do not repeat the same sentence or restate an identical fact twice; merge duplicates into one richer sentence.
-9. Output only the Markdown described above. No surrounding commentary, code fences, or JSON.
+9. Deltas: when a thread has `delta: "new"` append ` (新規)` to its topic headline, and ` (更新)` for `delta: "updated"`. If recent_delta.resolved is non-empty, add one topic `**解消済み — 前回からの終息トピック**` under `## その他` listing those titles. Never guess deltas yourself.
+10. Deadlines: take dates and times from calendar only. Put upcoming rows (within 72h of time_window.end_iso) under `## Heads-up` as one topic `**締切カレンダー — 直近の期限**` with one `・` line per row in the form `MM/DD HH:MM WIB project kind` (omit HH:MM when the row has no time), and do not restate those dates in other topics. Never reconcile or guess deadlines from thread text.
+11. Output only the Markdown described above. No surrounding commentary, code fences, or JSON.
 """
+
+# ANALYZE の response_schema (Gemini の OpenAPI サブセット)。プロンプトの Output format と同じ形。
+ANALYZE_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "meta": {
+            "type": "OBJECT",
+            "properties": {"timezone": {"type": "STRING"}},
+        },
+        "entities": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "canonical": {"type": "STRING"},
+                    "type": {"type": "STRING"},
+                    "aliases": {"type": "ARRAY", "items": {"type": "STRING"}},
+                },
+                "required": ["canonical"],
+            },
+        },
+        "threads": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "thread_id": {"type": "STRING"},
+                    "title": {"type": "STRING"},
+                    "entity_refs": {"type": "ARRAY", "items": {"type": "STRING"}},
+                    "messages": {
+                        "type": "ARRAY",
+                        "items": {
+                            "type": "OBJECT",
+                            "properties": {
+                                "msg_id": {"type": "STRING"},
+                                "time_wib": {"type": "STRING", "nullable": True},
+                                "text": {"type": "STRING"},
+                            },
+                            "required": ["msg_id", "text"],
+                        },
+                    },
+                    "facts": {"type": "ARRAY", "items": {"type": "STRING"}},
+                    "notes": {"type": "ARRAY", "items": {"type": "STRING"}},
+                    "risks": {"type": "ARRAY", "items": {"type": "STRING"}},
+                    "section_hint": {
+                        "type": "STRING",
+                        "format": "enum",
+                        "enum": ["Now", "Heads-up", "Context", "その他"],
+                    },
+                    "time_range": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "start_wib": {"type": "STRING", "nullable": True},
+                            "end_wib": {"type": "STRING", "nullable": True},
+                        },
+                    },
+                },
+                "required": ["thread_id", "title", "entity_refs", "messages", "facts", "section_hint"],
+            },
+        },
+    },
+    "required": ["threads"],
+}
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from src.provenance import row_chat, source_key
+from src.rules import normalize_topic
+
+# タグ付け済みメッセージからの集計。言及数・発言者数・チャット別 / 時間別の件数・急増を
+# ローカルで正確に数えて COMPOSE に渡し、LLM には数えさせない。
+WIB = timezone(timedelta(hours=7))
+TOP_N = 20
+# 急増判定: 1 時間の件数が BURST_MIN_COUNT 以上かつ、その話題の 1 時間あたり平均 + BURST_Z σ を超える
+BURST_MIN_COUNT = 5
+BURST_Z = 3.0
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _codes(values: List[str]):
+    """文字列列を (語彙, コード配列) にする。"""
+    vocab, codes = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    return vocab, codes.astype(np.int64)
+
+
+def build_frame(msgs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """メッセージを列 (NumPy 配列) に展開する。話題は (メッセージ番号, 話題コード) のペア列で持つ。"""
+    ts = np.array([datetime.strptime(m['date'], TS_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+                   for m in msgs], dtype=np.int64)
+    chats, chat_code = _codes([str(m.get('chat') or m.get('chat_id') or '') for m in msgs] or [''])
+    speakers, speaker_code = _codes([m.get('from') or '' for m in msgs] or [''])
+    pair_msg: List[int] = []
+    pair_topic: List[str] = []
+    for i, m in enumerate(msgs):
+        for topic in (m.get('tags') or {}).get('topics') or []:
+            pair_msg.append(i)
+            pair_topic.append(topic)
+    topics, topic_code = _codes(pair_topic or [''])
+    return {
+        'n': len(msgs),
+        'keys': [source_key(row_chat(m), m.get('id')) for m in msgs],
+        'ts': ts,
+        'chats': chats,
+        'chat_code': chat_code[:len(msgs)],
+        'speakers': speakers,
+        'speaker_code': speaker_code[:len(msgs)],
+        'topics': topics,
+        'pair_msg': np.asarray(pair_msg, dtype=np.int64),
+        'pair_topic': topic_code[:len(pair_msg)],
+    }
+
+
+def _top(vocab: np.ndarray, counts: np.ndarray, top_n: int, skip_empty: bool = True) -> List[int]:
+    order = np.argsort(-counts, kind='stable')
+    picked = [int(i) for i in order if counts[i] > 0 and not (skip_empty and vocab[i] == '')]
+    return picked[:top_n]
+
+
+def corpus_stats(frame: Dict[str, Any], now_dt: datetime, hours_24: int, hours_recent: int,
+                 top_n: int = TOP_N) -> Dict[str, Any]:
+    """hours_24 の窓で集計する。recent は hours_recent の窓の件数。"""
+    now_ts = int(now_dt.timestamp())
+    ts = frame['ts']
+    age_h = (now_ts - ts) // 3600
+    in_window = (age_h >= 0) & (age_h < hours_24)
+    in_recent = in_window & (now_ts - ts < hours_recent * 3600)
+
+    n_chats = len(frame['chats'])
+    n_speakers = len(frame['speakers'])
+    n_topics = len(frame['topics'])
+
+    chat_total = np.bincount(frame['chat_code'][in_window], minlength=n_chats)
+    chat_recent = np.bincount(frame['chat_code'][in_recent], minlength=n_chats)
+    speaker_total = np.bincount(frame['speaker_code'][in_window], minlength=n_speakers)
+
+    pair_msg = frame['pair_msg']
+    pair_topic = frame['pair_topic']
+    pair_in = in_window[pair_msg] if len(pair_msg) else np.zeros(0, dtype=bool)
+    pair_recent = in_recent[pair_msg] if len(pair_msg) else np.zeros(0, dtype=bool)
+    topic_total = np.bincount(pair_topic[pair_in], minlength=n_topics)
+    topic_recent = np.bincount(pair_topic[pair_recent], minlength=n_topics)
+    # 話題ごとの言及チャット数 ((話題, チャット) の組の重複を除いて数える)
+    topic_chat = np.unique(pair_topic[pair_in] * n_chats + frame['chat_code'][pair_msg[pair_in]])
+    topic_chats = np.bincount(topic_chat // n_chats, minlength=n_topics)
+
+    # 時間別 (古い順, hours_24 本)。ラベルは各時間帯の開始時刻 (WIB)
+    hourly = np.bincount(hours_24 - 1 - age_h[in_window], minlength=hours_24)
+    hour_start = [(now_dt - timedelta(hours=hours_24 - i)).astimezone(WIB).strftime('%H:%M') for i in range(hours_24)]
+
+    # 話題 × 時間の行列から急増を検出
+    topic_hourly = np.zeros((n_topics, hours_24), dtype=np.int64)
+    np.add.at(topic_hourly, (pair_topic[pair_in], hours_24 - 1 - age_h[pair_msg[pair_in]]), 1)
+    mean = topic_hourly.mean(axis=1, keepdims=True)
+    std = topic_hourly.std(axis=1, keepdims=True)
+    burst_mask = (topic_hourly >= BURST_MIN_COUNT) & (topic_hourly > mean + BURST_Z * std)
+    bursts = []
+    for t, h in zip(*np.nonzero(burst_mask)):
+        if frame['topics'][t] == '':
+            continue
+        bursts.append({
+            'topic': str(frame['topics'][t]),
+            'hour_start_wib': hour_start[h],
+            'count': int(topic_hourly[t, h]),
+            'hourly_mean': round(float(mean[t, 0]), 2),
+        })
+    bursts.sort(key=lambda item: -item['count'])
+
+    return {
+        'window_hours': hours_24,
+        'recent_hours': hours_recent,
+        'messages': int(in_window.sum()),
+        'messages_recent': int(in_recent.sum()),
+        'topics': [
+            {'topic': str(frame['topics'][i]), 'count': int(topic_total[i]), 'recent': int(topic_recent[i]),
+             'chats': int(topic_chats[i])}
+            for i in _top(frame['topics'], topic_total, top_n)
+        ],
+        'speakers': [
+            {'name': str(frame['speakers'][i]), 'count': int(speaker_total[i])}
+            for i in _top(frame['speakers'], speaker_total, top_n)
+        ],
+        'chats': [
+            {'chat': str(frame['chats'][i]), 'count': int(chat_total[i]), 'recent': int(chat_recent[i])}
+            for i in _top(frame['chats'], chat_total, len(frame['chats']))
+        ],
+        'hourly': [{'hour_start_wib': hour_start[i], 'count': int(c)} for i, c in enumerate(hourly.tolist())],
+        'bursts': bursts[:top_n],
+    }
+
+
+def thread_mentions(frame: Dict[str, Any], threads: List[Dict[str, Any]], since: Optional[datetime] = None) -> None:
+    """各スレッドの mention_count を、entity_refs のどれかを話題に含むメッセージと
+    スレッドが引用した元メッセージ (provenance で解決済みの ref) の和集合の件数で上書きする。
+
+    どちらも無いスレッドは ANALYZE 側の値 (引用メッセージ数) のまま。
+    """
+    lookup = {str(topic).upper(): i for i, topic in enumerate(frame['topics'])}
+    pair_ok = np.ones(len(frame['pair_msg']), dtype=bool)
+    if since is not None:
+        pair_ok = frame['ts'][frame['pair_msg']] >= int(since.timestamp())
+    for thread in threads:
+        cited = {msg['ref'] for msg in thread.get('messages') or [] if msg.get('ref')}
+        codes = {lookup[key] for key in (normalize_topic(ref).upper() for ref in thread.get('entity_refs') or [])
+                 if key in lookup}
+        if codes and len(frame['pair_msg']):
+            hit = pair_ok & np.isin(frame['pair_topic'], list(codes))
+            cited.update(frame['keys'][i] for i in np.unique(frame['pair_msg'][hit]))
+        if cited:
+            thread['mention_count'] = len(cited)
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+# 前回までのスレッド指紋。state.json の thread_index に保存する。
+# key: エンティティ集合 + 正規化タイトルのハッシュ / value: facts ハッシュと表示用タイトル等
+INDEX_VERSION = 1
+# 解消済み・未再出現のエントリを保持する期間
+RETENTION_DAYS = 7
+
+_TITLE_NOISE_RE = re.compile(r"[\s\-–—:：/|()（）\[\]【】「」『』,.、。!?！？*`'\"]+")
+
+
+def normalize_title(title: str) -> str:
+    text = unicodedata.normalize('NFKC', title or '').lower()
+    return _TITLE_NOISE_RE.sub(' ', text).strip()
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\x1f')
+    return h.hexdigest()[:16]
+
+
+def entity_key(thread: Dict[str, Any]) -> str:
+    refs = sorted({unicodedata.normalize('NFKC', r).strip().lower() for r in thread.get('entity_refs') or [] if r})
+    return '|'.join(refs)
+
+
+def facts_hash(thread: Dict[str, Any]) -> str:
+    # 順序や重複の揺れで「更新」扱いにならないよう、正規化した集合でハッシュする
+    facts = sorted({normalize_title(f) for f in thread.get('facts') or [] if f})
+    return _digest(*facts)
+
+
+def fingerprint(thread: Dict[str, Any]) -> Tuple[str, str, str]:
+    """(スレッドキー, エンティティキー, facts ハッシュ) を返す。"""
+    ents = entity_key(thread)
+    return _digest(ents, normalize_title(thread.get('title') or '')), ents, facts_hash(thread)
+
+
+def _empty_index() -> Dict[str, Any]:
+    return {'version': INDEX_VERSION, 'threads': {}}
+
+
+def load_index(state: Dict[str, Any]) -> Dict[str, Any]:
+    index = (state or {}).get('thread_index')
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION or not isinstance(index.get('threads'), dict):
+        return _empty_index()
+    return index
+
+
+def _match_previous(prints: List[Tuple[str, str, str]], previous: Dict[str, Dict[str, Any]],
+                    by_entities: Dict[str, List[str]]) -> Dict[str, str]:
+    """今回のスレッドキー -> 対応する前回キー。前回の 1 件は今回の 1 キーにしか対応させない。"""
+    # 1 パス目: キーが完全一致するものを先に確定する (後ろに並んだ再登場スレッドの取り合いを防ぐ)
+    links: Dict[str, str] = {key: key for key, _, _ in prints if key in previous}
+    taken = set(links.values())
+    # 2 パス目: タイトルの言い換え対策。未対応のスレッドだけ、同じエンティティ集合の前回スレッドが
+    # 1 件だけ残っていればそれとみなす
+    for key, ents, _ in prints:
+        if key in links or not ents:
+            continue
+        candidates = [k for k in by_entities.get(ents, []) if k not in taken]
+        if len(candidates) == 1:
+            links[key] = candidates[0]
+            taken.add(candidates[0])
+    return links
+
+
+def compute_deltas(threads: List[Dict[str, Any]], index: Dict[str, Any],
+                   now_dt: Optional[datetime] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """前回の指紋インデックスと突き合わせ、各スレッドに delta ('new' / 'updated') を付ける。
+
+    戻り値は (次回用インデックス, recent_delta)。LLM には推定させず、辞書引きだけで決める。
+    """
+    now_dt = now_dt or datetime.now(timezone.utc)
+    now_iso = now_dt.isoformat()
+    previous: Dict[str, Dict[str, Any]] = index.get('threads') or {}
+    last_run = index.get('last_run')
+    baseline = last_run is None
+
+    by_entities: Dict[str, List[str]] = {}
+    for key, entry in previous.items():
+        if entry.get('last_seen') == last_run:
+            by_entities.setdefault(entry.get('entities') or '', []).append(key)
+
+    new_titles: List[str] = []
+    updated_titles: List[str] = []
+    current: Dict[str, Dict[str, Any]] = {}
+
+    # 同じ指紋のスレッドが複数あれば (セクション違い等) facts ハッシュを 1 つにまとめる
+    prints: List[Tuple[str, str, str]] = [fingerprint(thread) for thread in threads]
+    grouped: Dict[str, List[str]] = {}
+    for key, _, fhash in prints:
+        grouped.setdefault(key, []).append(fhash)
+    combined = {key: hashes[0] if len(hashes) == 1 else _digest(*sorted(hashes)) for key, hashes in grouped.items()}
+
+    links = _match_previous(prints, previous, by_entities)
+    matched = set(links.values())
+
+    for thread, (key, ents, _) in zip(threads, prints):
+        fhash = combined[key]
+        title = thread.get('title') or ''
+        prev_key = links.get(key)
+        prev = previous.get(prev_key) if prev_key else None
+
+        if baseline:
+            delta = None
+        elif prev is None:
+            delta = 'new'
+            new_titles.append(title)
+        elif prev.get('facts_hash') != fhash or prev.get('last_seen') != last_run:
+            # facts が変わった / 一度消えてから再登場した
+            delta = 'updated'
+            updated_titles.append(title)
+        else:
+            delta = None
+        thread['delta'] = delta
+
+        if key not in current:
+            current[key] = {
+                'title': title,
+                'entities': ents,
+                'facts_hash': fhash,
+                'section_hint': thread.get('section_hint'),
+                'first_seen': (prev or {}).get('first_seen') or now_iso,
+                'last_seen': now_iso,
+            }
+
+    resolved_titles: List[str] = []
+    cutoff = (now_dt - timedelta(days=RETENTION_DAYS)).isoformat()
+    for key, entry in previous.items():
+        if key in matched or key in current:
+            continue
+        if entry.get('last_seen') == last_run:
+            # 前回は出ていて今回消えたものだけを「解消」とする
+            resolved_titles.append(entry.get('title') or '')
+            current[key] = {**entry, 'resolved_at': now_iso}
+        elif (entry.get('last_seen') or '') >= cutoff:
+            current[key] = entry
+
+    next_index = {'version': INDEX_VERSION, 'last_run': now_iso, 'threads': current}
+    recent_delta = {
+        'new': new_titles,
+        'updated': updated_titles,
+        'resolved': resolved_titles,
+        # 初回 (比較対象なし) は印を付けない
+        'baseline': baseline,
+    }
+    return next_index, recent_delta
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import re
+import time
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional
+
+from src.rules import tag_message
+
+# 緊急カテゴリのメッセージを数秒以内に通知する。タグ付けはバッチ (prepass_enrich) と同じ rules.tag_message。
+ALERT_CATEGORY = 'emergency'
+# 最初の 1 件から DEBOUNCE_SEC 待って、その間に来た同じ話題の連投を 1 通にまとめる
+DEBOUNCE_SEC = 15
+# 同じ話題は COOLDOWN_SEC の間は再通知しない (件数だけ数えて次の通知に載せる)
+COOLDOWN_SEC = 600
+# 同文の転載 (複数チャンネルへの一斉投稿) を捨てる期間
+DEDUPE_TTL_SEC = 3600
+ALERT_TEXT_LIMIT = 300
+
+_SPACE_RE = re.compile(r"\s+")
+_URL_RE = re.compile(r"https?://\S+")
+
+
+def _text_key(text: str) -> str:
+    norm = unicodedata.normalize('NFKC', _URL_RE.sub('', text)).lower()
+    return hashlib.sha1(_SPACE_RE.sub(' ', norm).strip().encode('utf-8')).hexdigest()[:16]
+
+
+def _topic_key(row: Dict[str, Any]) -> str:
+    topics = row.get('tags', {}).get('topics') or []
+    # 話題 (トークン名等) が取れなければチャット単位でまとめる
+    return ','.join(topics[:3]) if topics else f"chat:{row.get('chat_id') or row.get('chat')}"
+
+
+class AlertAggregator:
+    """緊急メッセージの重複除去・デバウンス・クールダウンを行い、送るべきアラートを返す。
+
+    時刻は引数で受け取るので (既定は time.monotonic)、イベントループに依存しない。
+    """
+
+    def __init__(self, debounce: float = DEBOUNCE_SEC, cooldown: float = COOLDOWN_SEC,
+                 dedupe_ttl: float = DEDUPE_TTL_SEC, clock: Callable[[], float] = time.monotonic):
+        self.debounce = debounce
+        self.cooldown = cooldown
+        self.dedupe_ttl = dedupe_ttl
+        self.clock = clock
+        self._seen: Dict[str, float] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._suppressed: Dict[str, int] = {}
+
+    def add(self, row: Dict[str, Any]) -> bool:
+        """行をタグ付けし、緊急なら保留に積む。積んだら True。"""
+        if 'tags' not in row:
+            row['tags'] = tag_message(row)
+        if ALERT_CATEGORY not in row['tags'].get('categories', []):
+            return False
+        now = self.clock()
+        text_key = _text_key(row.get('text') or '')
+        seen_at = self._seen.get(text_key)
+        if seen_at is not None and now - seen_at < self.dedupe_ttl:
+            return False
+        self._seen[text_key] = now
+
+        key = _topic_key(row)
+        last = self._last_sent.get(key)
+        if last is not None and now - last < self.cooldown:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return False
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = {'key': key, 'first_at': now, 'rows': [row]}
+        else:
+            pending['rows'].append(row)
+        return True
+
+    def flush_due(self, force: bool = False) -> List[Dict[str, Any]]:
+        """デバウンス期間を過ぎた保留分をアラートとして取り出す。"""
+        now = self.clock()
+        due: List[Dict[str, Any]] = []
+        for key in list(self._pending):
+            pending = self._pending[key]
+            if not force and now - pending['first_at'] < self.debounce:
+                continue
+            del self._pending[key]
+            pending['suppressed'] = self._suppressed.pop(key, 0)
+            self._last_sent[key] = now
+            due.append(pending)
+        # 古いキーは捨ててメモリを一定に保つ
+        self._seen = {k: t for k, t in self._seen.items() if now - t < self.dedupe_ttl}
+        self._last_sent = {k: t for k, t in self._last_sent.items() if now - t < self.cooldown}
+        return due
+
+
+def format_alert(alert: Dict[str, Any]) -> str:
+    rows = alert['rows']
+    first = rows[0]
+    topics = first.get('tags', {}).get('topics') or []
+    chats = sorted({row.get('chat') or '' for row in rows})
+    head = f"🚨 **緊急アラート** {' / '.join(topics[:3]) or first.get('chat') or ''}".rstrip()
+    lines = [head, f"{first.get('date')} UTC — {', '.join(chats)}"]
+    text = _SPACE_RE.sub(' ', first.get('text') or '').strip()
+    lines.append(text[:ALERT_TEXT_LIMIT] + ('…' if len(text) > ALERT_TEXT_LIMIT else ''))
+    if first.get('link'):
+        lines.append(first['link'])
+    extra = len(rows) - 1 + alert.get('suppressed', 0)
+    if extra:
+        lines.append(f"（ほか関連 {extra} 件）")
+    return "\n".join(lines)
+
+
+async def run_alert_loop(aggregator: AlertAggregator, send: Callable[[str], Any], interval: float = 1.0,
+                         stop: Optional[asyncio.Event] = None) -> None:
+    """保留中のアラートを interval ごとに確認して送る。send はブロッキングでよい (executor で呼ぶ)。"""
+    loop = asyncio.get_running_loop()
+    while stop is None or not stop.is_set():
+        for alert in aggregator.flush_due():
+            content = format_alert(alert)
+            try:
+                await loop.run_in_executor(None, send, content)
+                print(f"[alert] sent {alert['key']} ({len(alert['rows'])} msgs)")
+            except Exception as exc:
+                print(f"[warn] alert post failed: {type(exc).__name__}: {str(exc)[:200]}")
+        await asyncio.sleep(interval)
+
+
+async def attach_alert_stream(client: Any, specs: List[str], webhook_url: str, index: Optional[Dict[str, Any]] = None,
+                              debounce: float = DEBOUNCE_SEC, cooldown: float = COOLDOWN_SEC) -> asyncio.Task:
+    """接続済みクライアントに新着ハンドラを登録し、送信ループのタスクを返す。"""
+    from src.delivery.discord import post_alert
+    from src.telegram_pull import resolve_source_map, watch_sources
+
+    by_spec, notes = await resolve_source_map(client, specs, index)
+    entities: List[Any] = []
+    for entity in by_spec.values():
+        if entity is not None and all(entity.id != e.id for e in entities):
+            entities.append(entity)
+    print(f"[info] alert stream: watching {len(entities)} chats")
+
+    aggregator = AlertAggregator(debounce=debounce, cooldown=cooldown)
+    watch_sources(client, entities, aggregator.add)
+    return asyncio.create_task(run_alert_loop(aggregator, lambda content: post_alert(webhook_url, content)))
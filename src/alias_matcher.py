@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+# チェーン名・プロジェクト名の同時照合 (Aho-Corasick)。本文を 1 回なめるだけで全パターンを
+# 拾うので、辞書が数千語に増えてもメッセージあたりのコストは本文長にしか比例しない。
+# コンパイル済みのオートマトンは aliases.yml のハッシュをキーに JSON でキャッシュする。
+MATCHER_VERSION = 2
+_WORD_CHARS = set('abcdefghijklmnopqrstuvwxyz0123456789')
+
+
+class AliasMatcher:
+    """patterns は (小文字化した語, トピック名, 単語境界を要求するか)。"""
+
+    def __init__(self, goto: List[Dict[str, int]], fail: List[int], out: List[List[int]],
+                 patterns: List[Tuple[str, str, bool]]):
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+        self.patterns = patterns
+
+    @classmethod
+    def compile(cls, patterns: List[Tuple[str, str, bool]]) -> 'AliasMatcher':
+        goto: List[Dict[str, int]] = [{}]
+        out: List[List[int]] = [[]]
+        for pid, (word, _, _) in enumerate(patterns):
+            state = 0
+            for ch in word:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append([])
+                state = nxt
+            out[state].append(pid)
+
+        # 失敗リンクは幅優先で張り、出力は失敗先のものを引き継ぐ
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt].extend(out[fail[nxt]])
+        return cls(goto, fail, out, patterns)
+
+    def find(self, text: str) -> Set[str]:
+        lower = text.lower()
+        goto, fail, out, patterns = self.goto, self.fail, self.out, self.patterns
+        found: Set[str] = set()
+        state = 0
+        for i, ch in enumerate(lower):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for pid in out[state]:
+                word, topic, boundary = patterns[pid]
+                if boundary:
+                    start = i - len(word) + 1
+                    if start > 0 and lower[start - 1] in _WORD_CHARS:
+                        continue
+                    if i + 1 < len(lower) and lower[i + 1] in _WORD_CHARS:
+                        continue
+                found.add(topic)
+        return found
+
+    def to_dict(self) -> dict:
+        return {'goto': self.goto, 'fail': self.fail, 'out': self.out, 'patterns': [list(p) for p in self.patterns]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'AliasMatcher':
+        return cls(data['goto'], data['fail'], data['out'], [(w, t, bool(b)) for w, t, b in data['patterns']])
+
+
+def source_hash(raw: bytes) -> str:
+    return hashlib.sha256(raw + f"v{MATCHER_VERSION}".encode()).hexdigest()[:16]
+
+
+def load_matcher(patterns: List[Tuple[str, str, bool]], digest: str, cache_dir: Optional[Path]) -> AliasMatcher:
+    """cache_dir/alias_matcher.<digest>.json があれば読み、無ければコンパイルして書く (書けなくても続行)。"""
+    path = Path(cache_dir) / f"alias_matcher.{digest}.json" if cache_dir else None
+    if path is not None and path.exists():
+        try:
+            return AliasMatcher.from_dict(json.loads(path.read_text(encoding='utf-8')))
+        except Exception:
+            pass
+    matcher = AliasMatcher.compile(patterns)
+    if path is not None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            for old in path.parent.glob('alias_matcher.*.json'):
+                old.unlink()
+            tmp = path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(matcher.to_dict(), ensure_ascii=False, separators=(',', ':')), encoding='utf-8')
+            tmp.replace(path)
+        except OSError:
+            pass
+    return matcher
@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import re
+from concurrent.futures import Executor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from telethon import errors
+
+from src import metrics
+from src.rules import tag_message
+from src.telegram_pull import FETCH_PAGE_SIZE, MAX_FLOOD_WAIT, fetch_page
+
+UTC = timezone.utc
+
+# 過去ログのバックフィル。チャンネルごとに古い順にページ取得し、日付パーティション
+# (<out>/day=YYYY-MM-DD/<chat_id>-<first_id>-<last_id>.parquet) の列指向ファイルへ書き出す。
+# 書き出しは _pending- 付きの名前で行い、進捗を保存してから本来の名前に変える (途中で落ちた回の
+# ファイルだけを捨てられるように)。既にあるファイルの id 範囲に入るメッセージは書かない。
+# pyarrow は任意依存 (バックフィルを使うときだけ必要)。
+FORMATS = ('parquet', 'arrow')
+PROGRESS_FILE = '_progress.json'  # "_" 始まりは pyarrow.dataset の走査対象外
+FLUSH_ROWS = 5000
+TAG_BATCH = 500
+PENDING_PREFIX = '_pending-'  # "_" 始まりなので確定前のファイルは走査されない
+_PART_RE = re.compile(r"^(?P<pending>_pending-)?(?P<chat>-?\d+)-(?P<first>\d+)-(?P<last>\d+)\.(parquet|arrow)$")
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise SystemExit("[fatal] バックフィルには pyarrow が必要です: pip install pyarrow")
+    return pa, ds
+
+
+def _schema(pa):
+    return pa.schema([
+        ('chat_id', pa.int64()),
+        ('chat', pa.string()),
+        ('chat_title', pa.string()),
+        ('chat_username', pa.string()),
+        ('id', pa.int64()),
+        ('date', pa.timestamp('s', tz='UTC')),
+        ('from', pa.string()),
+        ('text', pa.string()),
+        ('link', pa.string()),
+        ('categories', pa.list_(pa.string())),
+        ('topics', pa.list_(pa.string())),
+        ('deadline', pa.string()),
+        # 締切カレンダー用の全件 (UTC)。この列が無い古い部品は null として読む
+        ('deadlines', pa.list_(pa.string())),
+    ])
+
+
+def tag_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """プロセスプールで呼ぶのでモジュール直下に置く。"""
+    return [tag_message(row) for row in rows]
+
+
+def load_progress(out_dir: Path) -> Dict[str, Any]:
+    try:
+        return json.loads((out_dir / PROGRESS_FILE).read_text(encoding='utf-8'))
+    except Exception:
+        return {}
+
+
+def save_progress(out_dir: Path, progress: Dict[str, Any]) -> None:
+    path = out_dir / PROGRESS_FILE
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(progress, ensure_ascii=False, indent=2), encoding='utf-8')
+    tmp.replace(path)
+
+
+def _settle_pending(out_dir: Path, chat_id: int, last_id: int) -> None:
+    """確定前のファイルのうち、保存済みの進捗 (last_id) までのものは確定し、その先のもの
+    (進捗を保存する前に落ちた回の書きかけ) は消す。確定済みのファイルには触らない。"""
+    for path in out_dir.glob(f"day=*/{PENDING_PREFIX}{chat_id}-*"):
+        m = _PART_RE.match(path.name)
+        if not m:
+            continue
+        if int(m.group('last')) <= last_id:
+            path.replace(path.with_name(path.name[len(PENDING_PREFIX):]))
+        else:
+            path.unlink()
+
+
+def _covered_ids(out_dir: Path, chat_id: int) -> List[List[int]]:
+    """確定済みファイルの id 範囲を重なりを畳んだ [first_id, last_id] の昇順リストで返す。"""
+    spans = []
+    for path in out_dir.glob(f"day=*/{chat_id}-*"):
+        m = _PART_RE.match(path.name)
+        if m and not m.group('pending'):
+            spans.append((int(m.group('first')), int(m.group('last'))))
+    merged: List[List[int]] = []
+    for first, last in sorted(spans):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def _is_covered(spans: List[List[int]], msg_id: int) -> bool:
+    i = bisect.bisect_right(spans, [msg_id, float('inf')]) - 1
+    return i >= 0 and spans[i][1] >= msg_id
+
+
+def _write_parts(out_dir: Path, rows: List[Dict[str, Any]], tags: List[Dict[str, Any]], fmt: str) -> int:
+    pa, _ = _pyarrow()
+    schema = _schema(pa)
+    by_day: Dict[str, List[int]] = {}
+    for i, row in enumerate(rows):
+        by_day.setdefault(row['date'][:10], []).append(i)
+    for day, idx in by_day.items():
+        part = [rows[i] for i in idx]
+        part_tags = [tags[i] for i in idx]
+        table = pa.table({
+            'chat_id': [row['chat_id'] for row in part],
+            'chat': [row['chat'] for row in part],
+            'chat_title': [row['chat_title'] for row in part],
+            'chat_username': [row['chat_username'] for row in part],
+            'id': [row['id'] for row in part],
+            'date': [datetime.strptime(row['date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=UTC) for row in part],
+            'from': [row['from'] for row in part],
+            'text': [row['text'] for row in part],
+            'link': [row['link'] for row in part],
+            'categories': [tag['categories'] for tag in part_tags],
+            'topics': [tag['topics'] for tag in part_tags],
+            'deadline': [tag['deadline'] for tag in part_tags],
+            'deadlines': [tag.get('deadlines') or [] for tag in part_tags],
+        }, schema=schema)
+        day_dir = out_dir / f"day={day}"
+        day_dir.mkdir(parents=True, exist_ok=True)
+        path = day_dir / f"{PENDING_PREFIX}{part[0]['chat_id']}-{part[0]['id']}-{part[-1]['id']}.{fmt}"
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path, compression='zstd')
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, path, compression='zstd')
+    return len(by_day)
+
+
+async def backfill_channel(client: Any, entity: Any, start: datetime, end: datetime, out_dir: Path,
+                           progress: Dict[str, Any], pool: Executor, fmt: str = 'parquet') -> int:
+    """1 チャンネル分を取得し、FLUSH_ROWS ごとに書き出して進捗を保存する。書いた行数を返す。
+
+    タグ付けは取得と並行してプロセスプールで進め、書き出しの直前にだけ待つ。
+    """
+    loop = asyncio.get_running_loop()
+    chat_key = str(entity.id)
+    title = getattr(entity, 'title', '') or getattr(entity, 'username', None) or chat_key
+    last_id = int(progress['channels'].get(chat_key, {}).get('last_id') or 0)
+    if progress['channels'].get(chat_key, {}).get('done'):
+        return 0
+    _settle_pending(out_dir, entity.id, last_id)
+    spans = _covered_ids(out_dir, entity.id)
+    end_s = end.strftime('%Y-%m-%d %H:%M:%S')
+
+    buffered: List[Dict[str, Any]] = []
+    pending: List[asyncio.Future] = []
+    written = 0
+
+    async def flush(page_last_id: int, done: bool) -> None:
+        nonlocal buffered, pending, written
+        tags = [tag for batch in await asyncio.gather(*pending) for tag in batch]
+        if buffered:
+            with metrics.span('backfill.write', chat=title, msgs=len(buffered)):
+                _write_parts(out_dir, buffered, tags, fmt)
+        written += len(buffered)
+        progress['channels'][chat_key] = {'last_id': page_last_id, 'done': done}
+        save_progress(out_dir, progress)
+        _settle_pending(out_dir, entity.id, page_last_id)
+        buffered, pending = [], []
+
+    while True:
+        try:
+            rows, max_id, seen = await fetch_page(client, entity, start, last_id)
+        except errors.FloodWaitError as exc:
+            seconds = float(getattr(exc, 'seconds', 0) or 0)
+            metrics.incr('backfill.flood_waits')
+            if seconds > MAX_FLOOD_WAIT:
+                print(f"[warn] {title}: FloodWait {seconds:.0f}s; 中断します (次回ここから再開)")
+                await flush(last_id, False)
+                return written
+            print(f"[info] {title}: FloodWait {seconds:.0f}s")
+            await asyncio.sleep(seconds)
+            continue
+
+        in_range = [row for row in rows if row['date'] < end_s]
+        done = seen < FETCH_PAGE_SIZE or len(in_range) < len(rows)
+        if len(in_range) < len(rows):
+            # 期間の終わりで止めた回は、期間外の id を進捗に含めない (後で期間を延ばしたときに続きから取れるように)
+            max_id = in_range[-1]['id'] if in_range else last_id
+        # 別の期間で取得済みの id は書かない (期間が重なる再実行での重複を防ぐ)
+        fresh = [row for row in in_range if not _is_covered(spans, row['id'])]
+        metrics.incr('backfill.skipped_existing', len(in_range) - len(fresh))
+        in_range = fresh
+        for i in range(0, len(in_range), TAG_BATCH):
+            pending.append(loop.run_in_executor(pool, tag_rows, in_range[i:i + TAG_BATCH]))
+        buffered.extend(in_range)
+        metrics.incr('backfill.msgs', len(in_range))
+        last_id = max_id
+        if done or len(buffered) >= FLUSH_ROWS:
+            await flush(last_id, done)
+        if done:
+            break
+
+    print(f"[info] {title}: backfilled {written} msgs")
+    return written
+
+
+def scan_backfill(out_dir: Path, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                  columns: Optional[List[str]] = None, chat_ids: Optional[List[int]] = None):
+    """バックフィル結果を pyarrow.Table で返す。日付はパーティション、チャットは行グループ統計で絞り込む。"""
+    pa, ds = _pyarrow()
+    fmt = load_progress(Path(out_dir)).get('format', 'parquet')
+    dataset = ds.dataset(
+        str(out_dir),
+        # 列の増えた部品と古い部品が混ざっても同じ列で読めるよう、スキーマは固定で渡す
+        schema=_schema(pa).append(pa.field('day', pa.string())),
+        format='ipc' if fmt == 'arrow' else 'parquet',
+        partitioning=ds.partitioning(pa.schema([('day', pa.string())]), flavor='hive'),
+    )
+    expr = None
+    for cond in (
+        ds.field('day') >= start_day if start_day else None,
+        ds.field('day') <= end_day if end_day else None,
+        ds.field('chat_id').isin(list(chat_ids)) if chat_ids else None,
+    ):
+        if cond is not None:
+            expr = cond if expr is None else expr & cond
+    return dataset.to_table(columns=columns, filter=expr)
+
+
+def backfill_rows(out_dir: Path, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                  chat_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """fetch_sources と同じ行形式 (tags 付き) に戻す。振り返り用に analyze_groups へそのまま渡せる。"""
+    table = scan_backfill(out_dir, start_day, end_day, chat_ids=chat_ids)
+    rows: List[Dict[str, Any]] = []
+    for rec in table.to_pylist():
+        deadlines = rec['deadlines']
+        if deadlines is None:
+            # deadlines 列の無い古い部品は先頭 1 件 (deadline) だけで代用する
+            deadlines = [rec['deadline']] if rec['deadline'] else []
+        rows.append({
+            'chat': rec['chat'],
+            'chat_id': rec['chat_id'],
+            'chat_title': rec['chat_title'] or '',
+            'chat_username': rec['chat_username'] or '',
+            'id': rec['id'],
+            'date': rec['date'].astimezone(UTC).strftime('%Y-%m-%d %H:%M:%S'),
+            'from': rec['from'] or '',
+            'text': rec['text'],
+            'link': rec['link'],
+            'tags': {'categories': rec['categories'] or [], 'topics': rec['topics'] or [], 'deadline': rec['deadline'],
+                     'deadlines': deadlines},
+        })
+    rows.sort(key=lambda row: (row['date'], row['chat_id'], row['id']))
+    return rows
@@ -1,102 +1,74 @@
 import re
-from typing import List
+import threading
+import time
+from typing import Dict, List, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from src import metrics
+from src.delivery.document import DigestDocument, DigestSection
+from src.delivery.normalize import parse_digest
 
 CHUNK_LIMIT = 1900
 
+# Discord の埋め込み上限 (1 リクエストあたり)
+EMBED_TITLE_LIMIT = 256
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBEDS_PER_MESSAGE = 10
+EMBED_TOTAL_LIMIT = 6000
+CONTENT_LIMIT = 2000
+SECTION_COLORS = {
+    "Now": 0xE74C3C,
+    "Heads-up": 0xF39C12,
+    "Context": 0x3498DB,
+    "その他": 0x95A5A6,
+}
+POST_MODES = ("markdown", "embed")
+MAX_ATTEMPTS = 4
+MAX_RATE_LIMIT_RETRIES = 20
+MAX_RETRY_WAIT = 60.0
+REQUEST_TIMEOUT = 30
 
-def _parse_sections(markdown: str):
-    lines = [line.rstrip() for line in markdown.strip().splitlines()]
-    if not lines:
-        return "", []
-    header = lines[0].strip()
-    sections = []
-    current = None
-    for line in lines[1:]:
-        stripped = line.strip()
-        if stripped.startswith("## "):
-            if current:
-                sections.append(current)
-            current = {"header": stripped, "lines": []}
-        else:
-            if current is None:
-                continue
-            current["lines"].append(line.rstrip())
-    if current:
-        sections.append(current)
-    if not sections:
-        sections = [{"header": "## その他", "lines": [line.rstrip() for line in lines[1:]]}]
-    return header, sections
+# 接続はスレッドごとに持つ (複数ダイジェストを並行に投稿するので requests.Session を共有しない)
+_LOCAL = threading.local()
+# webhook URL ごとのレートリミット状態: {'remaining': int, 'reset_at': monotonic秒}。スレッド間で共有するので _BUCKETS_LOCK で守る
+_BUCKETS: Dict[str, Dict[str, float]] = {}
+_BUCKETS_LOCK = threading.Lock()
 
 
-def _split_topics(section_lines: List[str]) -> List[str]:
-    topics = []
-    current: List[str] = []
-    for line in section_lines:
-        stripped = line.strip()
-        if stripped.startswith("**") and stripped.endswith("**") and current:
-            topics.append("\n".join(current).strip())
-            current = [line]
-        else:
-            current.append(line)
-    if current:
-        topics.append("\n".join(current).strip())
-    filtered = [topic for topic in topics if topic]
-    if not filtered:
-        return ["該当なし"]
-    return filtered
+def _document_sections(document: DigestDocument) -> List[dict]:
+    sections = document.sections or [DigestSection(name="その他")]
+    return [{"header": section.header, "topics": section.topic_texts()} for section in sections]
 
 
 def _split_text_by_length(text: str, limit: int) -> List[str]:
     if len(text) <= limit:
         return [text]
+    limit = max(limit, 1)
     parts: List[str] = []
-    paragraphs = re.split(r"\n{2,}", text)
     current: List[str] = []
-    for para in paragraphs:
-        candidate = "\n\n".join(current + [para]) if current else para
-        if len(candidate) <= limit:
+    current_len = 0
+    for para in re.split(r"\n{2,}", text):
+        # 連結し直さず、"\n\n" 区切り込みの長さを積算して判定する
+        addition = len(para) + (2 if current else 0)
+        if current and current_len + addition <= limit:
             current.append(para)
+            current_len += addition
+            continue
+        if current:
+            parts.append("\n\n".join(current))
+            current, current_len = [], 0
+        if len(para) <= limit:
+            current, current_len = [para], len(para)
         else:
-            if current:
-                parts.append("\n\n".join(current))
-                current = [para]
-            else:
-                for i in range(0, len(para), max(limit, 1)):
-                    parts.append(para[i:i + limit])
-                current = []
+            for i in range(0, len(para), limit):
+                parts.append(para[i:i + limit])
     if current:
         parts.append("\n\n".join(current))
     return [p for p in parts if p]
 
 
-def _build_section_blocks(section: dict, body_limit: int) -> List[str]:
-    header = section["header"]
-    topics = _split_topics(section.get("lines", []))
-    blocks: List[str] = []
-    prefix = header
-    current_lines: List[str] = [prefix]
-    for topic in topics:
-        topic_chunks = _split_text_by_length(topic, body_limit)
-        for chunk in topic_chunks:
-            candidate = "\n\n".join(current_lines + [chunk])
-            if len(candidate) <= body_limit:
-                current_lines.append(chunk)
-            else:
-                blocks.append("\n\n".join(current_lines))
-                header_cont = f"{header} (続き)"
-                if len(chunk) > body_limit:
-                    for piece in _split_text_by_length(chunk, body_limit):
-                        blocks.append(f"{header_cont}\n\n{piece}")
-                    current_lines = [header_cont]
-                else:
-                    current_lines = [header_cont, chunk]
-    if current_lines:
-        blocks.append("\n\n".join(current_lines))
-    return [block.strip() for block in blocks if block.strip()]
-
-
 def _format_header(base_header: str, index: int, total: int) -> str:
     header = base_header.strip()
     if total <= 1:
@@ -120,29 +92,89 @@ def _format_header(base_header: str, index: int, total: int) -> str:
     return header
 
 
-def _assemble_messages(header_line: str, sections: List[dict]) -> List[str]:
-    body_limit = max(400, CHUNK_LIMIT - len(header_line) - 12)
-    section_blocks: List[str] = []
-    for section in sections:
-        section_blocks.extend(_build_section_blocks(section, body_limit))
+def _section_items(sections: List[dict], body_limit: int) -> tuple:
+    """セクションをトピック単位の部品列に展開する。部品の間でしかメッセージを分割しない。"""
+    items: List[tuple] = []  # (section_index, text)
+    headers: List[tuple] = []  # (header, header_cont)
+    for idx, section in enumerate(sections):
+        header = section["header"]
+        header_cont = f"{header} (続き)"
+        headers.append((header, header_cont))
+        piece_limit = max(body_limit - len(header_cont) - 2, 1)
+        for topic in section["topics"]:
+            for piece in _split_text_by_length(topic, piece_limit):
+                items.append((idx, piece.strip()))
+    return items, headers
 
-    messages: List[str] = []
-    current_parts: List[str] = []
-    current_len = 0
-    for block in section_blocks:
-        block = block.strip()
-        if not block:
-            continue
-        addition = len(block) + (2 if current_parts else 0)
-        if current_parts and current_len + addition > body_limit:
-            messages.append("\n\n".join(current_parts))
-            current_parts = [block]
-            current_len = len(block)
+
+def _pack_items(items: List[tuple], headers: List[tuple], body_limit: int) -> List[tuple]:
+    """部品列を順序どおりメッセージに分割する。メッセージ長は累積和から O(1) で求め、文字列の再連結はしない。"""
+    n = len(items)
+    if not n:
+        return []
+    lengths = [len(text) for _, text in items]
+    starts = [i == 0 or items[i - 1][0] != items[i][0] for i in range(n)]
+    prefix_len = [0] * (n + 1)
+    prefix_head = [0] * (n + 1)
+    for i in range(n):
+        prefix_len[i + 1] = prefix_len[i] + lengths[i]
+        head = len(headers[items[i][0]][0]) + 2 if starts[i] else 0
+        prefix_head[i + 1] = prefix_head[i] + head
+
+    def message_len(i: int, j: int) -> int:
+        # items[i..j] を 1 通にしたときの本文長 (ブロック・部品はすべて "\n\n" で連結)
+        total = prefix_len[j + 1] - prefix_len[i] + 2 * (j - i)
+        total += prefix_head[j + 1] - prefix_head[i]
+        if not starts[i]:
+            total += len(headers[items[i][0]][1]) + 2
+        return total
+
+    def greedy(cap: int, max_count: int = n) -> List[tuple]:
+        spans: List[tuple] = []
+        i = 0
+        while i < n and len(spans) <= max_count:
+            j = i
+            while j + 1 < n and message_len(i, j + 1) <= cap:
+                j += 1
+            spans.append((i, j))
+            i = j + 1
+        return spans
+
+    # 順序固定の詰め込みは貪欲法で最小通数になる。そのうえで通数を変えない最小の上限を二分探索し、
+    # 最後の 1 通だけが極端に短くならないよう各メッセージの長さを均す。
+    spans = greedy(body_limit)
+    low = max(message_len(i, i) for i in range(n))
+    high = body_limit
+    while low < high:
+        mid = (low + high) // 2
+        if len(greedy(mid, len(spans))) <= len(spans):
+            high = mid
         else:
-            current_parts.append(block)
-            current_len += addition if current_len else len(block)
-    if current_parts:
-        messages.append("\n\n".join(current_parts))
+            low = mid + 1
+    if high < body_limit:
+        spans = greedy(high)
+    return spans
+
+
+def _render_message_body(items: List[tuple], headers: List[tuple], first: int, last: int) -> str:
+    blocks: List[str] = []
+    current_section = None
+    for pos in range(first, last + 1):
+        section_idx, text = items[pos]
+        if section_idx != current_section:
+            header, header_cont = headers[section_idx]
+            starts_section = pos == 0 or items[pos - 1][0] != section_idx
+            blocks.append(header if starts_section else header_cont)
+            current_section = section_idx
+        blocks.append(text)
+    return "\n\n".join(blocks)
+
+
+def _assemble_messages(header_line: str, sections: List[dict]) -> List[str]:
+    body_limit = max(400, CHUNK_LIMIT - len(header_line) - 12)
+    items, headers = _section_items(sections, body_limit)
+    spans = _pack_items(items, headers, body_limit)
+    messages = [_render_message_body(items, headers, first, last) for first, last in spans]
 
     formatted: List[str] = []
     total = len(messages) or 1
@@ -153,10 +185,230 @@ def _assemble_messages(header_line: str, sections: List[dict]) -> List[str]:
     return formatted
 
 
-def post_markdown(webhook_url: str, markdown: str):
-    header_line, sections = _parse_sections(markdown)
-    chunks = _assemble_messages(header_line or "6hダイジェスト", sections)
-    for chunk in chunks:
-        response = requests.post(webhook_url, json={"content": chunk}, timeout=30)
+def _get_session() -> requests.Session:
+    # 同一スレッド内では接続を使い回し、パートごとの TLS ハンドシェイクを避ける
+    session = getattr(_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _LOCAL.session = session
+    return session
+
+
+def _header_float(headers, name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _update_bucket(webhook_url: str, headers) -> None:
+    remaining = _header_float(headers, "X-RateLimit-Remaining")
+    reset_after = _header_float(headers, "X-RateLimit-Reset-After")
+    if remaining is None or reset_after is None:
+        return
+    with _BUCKETS_LOCK:
+        _BUCKETS[webhook_url] = {
+            "remaining": remaining,
+            "reset_at": time.monotonic() + reset_after,
+        }
+
+
+def _wait_for_bucket(webhook_url: str) -> float:
+    with _BUCKETS_LOCK:
+        bucket = dict(_BUCKETS.get(webhook_url) or {})
+    if not bucket or bucket["remaining"] > 0:
+        return 0.0
+    delay = bucket["reset_at"] - time.monotonic()
+    if delay <= 0:
+        return 0.0
+    delay = min(delay, MAX_RETRY_WAIT)
+    time.sleep(delay)
+    return delay
+
+
+def _retry_after(response: requests.Response) -> float:
+    delay = _header_float(response.headers, "Retry-After")
+    if delay is None:
+        try:
+            delay = float((response.json() or {}).get("retry_after"))
+        except Exception:
+            delay = None
+    if delay is None:
+        delay = _header_float(response.headers, "X-RateLimit-Reset-After")
+    return min(max(delay or 1.0, 0.0), MAX_RETRY_WAIT)
+
+
+def send_webhook(webhook_url: str, payload: dict) -> requests.Response:
+    """1 メッセージを送信する。429 / 503 / 接続できなかったときは同じメッセージを再送してから次へ進むので順序は保たれる。
+
+    webhook の投稿は冪等ではないので、受理されていないと分かる失敗だけを再送する。ReadTimeout や
+    503 以外の 5xx (502/504 はエッジが返すので保存済みのことがある) は再送せず、そのまま呼び出し側へ返す
+    (Discord 側で受理済みだと二重投稿になる)。
+    """
+    session = _get_session()
+    failures = 0
+    rate_limited = 0
+    while True:
+        _wait_for_bucket(webhook_url)
+        try:
+            response = session.post(webhook_url, params={"wait": "true"}, json=payload, timeout=REQUEST_TIMEOUT)
+        except requests.ConnectionError as exc:
+            # ConnectTimeout も ConnectionError の一種
+            failures += 1
+            if failures >= MAX_ATTEMPTS:
+                raise
+            delay = min(2 ** failures, MAX_RETRY_WAIT)
+            print(f"[warn] discord webhook error ({type(exc).__name__}); retry in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        _update_bucket(webhook_url, response.headers)
+        if response.status_code == 429 and rate_limited < MAX_RATE_LIMIT_RETRIES:
+            # レートリミットは待てば必ず通るので、通常の失敗回数とは別枠で数える
+            rate_limited += 1
+            delay = _retry_after(response)
+            metrics.incr("post.rate_limited")
+            print(f"[warn] discord rate limited; retry in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        if response.status_code == 503:
+            # 503 はサービス側で受け付けていない応答なので再送してよい
+            failures += 1
+            if failures < MAX_ATTEMPTS:
+                delay = min(2 ** failures, MAX_RETRY_WAIT)
+                print(f"[warn] discord webhook {response.status_code}; retry in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+        return response
+
+
+def _section_title(header: str) -> str:
+    return header.lstrip("#").strip()[:EMBED_TITLE_LIMIT]
+
+
+def _section_color(title: str) -> Optional[int]:
+    base = title.replace("(続き)", "").strip()
+    return SECTION_COLORS.get(base)
+
+
+def _assemble_embed_messages(sections: List[dict]) -> List[List[dict]]:
+    """セクション→埋め込み、トピック→説明文の段落として詰め、リクエスト数が最小になるよう順に埋めていく。"""
+    messages: List[List[dict]] = []
+    embeds: List[dict] = []
+    used = 0
+
+    def close_message() -> None:
+        nonlocal embeds, used
+        if embeds:
+            messages.append(embeds)
+        embeds = []
+        used = 0
+
+    for section in sections:
+        title = _section_title(section["header"])
+        cont_title = f"{title} (続き)"[:EMBED_TITLE_LIMIT]
+        color = _section_color(title)
+        current: Optional[dict] = None
+        for topic in section["topics"]:
+            for piece in _split_text_by_length(topic, EMBED_DESCRIPTION_LIMIT):
+                if current is not None:
+                    addition = len(piece) + 2
+                    if (len(current["description"]) + addition <= EMBED_DESCRIPTION_LIMIT
+                            and used + addition <= EMBED_TOTAL_LIMIT):
+                        current["description"] += "\n\n" + piece
+                        used += addition
+                        continue
+                embed_title = title if current is None else cont_title
+                cost = len(embed_title) + len(piece)
+                if len(embeds) >= EMBEDS_PER_MESSAGE or used + cost > EMBED_TOTAL_LIMIT:
+                    close_message()
+                current = {"title": embed_title, "description": piece}
+                if color is not None:
+                    current["color"] = color
+                embeds.append(current)
+                used += cost
+    close_message()
+    return messages
+
+
+def _embeds_to_sections(embed_messages: List[List[dict]]) -> List[dict]:
+    sections: List[dict] = []
+    for message in embed_messages:
+        for embed in message:
+            header = f"## {embed.get('title', '').replace('(続き)', '').strip()}"
+            topics = [t for t in embed.get("description", "").split("\n\n") if t.strip()]
+            if sections and sections[-1]["header"] == header:
+                sections[-1]["topics"].extend(topics)
+            else:
+                sections.append({"header": header, "topics": topics})
+    return sections
+
+
+def _post_content_messages(webhook_url: str, header_line: str, sections: List[dict]) -> int:
+    chunks = _assemble_messages(header_line, sections)
+    for idx, chunk in enumerate(chunks, start=1):
+        with metrics.span('post.message', index=idx, chars=len(chunk)) as msg_sp:
+            response = send_webhook(webhook_url, {"content": chunk})
+            msg_sp['attrs']['status'] = response.status_code
+        print(f"[info] discord part {idx}/{len(chunks)}: {response.status_code} "
+              f"in {msg_sp['duration_ms']:.0f}ms")
         if response.status_code >= 300:
             raise RuntimeError(f"discord webhook {response.status_code}: {response.text[:200]}")
+    return len(chunks)
+
+
+def _post_embed_messages(webhook_url: str, header_line: str, sections: List[dict]) -> int:
+    embed_messages = _assemble_embed_messages(sections)
+    total = len(embed_messages) or 1
+    for idx, embeds in enumerate(embed_messages, start=1):
+        content = _format_header(header_line, idx, total)[:CONTENT_LIMIT]
+        chars = len(content) + sum(len(e.get("title", "")) + len(e.get("description", "")) for e in embeds)
+        with metrics.span('post.message', index=idx, chars=chars, embeds=len(embeds)) as msg_sp:
+            response = send_webhook(webhook_url, {"content": content, "embeds": embeds})
+            msg_sp['attrs']['status'] = response.status_code
+        print(f"[info] discord part {idx}/{total} ({len(embeds)} embeds): {response.status_code} "
+              f"in {msg_sp['duration_ms']:.0f}ms")
+        if response.status_code >= 500:
+            # 受理済みかもしれないので content モードで送り直さない (二重投稿になる)
+            raise RuntimeError(f"discord webhook {response.status_code}: {response.text[:200]}")
+        if response.status_code >= 300:
+            # 埋め込みが拒否されたら残りを従来の content モードで送る
+            print(f"[warn] discord embed post failed ({response.status_code}: {response.text[:200]}); "
+                  f"falling back to content mode")
+            metrics.incr("post.embed_fallback")
+            remaining = _embeds_to_sections(embed_messages[idx - 1:])
+            return idx - 1 + _post_content_messages(webhook_url, header_line, remaining)
+    return len(embed_messages)
+
+
+def post_digest(webhook_url: str, document: DigestDocument, mode: str = "markdown"):
+    mode = (mode or "markdown").strip().lower()
+    if mode not in POST_MODES:
+        mode = "markdown"
+    header_line = document.header or "6hダイジェスト"
+    sections = _document_sections(document)
+    with metrics.span('post', topics=sum(len(s["topics"]) for s in sections), mode=mode) as sp:
+        if mode == "embed":
+            sp['attrs']['messages'] = _post_embed_messages(webhook_url, header_line, sections)
+        else:
+            sp['attrs']['messages'] = _post_content_messages(webhook_url, header_line, sections)
+
+
+def post_markdown(webhook_url: str, markdown: str, mode: str = "markdown"):
+    post_digest(webhook_url, parse_digest(markdown, default_section="その他"), mode)
+
+
+def post_alert(webhook_url: str, content: str) -> None:
+    """リアルタイムアラート 1 通を送る。分割はしない (長すぎる分は切り詰める)。"""
+    if not webhook_url:
+        print("[warn] ALERT webhook が未設定のためアラートを送れません")
+        return
+    response = send_webhook(webhook_url, {"content": content[:CONTENT_LIMIT]})
+    metrics.incr("alert.posted")
+    if response.status_code >= 300:
+        print(f"[warn] alert post failed: {response.status_code} {response.text[:200]}")
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class DigestTopic:
+    headline: str
+    body: List[str] = field(default_factory=list)
+    footer: Optional[str] = None
+    mention_count: int = 0
+
+    @property
+    def paragraph(self) -> str:
+        return " ".join(line for line in self.body if line)
+
+    def to_markdown(self) -> str:
+        lines: List[str] = []
+        headline = self.headline.strip()
+        if headline:
+            lines.append(headline if headline.startswith("**") else f"**{headline}**")
+        lines.extend(line for line in self.body if line)
+        if self.footer:
+            lines.append(self.footer)
+        return "\n".join(lines)
+
+
+@dataclass
+class DigestSection:
+    name: str
+    topics: List[DigestTopic] = field(default_factory=list)
+
+    @property
+    def header(self) -> str:
+        return f"## {self.name}"
+
+    def topic_texts(self) -> List[str]:
+        texts = [text for text in (topic.to_markdown().strip() for topic in self.topics) if text]
+        return texts or ["該当なし"]
+
+
+@dataclass
+class DigestDocument:
+    """COMPOSE 出力を 1 回だけパースした結果。normalize と delivery の両方がこれを受け渡す。"""
+    header: str
+    sections: List[DigestSection] = field(default_factory=list)
+
+    def to_markdown(self) -> str:
+        lines: List[str] = [self.header, ""]
+        for section in self.sections:
+            lines.append(section.header)
+            if not section.topics:
+                lines.append("該当なし")
+                lines.append("")
+                continue
+            for topic in section.topics:
+                text = topic.to_markdown()
+                if text:
+                    lines.append(text)
+                    lines.append("")
+        while lines and lines[-1] == "":
+            lines.pop()
+        return "\n".join(lines)
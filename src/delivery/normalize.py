@@ -3,6 +3,9 @@ from __future__ import annotations
 import re
 from typing import Dict, List, Optional
 
+from src import metrics
+from src.delivery.document import DigestDocument, DigestSection, DigestTopic
+
 MAX_TOPICS_PER_SECTION = 12
 FORCED_SECTIONS: tuple[str, ...] = ("Now", "Heads-up", "Context", "その他")
 SECTION_ALIAS_MAP: Dict[str, str] = {
@@ -29,6 +32,17 @@ TEXT_REPLACEMENTS = [
     ("バイナ", "Binance"),
     ("nashinashi133", "ryutaro (nashinashi133)"),
 ]
+# 長い語を優先した 1 本の正規表現で、置換を 1 回の走査で済ませる
+_REPLACEMENT_MAP: Dict[str, str] = dict(TEXT_REPLACEMENTS)
+_REPLACEMENT_RE = re.compile("|".join(
+    re.escape(old) for old in sorted(_REPLACEMENT_MAP, key=len, reverse=True)
+))
+
+
+def apply_text_replacements(text: str) -> str:
+    if not text:
+        return text
+    return _REPLACEMENT_RE.sub(lambda m: _REPLACEMENT_MAP[m.group(0)], text)
 
 
 def _normalize_section_label(raw: str) -> Optional[str]:
@@ -66,151 +80,128 @@ def _parse_footer(line: str, default_mentions: int = 0) -> tuple[str, int]:
     return stripped, mentions
 
 
-def _summarize_remainder(topics: List[Dict[str, str]]) -> List[Dict[str, str]]:
+def _summarize_remainder(topics: List[DigestTopic]) -> List[DigestTopic]:
     if len(topics) <= MAX_TOPICS_PER_SECTION:
         return topics
     keep = topics[: max(MAX_TOPICS_PER_SECTION - 1, 1)]
     remainder = topics[max(MAX_TOPICS_PER_SECTION - 1, 1):]
-    summary_titles = [item['headline'] for item in remainder[:8]]
-    total_mentions = sum(item.get('mention_count', 0) or 0 for item in remainder)
+    summary_titles = [item.headline for item in remainder[:8]]
+    total_mentions = sum(item.mention_count or 0 for item in remainder)
     if summary_titles:
         summary_sentence = "その他の主な話題: " + " / ".join(summary_titles)
     else:
         summary_sentence = "その他の主な話題があります。"
     footer = f"（言及×{total_mentions}）" if total_mentions else "（言及×-）"
-    keep.append({
-        'headline': 'その他主要トピック',
-        'paragraph': summary_sentence,
-        'footer': footer,
-        'mention_count': total_mentions,
-    })
+    keep.append(DigestTopic(
+        headline='その他主要トピック',
+        body=[summary_sentence],
+        footer=footer,
+        mention_count=total_mentions,
+    ))
     return keep
 
 
-def normalize_digest_markdown(markdown: str) -> str:
-    text = markdown or ""
-    if not text.strip():
-        return text
-    # always reflow to deduplicate topics, even if markdown already uses headings
-    lines = [line.rstrip() for line in text.splitlines() if not line.strip().startswith('```')]
+def parse_digest(markdown: str, default_section: str = FORCED_SECTIONS[0]) -> DigestDocument:
+    """見出し・セクション・トピック・フッターを 1 パスで読み取る。見出しの無い行は見出し空のトピックとして残す。"""
+    lines = [line.rstrip() for line in (markdown or "").splitlines() if not line.strip().startswith('```')]
+    while lines and not lines[0].strip():
+        lines.pop(0)
     if not lines:
-        return text
+        return DigestDocument(header="")
 
-    header_line = lines[0].strip()
+    header_line = apply_text_replacements(lines[0].strip())
     if header_line.startswith('### '):
         header_line = header_line[4:].strip()
     elif header_line.startswith('## '):
         header_line = header_line[3:].strip()
-    content_lines = lines[1:]
-
-    section_topics: Dict[str, List[Dict[str, str]]] = {}
-    section_order: List[str] = []
-    current_section: Optional[str] = None
-    current_topic: List[str] = []
-
-    def flush_topic() -> None:
-        nonlocal current_topic, current_section
-        topic_lines = [l.strip() for l in current_topic if l.strip()]
-        if not topic_lines:
-            current_topic = []
-            return
-        section = current_section or FORCED_SECTIONS[0]
-        if section not in section_topics:
-            section_topics[section] = []
-            section_order.append(section)
-        headline_raw = topic_lines[0]
-        headline = headline_raw.strip('* ')
-        body_lines: List[str] = []
-        footer_line = None
-        for entry in topic_lines[1:]:
-            if FOOTER_RE.match(entry):
-                footer_line = entry
-            elif entry:
-                body_lines.append(entry)
-        footer_line, mentions = _parse_footer(footer_line or '', 0)
-        paragraph = " ".join(body_lines)
-        section_topics[section].append({
-            'headline': headline,
-            'paragraph': paragraph,
-            'footer': footer_line,
-            'mention_count': mentions,
-        })
-        current_topic = []
-
-    for raw_line in content_lines:
+
+    sections: Dict[str, DigestSection] = {}
+    document = DigestDocument(header=header_line)
+    current_section: Optional[DigestSection] = None
+    current_topic: Optional[DigestTopic] = None
+
+    def section_for(name: str) -> DigestSection:
+        section = sections.get(name)
+        if section is None:
+            section = DigestSection(name=name)
+            sections[name] = section
+            document.sections.append(section)
+        return section
+
+    for raw_line in lines[1:]:
         stripped = raw_line.strip()
         if not stripped:
             continue
         section_label = _normalize_section_label(stripped)
         if section_label:
-            flush_topic()
-            current_section = section_label
-            if current_section not in section_topics:
-                section_topics[current_section] = []
-                section_order.append(current_section)
+            current_section = section_for(section_label)
+            current_topic = None
             continue
+        stripped = apply_text_replacements(stripped)
+        if current_section is None:
+            current_section = section_for(default_section)
         if _looks_like_headline(stripped):
-            flush_topic()
-            current_topic = [stripped]
-            continue
-        if not current_topic:
+            current_topic = DigestTopic(headline=stripped.strip('* '))
+            current_section.topics.append(current_topic)
             continue
-        current_topic.append(stripped)
+        if current_topic is None:
+            current_topic = DigestTopic(headline='')
+            current_section.topics.append(current_topic)
+        if FOOTER_RE.match(stripped):
+            current_topic.footer, current_topic.mention_count = _parse_footer(stripped, 0)
+        else:
+            current_topic.body.append(stripped)
+    return document
 
-    flush_topic()
 
-    for section in FORCED_SECTIONS:
-        section_topics.setdefault(section, [])
-    extra_sections = [s for s in section_order if s not in FORCED_SECTIONS]
+def normalize_digest(markdown: str) -> DigestDocument:
+    with metrics.span('normalize', input_chars=len(markdown or '')) as sp:
+        document = _normalize_document(parse_digest(markdown))
+        sp['attrs']['topics'] = sum(len(section.topics) for section in document.sections)
+    return document
 
-    output_lines: List[str] = []
-    global_seen: set[tuple[str, str]] = set()
-    header = header_line or "6h Digest"
+
+def normalize_digest_markdown(markdown: str) -> str:
+    if not (markdown or "").strip():
+        return markdown or ""
+    return normalize_digest(markdown).to_markdown()
+
+
+def _normalize_document(parsed: DigestDocument) -> DigestDocument:
+    # always reflow to deduplicate topics, even if markdown already uses headings
+    header = parsed.header or "6h Digest"
     if not header.startswith("**"):
         header = f"**{header}**"
-    output_lines.append(header)
-    output_lines.append("")
+    document = DigestDocument(header=header)
 
-    def render_section(name: str, topics: List[Dict[str, str]]) -> None:
-        output_lines.append(f"## {name}")
-        deduped: List[Dict[str, str]] = []
+    by_name = {section.name: section for section in parsed.sections}
+    names = list(FORCED_SECTIONS) + [s.name for s in parsed.sections if s.name not in FORCED_SECTIONS]
+    global_seen: set[tuple[str, str]] = set()
+    for name in names:
+        source = by_name.get(name)
+        deduped: List[DigestTopic] = []
         seen_headlines: set[str] = set()
-        for topic in topics:
-            key = topic['headline'].strip('* ').lower()
+        for topic in (source.topics if source else []):
+            # 見出しの無い前置き行 (「該当なし」等) は捨てる
+            if not topic.headline:
+                continue
+            key = topic.headline.strip('* ').lower()
             if key in seen_headlines:
                 continue
             seen_headlines.add(key)
-            deduped.append(topic)
-        deduped = _summarize_remainder(deduped)
-        if not deduped:
-            output_lines.append("該当なし")
-            output_lines.append("")
-            return
-        for topic in deduped:
-            headline = topic['headline'].strip()
-            paragraph = topic.get('paragraph', '').strip()
-            key = (headline.strip("* ").lower(), paragraph)
+            footer, mentions = _parse_footer(topic.footer or '', 0)
+            deduped.append(DigestTopic(
+                headline=topic.headline,
+                body=[topic.paragraph] if topic.paragraph else [],
+                footer=footer,
+                mention_count=mentions,
+            ))
+        section = DigestSection(name=name)
+        for topic in _summarize_remainder(deduped):
+            key = (topic.headline.strip("* ").lower(), topic.paragraph.strip())
             if key in global_seen:
                 continue
             global_seen.add(key)
-            if not headline.startswith("**"):
-                output_lines.append(f"**{headline}**")
-            else:
-                output_lines.append(headline)
-            if paragraph:
-                output_lines.append(paragraph)
-            output_lines.append(topic.get('footer', '（言及×-）'))
-            output_lines.append("")
-
-    for name in FORCED_SECTIONS:
-        render_section(name, section_topics.get(name, []))
-    for name in extra_sections:
-        render_section(name, section_topics.get(name, []))
-
-    while output_lines and output_lines[-1] == "":
-        output_lines.pop()
-
-    output = "\n".join(output_lines)
-    for old, new in TEXT_REPLACEMENTS:
-        output = output.replace(old, new)
-    return output
+            section.topics.append(topic)
+        document.sections.append(section)
+    return document
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import mmap
+import os
+import tempfile
+from array import array
+from typing import Any, Dict, List, Optional
+
+# 取得した本文 (text / processed_text) の置き場。本文は無名の一時ファイルを mmap した追記専用の領域に
+# UTF-8 で詰め、各行は (オフセット, 長さ) の記録番号だけを持つ。CONTEXT_WINDOW_DAYS を伸ばしても
+# Python ヒープに残るのは行のメタデータだけで、本文はページキャッシュ側 (必要なときだけ読まれる) に載る。
+# MESSAGE_ARENA=0 で無効 (従来どおり dict に文字列を持つ)。
+MESSAGE_ARENA = os.getenv('MESSAGE_ARENA', '1').lower() not in ('0', 'false', 'no', 'off')
+MESSAGE_ARENA_DIR = os.getenv('MESSAGE_ARENA_DIR') or None
+INITIAL_CAPACITY = 1 << 20
+# 常駐プロセスで、生きている本文が領域の 1/REPACK_RATIO を下回ったら詰め直す
+REPACK_RATIO = 3
+_LAZY_KEYS = ('text', 'processed_text')
+
+
+class MessageArena:
+    """追記専用の本文領域。append で記録番号を返し、text(i) で文字列に戻す。"""
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY, directory: Optional[str] = MESSAGE_ARENA_DIR):
+        # 名前の無い一時ファイル (プロセス終了やクローズで消える)
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.truncate(capacity)
+        self._mm = mmap.mmap(self._file.fileno(), capacity)
+        self._capacity = capacity
+        self._size = 0
+        self._offsets = array('Q')
+        self._lengths = array('I')
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def append(self, text: str) -> int:
+        data = text.encode('utf-8')
+        end = self._size + len(data)
+        if end > self._capacity:
+            capacity = self._capacity
+            while capacity < end:
+                capacity *= 2
+            self._mm.resize(capacity)
+            self._capacity = capacity
+        self._mm[self._size:end] = data
+        self._offsets.append(self._size)
+        self._lengths.append(len(data))
+        self._size = end
+        return len(self._offsets) - 1
+
+    def nbytes(self, index: int) -> int:
+        return self._lengths[index]
+
+    def text(self, index: int) -> str:
+        start = self._offsets[index]
+        return self._mm[start:start + self._lengths[index]].decode('utf-8')
+
+    def pack(self, rows: List[Dict[str, Any]]) -> List['ArenaRow']:
+        """行の本文をこの領域に移し、ArenaRow のリストを返す (既にこの領域の行はそのまま)。"""
+        return [row if isinstance(row, ArenaRow) and row.arena is self else ArenaRow(self, row) for row in rows]
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+
+class ArenaRow(dict):
+    """本文を MessageArena に置いた行。text / processed_text は読むたびに領域から復元する。
+
+    通常の dict と同じように get / [] / in / items / json.dumps / dict(row) が使える。
+    processed_text が text と同じなら同じ記録を指し、本文を二重に持たない。
+    dict 側の本文キーには順序を保つための None しか無いので、本文に触るメソッド (update / setdefault /
+    pop / del / | / == など) はすべてここで上書きし、C 実装の dict メソッドが None を読み書きしないようにする。
+    """
+
+    __slots__ = ('arena', '_text', '_processed')
+
+    def __init__(self, arena: MessageArena, row: Dict[str, Any]):
+        # 本文のキーは順序を保つための None だけを dict 側に置く
+        super().__init__((key, None if key in _LAZY_KEYS else value) for key, value in row.items())
+        self.arena = arena
+        self._text = -1
+        self._processed = -1
+        self['text'] = row.get('text') or ''
+        if row.get('processed_text') is not None:
+            self['processed_text'] = row['processed_text']
+
+    def _slot(self, key: Any) -> int:
+        if key == 'text':
+            return self._text
+        if key == 'processed_text':
+            return self._processed
+        return -1
+
+    def _drop(self, key: Any) -> None:
+        if key == 'text':
+            self._text = -1
+        elif key == 'processed_text':
+            self._processed = -1
+
+    def text_bytes(self) -> int:
+        """text の UTF-8 バイト数 (復元せずに分かる)。"""
+        return self.arena.nbytes(self._text) if self._text >= 0 else 0
+
+    def __getitem__(self, key: Any) -> Any:
+        slot = self._slot(key)
+        if slot >= 0:
+            return self.arena.text(slot)
+        return super().__getitem__(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        if key not in _LAZY_KEYS or not isinstance(value, str):
+            super().__setitem__(key, value)
+            return
+        if key == 'processed_text' and value == self.arena.text(self._text):
+            self._processed = self._text
+        elif key == 'processed_text':
+            self._processed = self.arena.append(value)
+        else:
+            self._text = self.arena.append(value)
+        super().__setitem__(key, None)
+
+    def __delitem__(self, key: Any) -> None:
+        super().__delitem__(key)
+        self._drop(key)
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self) -> tuple:
+        if not super().__len__():
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(reversed(list(super().__iter__())))
+        return key, self.pop(key)
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        super().clear()
+        self._text = self._processed = -1
+
+    def __ior__(self, other: Any) -> 'ArenaRow':
+        self.update(other)
+        return self
+
+    def __or__(self, other: Any) -> Dict[str, Any]:
+        if not isinstance(other, dict):
+            return NotImplemented
+        return {**self.copy(), **other}
+
+    def __ror__(self, other: Any) -> Dict[str, Any]:
+        if not isinstance(other, dict):
+            return NotImplemented
+        return {**other, **self.copy()}
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.copy() == (other.copy() if isinstance(other, ArenaRow) else other)
+
+    def __ne__(self, other: Any) -> bool:
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __iter__(self):
+        # dict の高速コピー ({**row} など) が本文を読まずに None を写さないよう、keys / [] 経由にさせる
+        return super().__iter__()
+
+    def keys(self) -> List[str]:  # type: ignore[override]
+        return list(self)
+
+    def items(self) -> List[tuple]:  # type: ignore[override]
+        return [(key, self[key]) for key in self]
+
+    def values(self) -> List[Any]:  # type: ignore[override]
+        return [self[key] for key in self]
+
+    def copy(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __reduce__(self):
+        # プロセス間で渡すときは通常の dict にする (mmap は pickle できない)
+        return (dict, (self.items(),))
+
+    def __repr__(self) -> str:
+        return repr(self.copy())
+
+
+def new_arena() -> Optional[MessageArena]:
+    return MessageArena() if MESSAGE_ARENA else None
+
+
+def pack_rows(rows: List[Dict[str, Any]], arena: Optional[MessageArena]) -> List[Dict[str, Any]]:
+    return arena.pack(rows) if arena is not None else rows
+
+
+def text_bytes(msg: Dict[str, Any]) -> int:
+    """チャンク分割用の本文バイト数 (processed_text 優先)。ArenaRow は記録の長さで済ませる。"""
+    if isinstance(msg, ArenaRow):
+        slot = msg._processed if msg._processed >= 0 else msg._text
+        return msg.arena.nbytes(slot) if slot >= 0 else 0
+    return len((msg.get('processed_text') or msg.get('text', '')).encode('utf-8'))
+
+
+def repack(groups: Dict[Any, List[Dict[str, Any]]], arena: Optional[MessageArena]) -> Optional[MessageArena]:
+    """常駐プロセス用。生きている行の本文が領域の 1/REPACK_RATIO を下回っていたら新しい領域へ移す。
+
+    移した場合は groups の各リストを書き換えて新しい領域を返す (古い領域は参照が無くなれば解放される)。
+    """
+    if arena is None:
+        return None
+    live = sum(row.text_bytes() for rows in groups.values() for row in rows if isinstance(row, ArenaRow))
+    if arena.size <= INITIAL_CAPACITY or live * REPACK_RATIO >= arena.size:
+        return arena
+    fresh = MessageArena(max(INITIAL_CAPACITY, live * 2))
+    for key, rows in groups.items():
+        groups[key] = fresh.pack(rows)
+    return fresh
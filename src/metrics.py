@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+UTC = timezone.utc
+
+# 1 実行 = 1 レポート。スパンとカウンタはプロセス内で共有し、run 終了時に state/ へ書き出す。
+_LOCK = threading.Lock()
+_SPANS: List[Dict[str, Any]] = []
+_COUNTERS: Dict[str, float] = {}
+_RUN: Dict[str, Any] = {}
+_LLM_CALLS: List[Dict[str, Any]] = []
+_CURRENT: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('metrics_current_span', default=None)
+
+
+def reset_run(run_id: Optional[str] = None) -> None:
+    now = datetime.now(UTC)
+    with _LOCK:
+        _SPANS.clear()
+        _COUNTERS.clear()
+        _LLM_CALLS.clear()
+        _RUN.clear()
+        _RUN['run_id'] = run_id or now.strftime('%Y%m%dT%H%M%SZ')
+        _RUN['started_at'] = now.isoformat()
+        _RUN['started_perf'] = time.perf_counter()
+
+
+def run_id() -> str:
+    return _RUN.get('run_id') or datetime.now(UTC).strftime('%Y%m%dT%H%M%SZ')
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """処理区間の所要時間を記録する。yield される dict の attrs に件数やサイズを追記できる。"""
+    parent = _CURRENT.get()
+    path = f"{parent}/{name}" if parent else name
+    record: Dict[str, Any] = {
+        'name': name,
+        'path': path,
+        'attrs': dict(attrs),
+    }
+    token = _CURRENT.set(path)
+    started = time.perf_counter()
+    record['offset_ms'] = round((started - _RUN.get('started_perf', started)) * 1000, 1)
+    try:
+        yield record
+    except BaseException as exc:
+        record['error'] = f"{type(exc).__name__}: {str(exc)[:200]}"
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        _CURRENT.reset(token)
+        with _LOCK:
+            _SPANS.append(record)
+
+
+def incr(key: str, value: float = 1) -> None:
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+
+def set_value(key: str, value: Any) -> None:
+    with _LOCK:
+        _RUN.setdefault('values', {})[key] = value
+
+
+def record_llm_call(stage: str, usage: Dict[str, Any], **attrs: Any) -> None:
+    """LLM 呼び出し 1 回分のトークン使用量と finish_reason を記録する。"""
+    entry = {'stage': stage, **usage, **attrs}
+    with _LOCK:
+        _LLM_CALLS.append(entry)
+
+
+def _aggregate_llm(calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+    per_stage: Dict[str, Dict[str, Any]] = {}
+    totals = {'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+    for call in calls:
+        stat = per_stage.setdefault(call['stage'], {
+            'calls': 0,
+            'prompt_tokens': 0,
+            'output_tokens': 0,
+            'total_tokens': 0,
+            'max_prompt_tokens': 0,
+            'max_output_tokens': 0,
+            'output_limit': call.get('output_limit'),
+            'finish_reasons': {},
+        })
+        prompt = call.get('prompt_tokens') or 0
+        output = call.get('output_tokens') or 0
+        total = call.get('total_tokens') or (prompt + output)
+        stat['calls'] += 1
+        stat['prompt_tokens'] += prompt
+        stat['output_tokens'] += output
+        stat['total_tokens'] += total
+        stat['max_prompt_tokens'] = max(stat['max_prompt_tokens'], prompt)
+        stat['max_output_tokens'] = max(stat['max_output_tokens'], output)
+        reason = call.get('finish_reason') or 'UNKNOWN'
+        stat['finish_reasons'][reason] = stat['finish_reasons'].get(reason, 0) + 1
+        totals['calls'] += 1
+        totals['prompt_tokens'] += prompt
+        totals['output_tokens'] += output
+        totals['total_tokens'] += total
+    for stat in per_stage.values():
+        limit = stat.get('output_limit')
+        if limit:
+            stat['max_output_ratio'] = round(stat['max_output_tokens'] / limit, 3)
+    return {'stages': per_stage, 'total': totals, 'calls': calls}
+
+
+def _aggregate(spans: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    stages: Dict[str, Dict[str, Any]] = {}
+    for record in spans:
+        stat = stages.setdefault(record['path'], {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'errors': 0})
+        stat['count'] += 1
+        stat['total_ms'] = round(stat['total_ms'] + record['duration_ms'], 1)
+        stat['max_ms'] = max(stat['max_ms'], record['duration_ms'])
+        if record.get('error'):
+            stat['errors'] += 1
+    return stages
+
+
+def build_report() -> Dict[str, Any]:
+    with _LOCK:
+        spans = sorted(_SPANS, key=lambda r: (r['offset_ms'], r['path'].count('/')))
+        counters = dict(_COUNTERS)
+        llm_calls = list(_LLM_CALLS)
+        run = {k: v for k, v in _RUN.items() if k != 'started_perf'}
+        started_perf = _RUN.get('started_perf')
+    if started_perf is not None:
+        run['duration_ms'] = round((time.perf_counter() - started_perf) * 1000, 1)
+    run['finished_at'] = datetime.now(UTC).isoformat()
+    return {
+        'run': run,
+        'stages': _aggregate(spans),
+        'counters': counters,
+        'llm': _aggregate_llm(llm_calls),
+        'spans': spans,
+    }
+
+
+def print_summary(report: Optional[Dict[str, Any]] = None) -> None:
+    report = report or build_report()
+    top_level = [(path, stat) for path, stat in report['stages'].items() if path.count('/') <= 1]
+    parts = [f"{path}={stat['total_ms'] / 1000:.2f}s" for path, stat in top_level]
+    print('[timing]', ' '.join(parts) or '-')
+    for stage, stat in report['llm']['stages'].items():
+        limit = stat.get('output_limit')
+        max_out = f"{stat['max_output_tokens']}/{limit}" if limit else str(stat['max_output_tokens'])
+        reasons = ','.join(f"{k}={v}" for k, v in stat['finish_reasons'].items())
+        print(f"[tokens] {stage}: calls={stat['calls']} in={stat['prompt_tokens']} "
+              f"out={stat['output_tokens']} max_out={max_out} finish={reasons}")
+    plain = report['counters'].get('corpus.tokens_plain')
+    if plain:
+        compact = report['counters'].get('corpus.tokens_compact', 0)
+        print(f"[corpus] compact ~{compact} tok vs plain ~{plain} tok (-{100 * (plain - compact) / plain:.0f}%)")
+
+
+def write_run_report(state_dir: Path, extra: Optional[Dict[str, Any]] = None) -> Path:
+    """state/runs/<run_id>.json に詳細を、state/runs.jsonl に推移用の 1 行サマリを追記する。"""
+    report = build_report()
+    if extra:
+        report.update(extra)
+    runs_dir = Path(state_dir) / 'runs'
+    runs_dir.mkdir(parents=True, exist_ok=True)
+    run_id = report['run'].get('run_id') or datetime.now(UTC).strftime('%Y%m%dT%H%M%SZ')
+    path = runs_dir / f"{run_id}.json"
+    path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+
+    summary = {
+        'run_id': run_id,
+        'started_at': report['run'].get('started_at'),
+        'duration_ms': report['run'].get('duration_ms'),
+        'stages_ms': {p: s['total_ms'] for p, s in report['stages'].items() if p.count('/') <= 1},
+        'counters': report['counters'],
+        'llm': {stage: {k: v for k, v in stat.items() if k != 'output_limit'}
+                for stage, stat in report['llm']['stages'].items()},
+    }
+    with open(Path(state_dir) / 'runs.jsonl', 'a', encoding='utf-8') as fh:
+        fh.write(json.dumps(summary, ensure_ascii=False) + '\n')
+    return path
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+# 取得した行を (チャット, メッセージ id) で引く索引。ANALYZE の messages[].msg_id をここで元の行に
+# 戻し、スレッドの時刻範囲・出典リンクを LLM の出力ではなく実データから埋める。
+UTC = timezone.utc
+WIB = timezone(timedelta(hours=7))
+EVIDENCE_LIMIT = 3
+_DIGITS_RE = re.compile(r"\d+")
+_WORD_RE = re.compile(r"[0-9A-Za-z぀-ヿ一-鿿]{2,}")
+
+
+def row_chat(row: Dict[str, Any]) -> Any:
+    return row.get('chat_id') or row.get('chat')
+
+
+def source_key(chat: Any, msg_id: Any) -> str:
+    return f"{chat}:{msg_id}"
+
+
+def build_index(rows: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    return {source_key(row_chat(row), row.get('id')): row for row in rows}
+
+
+def _row_dt(row: Dict[str, Any]) -> datetime:
+    return datetime.strptime(row['date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=UTC)
+
+
+def resolve_messages(results: List[dict], rows: List[Dict[str, Any]]) -> int:
+    """チャンク結果の messages[] に ref (索引のキー) と実際の time_wib を付ける。解決できた件数を返す。
+
+    msg_id はそのチャンクに入れた行の id から探す。チャットをまたぐチャンクで同じ id が複数あるときは解決しない。
+    """
+    by_id: Dict[str, Optional[Dict[str, Any]]] = {}
+    for row in rows:
+        key = str(row.get('id'))
+        by_id[key] = None if key in by_id else row
+    resolved = 0
+    for res in results:
+        for thread in res.get('threads') or []:
+            for msg in thread.get('messages') or []:
+                digits = _DIGITS_RE.search(str(msg.get('msg_id') or ''))
+                row = by_id.get(digits.group(0)) if digits else None
+                if row is None:
+                    continue
+                msg['ref'] = source_key(row_chat(row), row['id'])
+                msg['time_wib'] = _row_dt(row).astimezone(WIB).strftime('%H:%M')
+                resolved += 1
+    return resolved
+
+
+def apply_provenance(threads: List[dict], index: Dict[str, Dict[str, Any]],
+                     evidence_limit: int = EVIDENCE_LIMIT) -> None:
+    """解決済みの ref から time_range と evidence (出典リンク) を埋める。ref が無いスレッドは ANALYZE の値のまま。"""
+    for thread in threads:
+        rows = []
+        seen = set()
+        for msg in thread.get('messages') or []:
+            ref = msg.get('ref')
+            if ref and ref not in seen and ref in index:
+                seen.add(ref)
+                rows.append(index[ref])
+        if not rows:
+            continue
+        rows.sort(key=_row_dt)
+        thread['time_range'] = {
+            'start_wib': _row_dt(rows[0]).astimezone(WIB).strftime('%H:%M'),
+            'end_wib': _row_dt(rows[-1]).astimezone(WIB).strftime('%H:%M'),
+        }
+        thread['evidence'] = [row['link'] for row in rows if row.get('link')][:evidence_limit]
+
+
+def strip_provenance(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """COMPOSE に送る前に ref / evidence を落とす (トークンを増やさない)。"""
+    threads = []
+    for thread in analysis.get('threads') or []:
+        slim = {key: value for key, value in thread.items() if key != 'evidence'}
+        slim['messages'] = [{key: value for key, value in msg.items() if key != 'ref'}
+                            for msg in thread.get('messages') or []]
+        threads.append(slim)
+    return {**analysis, 'threads': threads}
+
+
+def _words(text: str) -> set:
+    return {word.lower() for word in _WORD_RE.findall(text or '')}
+
+
+def _match_thread(headline: str, threads: List[dict]) -> Optional[dict]:
+    """見出しに entity_refs / タイトルの語が最も多く現れるスレッドを返す。"""
+    head_words = _words(headline)
+    best, best_score = None, 0
+    for thread in threads:
+        if not thread.get('evidence'):
+            continue
+        score = 2 * sum(1 for ref in thread.get('entity_refs') or [] if ref and ref.lower() in headline.lower())
+        score += len(head_words & _words(thread.get('title') or ''))
+        if score > best_score:
+            best, best_score = thread, score
+    return best
+
+
+def attach_evidence(document: Any, threads: List[dict], limit: int = EVIDENCE_LIMIT) -> int:
+    """INCLUDE_EVIDENCE_IN_OUTPUT 用。各トピックの脚注の後に対応スレッドの出典リンクを足す。付けた数を返す。"""
+    attached = 0
+    for section in document.sections:
+        for topic in section.topics:
+            thread = _match_thread(topic.headline, threads)
+            if thread is None:
+                continue
+            # <> で囲んで Discord の埋め込みプレビューを抑える
+            links = " ".join(f"<{url}>" for url in thread['evidence'][:limit])
+            topic.footer = f"{topic.footer} {links}" if topic.footer else links
+            attached += 1
+    return attached
@@ -1,15 +1,249 @@
-# This file is a placeholder for the HTML report generation logic
-# to be ported from tg-analyzer/scripts/json_to_html.py
+from __future__ import annotations
 
-def json_to_html(data, output_path):
-    # Basic placeholder implementation
+import html
+import json
+import re
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, TextIO
+
+SECTION_ORDER = ("Now", "Heads-up", "Context", "その他")
+INDEX_FILE = "search_index.json"
+SNIPPET_LIMIT = 160
+DELTA_LABELS = {"new": "新規", "updated": "更新"}
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+_WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.\-]{1,}")
+
+_STYLE = """
+body{font-family:system-ui,sans-serif;max-width:960px;margin:2em auto;padding:0 1em;line-height:1.6;color:#222}
+h1{font-size:1.4em}h2{border-bottom:1px solid #ddd;padding-bottom:.2em}
+.topic{margin:1em 0}.footer{color:#777;font-size:.9em}
+.thread{border:1px solid #e3e3e3;border-radius:6px;padding:.6em 1em;margin:.8em 0}
+.meta{color:#666;font-size:.85em}.ent{background:#eef;border-radius:3px;padding:0 .3em;margin-right:.3em}
+details pre{white-space:pre-wrap;background:#f7f7f7;padding:.5em}
+input{width:100%;padding:.5em;font-size:1em}li.hit{margin:.4em 0}
+"""
+
+_ARCHIVE_INDEX_HTML = """<!doctype html>
+<html lang="ja"><head><meta charset="utf-8"><title>Digest Archive</title>
+<style>{style}</style></head>
+<body><h1>Digest Archive</h1>
+<input id="q" placeholder="検索 (プロジェクト名・キーワード)" autofocus>
+<ul id="results"></ul>
+<script>
+let idx = null;
+fetch("{index_file}").then(r => r.json()).then(data => {{ idx = data; render(""); }});
+function render(q) {{
+  const out = document.getElementById("results");
+  out.innerHTML = "";
+  if (!idx) return;
+  const terms = q.toLowerCase().split(/\\s+/).filter(Boolean);
+  let shown = 0;
+  for (let i = idx.docs.length - 1; i >= 0 && shown < 200; i--) {{
+    const d = idx.docs[i];
+    if (terms.length && !terms.every(t => d[4].includes(t))) continue;
+    const run = idx.runs[d[0]];
+    const li = document.createElement("li");
+    li.className = "hit";
+    const a = document.createElement("a");
+    a.href = run[2] + "#" + d[1];
+    a.textContent = run[1] + " — " + d[2];
+    li.appendChild(a);
+    const span = document.createElement("div");
+    span.className = "meta";
+    span.textContent = d[3];
+    li.appendChild(span);
+    out.appendChild(li);
+    shown++;
+  }}
+}}
+document.getElementById("q").addEventListener("input", e => render(e.target.value));
+</script></body></html>
+"""
+
+
+def _e(value: Any) -> str:
+    return html.escape("" if value is None else str(value))
+
+
+def _inline(text: str) -> str:
+    return _BOLD_RE.sub(r"<strong>\1</strong>", _e(text))
+
+
+def _write_digest(fh: TextIO, document: Any) -> None:
+    fh.write("<section id=\"digest\"><h2>Digest</h2>\n")
+    if document is None:
+        fh.write("<p>(digest なし)</p></section>\n")
+        return
+    if isinstance(document, str):
+        for line in document.splitlines():
+            if line.startswith("## "):
+                fh.write(f"<h3>{_e(line[3:])}</h3>\n")
+            elif line.strip():
+                fh.write(f"<p>{_inline(line)}</p>\n")
+        fh.write("</section>\n")
+        return
+    for section in document.sections:
+        fh.write(f"<h3>{_e(section.name)}</h3>\n")
+        if not section.topics:
+            fh.write("<p>該当なし</p>\n")
+            continue
+        for topic in section.topics:
+            fh.write("<div class=\"topic\">")
+            if topic.headline:
+                fh.write(f"<strong>{_e(topic.headline.strip('* '))}</strong>")
+            for line in topic.body:
+                fh.write(f"<p>{_inline(line)}</p>")
+            if topic.footer:
+                fh.write(f"<div class=\"footer\">{_e(topic.footer)}</div>")
+            fh.write("</div>\n")
+    fh.write("</section>\n")
+
+
+def _write_list(fh: TextIO, label: str, items: Iterable[Any]) -> None:
+    items = [item for item in items if item]
+    if not items:
+        return
+    fh.write(f"<div><em>{_e(label)}</em><ul>")
+    for item in items:
+        fh.write(f"<li>{_e(item)}</li>")
+    fh.write("</ul></div>")
+
+
+def _thread_anchor(index: int) -> str:
+    return f"t{index}"
+
+
+def _ordered_threads(threads: List[dict]) -> List[tuple]:
+    rank = {name: i for i, name in enumerate(SECTION_ORDER)}
+    indexed = list(enumerate(threads))
+    indexed.sort(key=lambda it: (rank.get(it[1].get("section_hint"), len(rank)), it[0]))
+    return indexed
+
+
+def _write_threads(fh: TextIO, analysis: Dict[str, Any]) -> None:
+    threads = analysis.get("threads") or []
+    fh.write(f"<section id=\"threads\"><h2>Threads ({len(threads)})</h2>\n")
+    current = None
+    for index, thread in _ordered_threads(threads):
+        section = thread.get("section_hint") or "その他"
+        if section != current:
+            fh.write(f"<h3>{_e(section)}</h3>\n")
+            current = section
+        time_range = thread.get("time_range") or {}
+        span = " – ".join(v for v in (time_range.get("start_wib"), time_range.get("end_wib")) if v)
+        fh.write(f"<div class=\"thread\" id=\"{_thread_anchor(index)}\">")
+        fh.write(f"<strong>{_e(thread.get('title'))}</strong>")
+        if thread.get("delta") in DELTA_LABELS:
+            fh.write(f" <span class=\"ent\">{DELTA_LABELS[thread['delta']]}</span>")
+        fh.write(f"<div class=\"meta\">言及×{_e(thread.get('mention_count') or 0)}"
+                 f"{' / ' + _e(span) + ' WIB' if span else ''}</div>")
+        refs = thread.get("entity_refs") or []
+        if refs:
+            fh.write("<div>" + "".join(f"<span class=\"ent\">{_e(r)}</span>" for r in refs) + "</div>")
+        _write_list(fh, "facts", thread.get("facts") or [])
+        _write_list(fh, "notes", thread.get("notes") or [])
+        _write_list(fh, "risks", thread.get("risks") or [])
+        evidence = thread.get("evidence") or []
+        if evidence:
+            fh.write("<div class=\"meta\">出典: " + " ".join(
+                f"<a href=\"{_e(url)}\">[{i + 1}]</a>" for i, url in enumerate(evidence)) + "</div>")
+        messages = thread.get("messages") or []
+        if messages:
+            fh.write(f"<details><summary>messages ({len(messages)})</summary><pre>")
+            for msg in messages:
+                fh.write(f"{_e(msg.get('time_wib') or '--:--')} {_e(msg.get('text'))}\n")
+            fh.write("</pre></details>")
+        fh.write("</div>\n")
+    fh.write("</section>\n")
+
+
+def _write_entities(fh: TextIO, analysis: Dict[str, Any]) -> None:
+    entities = analysis.get("entities") or []
+    if not entities:
+        return
+    fh.write(f"<section id=\"entities\"><h2>Entities ({len(entities)})</h2><ul>\n")
+    for entity in entities:
+        aliases = ", ".join(entity.get("aliases") or [])
+        fh.write(f"<li><strong>{_e(entity.get('canonical'))}</strong>"
+                 f"{' (' + _e(entity.get('type')) + ')' if entity.get('type') else ''}"
+                 f"{' — ' + _e(aliases) if aliases else ''}</li>\n")
+    fh.write("</ul></section>\n")
+
+
+def render_report(fh: TextIO, analysis: Dict[str, Any], document: Any = None, title: str = "Digest Report") -> None:
+    """ファイルハンドルへ逐次書き込む。巨大な文字列は組み立てない。"""
+    fh.write("<!doctype html>\n<html lang=\"ja\"><head><meta charset=\"utf-8\">")
+    fh.write(f"<title>{_e(title)}</title><style>{_STYLE}</style></head>\n<body>\n")
+    fh.write(f"<h1>{_e(title)}</h1>\n")
+    _write_digest(fh, document)
+    _write_threads(fh, analysis or {})
+    _write_entities(fh, analysis or {})
+    fh.write("</body></html>\n")
+
+
+def json_to_html(data, output_path, document: Any = None, title: str = "Digest Report"):
     with open(output_path, 'w', encoding='utf-8') as f:
-        f.write('<html>\n')
-        f.write('<head><title>Digest Report</title></head>\n')
-        f.write('<body>\n')
-        f.write('<h1>Digest Report</h1>\n')
-        f.write('<pre>\n')
-        f.write(str(data)) # Just a simple representation for now
-        f.write('\n</pre>\n')
-        f.write('</body>\n')
-        f.write('</html>\n')
+        render_report(f, data if isinstance(data, dict) else {}, document, title)
+
+
+def _search_docs(run_idx: int, analysis: Dict[str, Any]) -> List[list]:
+    docs: List[list] = []
+    for index, thread in enumerate(analysis.get("threads") or []):
+        refs = thread.get("entity_refs") or []
+        facts = thread.get("facts") or []
+        snippet = " / ".join(facts)[:SNIPPET_LIMIT]
+        words = set(w.lower() for w in refs)
+        for text in [thread.get("title") or "", *facts]:
+            words.update(w.lower() for w in _WORD_RE.findall(text))
+        keywords = " ".join(sorted(words)) + " " + (thread.get("title") or "").lower()
+        # [run番号, アンカー, タイトル, スニペット, 検索用キーワード]
+        docs.append([run_idx, _thread_anchor(index), thread.get("title") or "", snippet, keywords])
+    return docs
+
+
+def _load_index(path: Path) -> Dict[str, Any]:
+    if path.exists():
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            if isinstance(data, dict) and "runs" in data and "docs" in data:
+                return data
+        except Exception:
+            pass
+    return {"v": 1, "runs": [], "docs": []}
+
+
+def archive_run(archive_dir: Path, run_id: str, analysis: Dict[str, Any], document: Any = None,
+                generated_at: Optional[datetime] = None) -> Path:
+    """1 実行分のページを追加し、検索インデックスに追記する。過去のページは再生成しない。"""
+    archive_dir = Path(archive_dir)
+    runs_dir = archive_dir / "runs"
+    runs_dir.mkdir(parents=True, exist_ok=True)
+    generated_at = generated_at or datetime.now(timezone.utc)
+    label = generated_at.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+    page = runs_dir / f"{run_id}.html"
+    json_to_html(analysis, page, document, title=f"Digest {label}")
+
+    index_path = archive_dir / INDEX_FILE
+    index = _load_index(index_path)
+    rel = f"runs/{page.name}"
+    run_ids = [run[0] for run in index["runs"]]
+    if run_id in run_ids:
+        # 同じ run_id の再実行はその回のエントリだけ差し替える
+        run_idx = run_ids.index(run_id)
+        index["runs"][run_idx] = [run_id, label, rel]
+        index["docs"] = [doc for doc in index["docs"] if doc[0] != run_idx]
+    else:
+        run_idx = len(index["runs"])
+        index["runs"].append([run_id, label, rel])
+    index["docs"].extend(_search_docs(run_idx, analysis or {}))
+    tmp = index_path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    tmp.replace(index_path)
+
+    landing = archive_dir / "index.html"
+    landing_html = _ARCHIVE_INDEX_HTML.format(style=_STYLE, index_file=INDEX_FILE)
+    if not landing.exists() or landing.read_text(encoding="utf-8") != landing_html:
+        landing.write_text(landing_html, encoding="utf-8")
+    return page
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import os
 import re
 import yaml
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Set, Tuple
 
+from src.alias_matcher import AliasMatcher, load_matcher, source_hash
+
 ALIAS_PATH = Path(__file__).resolve().parents[1] / "data" / "aliases.yml"
+# コンパイル済み照合器のキャッシュ置き場 (aliases.yml のハッシュ別)
+ALIAS_CACHE_DIR = Path(os.getenv("ALIAS_CACHE_DIR") or Path(__file__).resolve().parents[1] / "state" / "cache")
 
 _EMERGENCY_PATTERN = re.compile(r"(?i)\b(hack|exploit|rug|scam|重大|障害|停止|不正|freeze|halt|attack)\b")
 _MARKET_PATTERN = re.compile(r"(?i)(regulation|上場|listing|listing|funding|資金調達|提携|partnership|acquire|投資|news|update|発表|承認|approval|ローンチ|launch)")
@@ -14,7 +19,20 @@ _TRADING_PATTERN = re.compile(r"(?i)\b(long|short|entry|exit|buy|sell|tp|sl|stop
 _SALES_PATTERN = re.compile(r"(?i)(ieo|ido|ico|presale|プレセール|トークンセール|ローンチパッド|launchpad|whitelist|ホワイトリスト|sale)")
 _AIRDROP_PATTERN = re.compile(r"(?i)(airdrop|claim|ポイント|reward|rewards|quest|task|ミッション|キャンペーン|応募|抽選|ポイント|rewards)")
 _DEADLINE_PATTERN = re.compile(r"(?i)(締切|deadline|〆切|KYC|申請|提出|スナップショット|snapshot|claim期限)")
-_DEADLINE_TIME_PATTERN = re.compile(r"(?P<date>(\d{4}-\d{2}-\d{2})|(\d{1,2}/\d{1,2}))(?:[^0-9]{0,3}(?P<time>\d{1,2}:\d{2}))?")
+_MONTHS = {m: i + 1 for i, m in enumerate(("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"))}
+# 日付 (ISO / 年月日 / M/D / M月D日 / Oct 20 / 20 Oct) + 任意の時刻 + 任意のタイムゾーン
+_DEADLINE_TIME_PATTERN = re.compile(
+    r"(?:(?P<y>\d{4})[-/.](?P<m>\d{1,2})[-/.](?P<d>\d{1,2})"
+    r"|(?<![\d/.])(?P<m2>\d{1,2})/(?P<d2>\d{1,2})(?![\d/])"
+    r"|(?P<m3>\d{1,2})月(?P<d3>\d{1,2})日"
+    r"|(?i:\b(?P<mon>jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+(?P<d4>\d{1,2})(?:st|nd|rd|th)?\b)"
+    r"|(?i:\b(?P<d5>\d{1,2})(?:st|nd|rd|th)?\s+(?P<mon2>jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b))"
+    r"(?:[^0-9]{0,3}(?P<time>\d{1,2}:\d{2}))?"
+    r"(?:\s*\(?(?P<tz>(?i:utc|gmt)\s*[+-]\s*\d{1,2}|(?i:utc|gmt|wib|jst|kst|sgt))\)?)?"
+)
+_TZ_OFFSETS = {"UTC": 0, "GMT": 0, "WIB": 7, "SGT": 8, "JST": 9, "KST": 9}
+# タイムゾーン表記の無い時刻の扱い (既定は UTC)
+DEADLINE_DEFAULT_TZ = os.getenv("DEADLINE_DEFAULT_TZ", "UTC").upper()
 _TECH_PATTERN = re.compile(r"(?i)(upgrade|アップデート|メンテ|maintenance|deploy|patch|bug|fix|testnet|beta|release|ローンチ|修正)")
 _RESOURCE_PATTERN = re.compile(r"(?i)(docs?|documentation|guide|thread|スレ|公式|詳細|こちら|詳しくはこちら)")
 _URL_PATTERN = re.compile(r"https?://\S+")
@@ -32,31 +50,47 @@ CATEGORY_KEYS = {
 }
 
 
-def _load_aliases() -> Dict[str, str]:
-    if ALIAS_PATH.exists():
-        try:
-            data = yaml.safe_load(ALIAS_PATH.read_text(encoding="utf-8")) or {}
-            aliases = data.get("aliases", {})
-            return {k.upper(): v.upper() for k, v in aliases.items()}
-        except Exception:
-            return {}
-    return {}
+def _load_dictionary() -> Tuple[Dict[str, Any], bytes]:
+    """aliases.yml を 1 回だけ読み、(内容, 生バイト列) を返す。"""
+    if not ALIAS_PATH.exists():
+        return {}, b""
+    try:
+        raw = ALIAS_PATH.read_bytes()
+        return yaml.safe_load(raw.decode("utf-8")) or {}, raw
+    except Exception:
+        return {}, b""
 
 
-def _load_chain_names() -> Set[str]:
-    if ALIAS_PATH.exists():
-        try:
-            data = yaml.safe_load(ALIAS_PATH.read_text(encoding="utf-8")) or {}
-            return {str(item) for item in data.get("chains", [])}
-        except Exception:
-            return set()
-    return set()
+def _dictionary_patterns(data: Dict[str, Any]) -> List[Tuple[str, str, bool]]:
+    """(照合語, トピック, 単語境界) の一覧。チェーン名は従来どおり部分一致、プロジェクト名は語単位。
+
+    別名 (aliases) はここに入れない。従来どおり _TOKEN_PATTERN の大文字トークンを normalize_topic で
+    引き当てるだけにする (小文字の一般語 "mira network" などを拾わないように)。
+    """
+    patterns: List[Tuple[str, str, bool]] = []
+    for chain in data.get("chains") or []:
+        patterns.append((str(chain).lower(), str(chain), False))
+    # projects: {正式名: [別表記, ...]}
+    for canonical, names in (data.get("projects") or {}).items():
+        for name in [canonical, *(names or [])]:
+            patterns.append((str(name).lower(), str(canonical), True))
+    return [p for p in patterns if p[0]]
+
+
+_DICTIONARY, _DICTIONARY_RAW = _load_dictionary()
+_ALIASES = {str(k).upper(): str(v).upper() for k, v in (_DICTIONARY.get("aliases") or {}).items()}
+_MATCHER: Optional[AliasMatcher] = None
+
 
-_ALIASES = _load_aliases()
-_CHAIN_NAMES = _load_chain_names()
+def _matcher() -> AliasMatcher:
+    # 初回の照合時に読み込む (import しただけで state/cache に書かないように)
+    global _MATCHER
+    if _MATCHER is None:
+        _MATCHER = load_matcher(_dictionary_patterns(_DICTIONARY), source_hash(_DICTIONARY_RAW), ALIAS_CACHE_DIR)
+    return _MATCHER
 
 
-def _normalize_topic(token: str) -> str:
+def normalize_topic(token: str) -> str:
     up = token.upper()
     return _ALIASES.get(up, up)
 
@@ -68,26 +102,103 @@ def _extract_topics(text: str) -> Set[str]:
             continue
         if len(match) <= 2:
             continue
-        norm = _normalize_topic(match)
+        norm = normalize_topic(match)
         topics.add(norm)
-    for chain in _CHAIN_NAMES:
-        if chain.lower() in text.lower():
-            topics.add(chain)
+    # チェーン・プロジェクト名は 1 パスでまとめて照合
+    topics.update(_matcher().find(text))
     return topics
 
 
-def _extract_deadline(text: str) -> Optional[str]:
-    m = _DEADLINE_TIME_PATTERN.search(text)
-    if not m:
+def _parse_tz(raw: str) -> Optional[int]:
+    """"WIB" / "UTC+7" などを UTC からの時差 (時間) にする。分からなければ None。"""
+    key = re.sub(r"\s+", "", raw.upper())
+    if re.fullmatch(r"(UTC|GMT)[+-]\d{1,2}", key):
+        return int(key[3:])
+    return _TZ_OFFSETS.get(key)
+
+
+_DEFAULT_TZ_OFFSET = _parse_tz(DEADLINE_DEFAULT_TZ)
+if _DEFAULT_TZ_OFFSET is None:
+    print(f"[warn] DEADLINE_DEFAULT_TZ={DEADLINE_DEFAULT_TZ!r} は未対応のため UTC として扱います "
+          f"(使えるもの: {', '.join(_TZ_OFFSETS)} / UTC+N)")
+    _DEFAULT_TZ_OFFSET = 0
+
+
+def _tz_offset(raw: Optional[str]) -> int:
+    if not raw:
+        return _DEFAULT_TZ_OFFSET
+    offset = _parse_tz(raw)
+    return _DEFAULT_TZ_OFFSET if offset is None else offset
+
+
+def _infer_year(month: int, day: int, posted_at: datetime) -> Optional[datetime]:
+    """年の無い日付は投稿日に最も近い年にする (年末の投稿で「1/5」と書けば翌年)。"""
+    candidates = []
+    for year in (posted_at.year - 1, posted_at.year, posted_at.year + 1):
+        try:
+            candidates.append(datetime(year, month, day, tzinfo=timezone.utc))
+        except ValueError:
+            continue
+    if not candidates:
+        return None
+    return min(candidates, key=lambda d: abs((d - posted_at).total_seconds()))
+
+
+def extract_deadlines(text: str, posted_at: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """本文中の日付・日時をすべて取り出して UTC に正規化する。
+
+    返り値は {"utc": "YYYY-MM-DD HH:MM" (時刻が無ければ "YYYY-MM-DD"), "has_time", "tz", "raw"}。
+    """
+    posted_at = posted_at or datetime.now(timezone.utc)
+    found: List[Dict[str, Any]] = []
+    seen: Set[str] = set()
+    for m in _DEADLINE_TIME_PATTERN.finditer(text):
+        try:
+            if m.group("y"):
+                base = datetime(int(m.group("y")), int(m.group("m")), int(m.group("d")), tzinfo=timezone.utc)
+            else:
+                if m.group("m2"):
+                    month, day = int(m.group("m2")), int(m.group("d2"))
+                elif m.group("m3"):
+                    month, day = int(m.group("m3")), int(m.group("d3"))
+                elif m.group("mon"):
+                    month, day = _MONTHS[m.group("mon").lower()], int(m.group("d4"))
+                else:
+                    month, day = _MONTHS[m.group("mon2").lower()], int(m.group("d5"))
+                base = _infer_year(month, day, posted_at)
+        except ValueError:
+            base = None
+        if base is None:
+            continue
+        time_s = m.group("time")
+        if time_s:
+            hour, minute = (int(x) for x in time_s.split(":"))
+            if hour > 23 or minute > 59:
+                continue
+            offset = _tz_offset(m.group("tz"))
+            dt = base.replace(hour=hour, minute=minute) - timedelta(hours=offset)
+            utc = dt.strftime("%Y-%m-%d %H:%M")
+        else:
+            utc = base.strftime("%Y-%m-%d")
+        if utc in seen:
+            continue
+        seen.add(utc)
+        found.append({"utc": utc, "has_time": bool(time_s), "tz": (m.group("tz") or "").upper() or None,
+                      "raw": m.group(0).strip()})
+    return found
+
+
+def deadline_keyword(text: str) -> Optional[str]:
+    """締切の種類を表す語 (締切 / snapshot / KYC など) を返す。"""
+    m = _DEADLINE_PATTERN.search(text or "")
+    return m.group(0).lower() if m else None
+
+
+def _posted_at(message: Dict[str, Any]) -> Optional[datetime]:
+    try:
+        return datetime.strptime(message.get("date") or "", "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    except ValueError:
         return None
-    date = m.group("date")
-    time = m.group("time") or "00:00"
-    if "/" in date:
-        parts = date.split("/")
-        month, day = parts[0].zfill(2), parts[1].zfill(2)
-        year = datetime.utcnow().year
-        date = f"{year}-{month}-{day}"
-    return f"{date} {time}"
 
 
 def tag_message(message: Dict[str, Any]) -> Dict[str, Any]:
@@ -105,7 +216,8 @@ def tag_message(message: Dict[str, Any]) -> Dict[str, Any]:
         categories.add("sales")
     if _AIRDROP_PATTERN.search(text):
         categories.add("airdrops")
-    if _DEADLINE_PATTERN.search(text) or _DEADLINE_TIME_PATTERN.search(text):
+    deadlines = extract_deadlines(text, _posted_at(message))
+    if _DEADLINE_PATTERN.search(text) or deadlines:
         categories.add("deadlines")
     if _TECH_PATTERN.search(text):
         categories.add("tech_updates")
@@ -113,10 +225,15 @@ def tag_message(message: Dict[str, Any]) -> Dict[str, Any]:
         categories.add("resources")
 
     topics = _extract_topics(text)
-    deadline = _extract_deadline(text)
+    # deadline は従来どおり先頭 1 件 ("YYYY-MM-DD HH:MM")。全件は deadlines (締切カレンダー用)
+    deadline = None
+    if deadlines:
+        first = deadlines[0]["utc"]
+        deadline = first if deadlines[0]["has_time"] else f"{first} 00:00"
 
     return {
         "categories": sorted(categories),
         "topics": sorted(topics),
         "deadline": deadline,
+        "deadlines": [item["utc"] for item in deadlines],
     }
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Set
+
+UTC = timezone.utc
+
+# cron 5 フィールド (分 時 日 月 曜日)。曜日は 0 (または 7) = 日曜。
+# 日と曜日が両方とも制限されている (どちらも * で始まらない) ときは標準 cron と同じくどちらかに一致すれば発火する。
+_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+)
+
+
+def _parse_field(expr: str, lo: int, hi: int) -> Set[int]:
+    values: Set[int] = set()
+    for part in expr.split(','):
+        step = 1
+        if '/' in part:
+            part, step_s = part.split('/', 1)
+            step = int(step_s)
+            if step <= 0:
+                raise ValueError(f"bad cron step: {expr}")
+        if part in ('*', ''):
+            start, end = lo, hi
+        elif '-' in part:
+            a, b = part.split('-', 1)
+            start, end = int(a), int(b)
+        else:
+            start = int(part)
+            end = hi if step > 1 else start
+        if start < lo or end > hi or start > end:
+            raise ValueError(f"cron field out of range: {expr}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(expr: str) -> Dict[str, Any]:
+    parts = expr.split()
+    if len(parts) != 5:
+        raise ValueError(f"cron expression needs 5 fields: {expr!r}")
+    fields: Dict[str, Any] = {name: _parse_field(part, lo, hi) for part, (name, lo, hi) in zip(parts, _FIELDS)}
+    # 7 も日曜として受け付ける
+    if 7 in fields['weekday']:
+        fields['weekday'].discard(7)
+        fields['weekday'].add(0)
+    fields['day_or_weekday'] = not parts[2].startswith('*') and not parts[4].startswith('*')
+    return fields
+
+
+def _day_matches(fields: Dict[str, Any], t: datetime) -> bool:
+    # Python の weekday() は月曜=0 なので cron 表記 (日曜=0) に合わせる
+    day_ok = t.day in fields['day']
+    weekday_ok = (t.weekday() + 1) % 7 in fields['weekday']
+    return day_ok or weekday_ok if fields['day_or_weekday'] else day_ok and weekday_ok
+
+
+def next_fire(fields: Dict[str, Any], after: datetime) -> datetime:
+    """after より後で最初に一致する時刻 (UTC, 分単位) を返す。"""
+    minutes, hours, months = fields['minute'], fields['hour'], fields['month']
+    t = after.astimezone(UTC).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 4)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            continue
+        if not _day_matches(fields, t):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+        return t
+    raise ValueError("cron expression never fires")
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 複数の Telegram アカウントへのチャット割り当て。前回のチャットごとの取得件数 (state/fetch_volume.json)
+# を重みにして、各アカウントの負荷が均等になるよう大きいチャットから順に割り当てる。
+VOLUME_FILE = 'fetch_volume.json'
+DEFAULT_VOLUME = 1
+
+
+def load_volumes(state_dir: Optional[Path]) -> Dict[str, int]:
+    if state_dir is None:
+        return {}
+    try:
+        data = json.loads((Path(state_dir) / VOLUME_FILE).read_text(encoding='utf-8'))
+    except Exception:
+        return {}
+    return {str(k): int(v) for k, v in (data.get('chats') or {}).items()}
+
+
+def save_volumes(state_dir: Optional[Path], rows: List[Dict[str, Any]]) -> None:
+    if state_dir is None:
+        return
+    counts: Dict[str, int] = {}
+    for row in rows:
+        key = str(row.get('chat_id') or row.get('chat'))
+        counts[key] = counts.get(key, 0) + 1
+    path = Path(state_dir) / VOLUME_FILE
+    path.write_text(json.dumps({'chats': counts}, ensure_ascii=False, indent=2), encoding='utf-8')
+
+
+def plan_shards(candidates: Dict[int, List[int]], volumes: Dict[str, int], n_sessions: int) -> Dict[int, List[int]]:
+    """chat_id -> 取得可能なセッション番号 (メンバーのセッションを優先済み) から、セッション番号 -> chat_id 群を返す。
+
+    候補の少ないチャットを先に (取り合いにならないよう)、同数なら件数の多い順に、負荷最小の候補へ割り当てる。
+    """
+    load = [0] * n_sessions
+    plan: Dict[int, List[int]] = {i: [] for i in range(n_sessions)}
+    order = sorted(candidates, key=lambda chat: (len(candidates[chat]), -volumes.get(str(chat), DEFAULT_VOLUME)))
+    for chat in order:
+        options = candidates[chat]
+        if not options:
+            continue
+        target = min(options, key=lambda i: (load[i], i))
+        plan[target].append(chat)
+        load[target] += max(volumes.get(str(chat), DEFAULT_VOLUME), DEFAULT_VOLUME)
+    return plan
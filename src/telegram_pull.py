@@ -1,13 +1,38 @@
 from __future__ import annotations
+import asyncio
+import json
 import re
+import time
+from contextlib import AsyncExitStack
+from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any, Tuple, Optional
 
-from telethon import TelegramClient, types, functions
+from telethon import TelegramClient, errors, events, types, functions
 from telethon.sessions import StringSession
 
+from src import metrics
+from src.message_arena import MessageArena, new_arena, pack_rows, repack
+from src.shard_plan import plan_shards
+
 UTC = timezone.utc
 
+# 取得スケジューラ: チャンネルごとにページ単位で取りに行き、FloodWait を受けたチャンネルは待ち時間が
+# 明けるまで後回しにして他のチャンネルを進める。
+FETCH_PAGE_SIZE = 200
+# これより長い FloodWait はその回は諦め、チェックポイントに残して次回に回す
+MAX_FLOOD_WAIT = 900
+# FloodWait を受けたチャンネルのページ間隔 (秒)。成功が続けば減衰させる
+MAX_CHANNEL_DELAY = 30.0
+DELAY_DECAY = 0.7
+CHECKPOINT_FILE = 'fetch_checkpoint.json'
+# 中断した取得を再開できる最大の経過時間 (窓の開始時刻のずれ)
+CHECKPOINT_MAX_AGE = timedelta(hours=1)
+CHECKPOINT_EVERY_PAGES = 5
+# 取得中は Telethon 内部の FloodWait 自動スリープを切り、FloodWaitError をスケジューラで受ける
+# (既定の 60 秒以下の待ちを iter_messages の中で寝られると、他のチャンネルも止まる)
+FETCH_FLOOD_SLEEP_THRESHOLD = 0
+
 
 def utcnow() -> datetime:
     return datetime.now(UTC)
@@ -60,6 +85,26 @@ def _parse_spec_token(token: str) -> Tuple[str, str]:
     return 'username', tok.lower()
 
 
+def _invite_hash(token: str) -> Optional[str]:
+    """招待リンク (t.me/+xxx / joinchat/xxx) ならハッシュを返す。"""
+    kind, url = _parse_spec_token(token)
+    if kind != 'link' or not ('joinchat' in url or '/+' in url):
+        return None
+    return url.rsplit('/', 1)[-1].lstrip('+')
+
+
+async def _invite_owner(clients: List[TelegramClient], invite_hash: str) -> int:
+    """招待リンクを解決させるアカウント。既に参加しているアカウントがあればそれ、無ければ先頭 (そこだけが参加する)。"""
+    for i, client in enumerate(clients):
+        try:
+            check = await client(functions.messages.CheckChatInviteRequest(hash=invite_hash))
+        except Exception:
+            continue
+        if isinstance(check, types.ChatInviteAlready):
+            return i
+    return 0
+
+
 def _try_parse_c_link(url: str) -> Optional[int]:
     match = re.search(r"t\.me/(?:c/)?(\d+)", url)
     if not match:
@@ -110,9 +155,9 @@ async def _resolve_one(client: TelegramClient, index: Dict[str, Any], token: str
 
     if kind == 'link':
         url = value
-        if 'joinchat' in url or '/+' in url:
+        invite_hash = _invite_hash(token)
+        if invite_hash:
             try:
-                invite_hash = url.rsplit('/', 1)[-1].lstrip('+')
                 await client(functions.messages.ImportChatInviteRequest(hash=invite_hash))
             except Exception:
                 pass
@@ -137,56 +182,388 @@ async def _resolve_one(client: TelegramClient, index: Dict[str, Any], token: str
     return None, f"unknown spec:{token}"
 
 
-async def resolve_sources(client: TelegramClient, specs: List[str]) -> Tuple[List[Any], List[str]]:
+async def load_dialog_index(client: TelegramClient) -> Dict[str, Any]:
     index, collect = _index_dialogs(client)
     await collect()
+    return index
+
+
+async def resolve_source_map(client: TelegramClient, specs: List[str], index: Optional[Dict[str, Any]] = None
+                             ) -> Tuple[Dict[str, Optional[Any]], List[str]]:
+    """spec ごとの解決結果 (未解決は None) を返す。ダイアログ一覧の取得は 1 回だけ (index を渡せば 0 回)。"""
+    with metrics.span('resolve', specs=len(specs), cached_dialogs=index is not None) as sp:
+        if index is None:
+            index = await load_dialog_index(client)
+        by_spec: Dict[str, Optional[Any]] = {}
+        notes = []
+        for token in specs:
+            if token in by_spec:
+                continue
+            entity, note = await _resolve_one(client, index, token)
+            notes.append(note)
+            by_spec[token] = entity
+        sp['attrs'].update(dialogs=len(index['list']), resolved=sum(1 for e in by_spec.values() if e))
+    return by_spec, notes
+
+
+async def resolve_sources(client: TelegramClient, specs: List[str]) -> Tuple[List[Any], List[str]]:
+    by_spec, notes = await resolve_source_map(client, specs)
     resolved = []
-    notes = []
-    for token in specs:
-        entity, note = await _resolve_one(client, index, token)
-        notes.append(note)
-        if entity:
-            resolved.append(entity)
+    seen = set()
+    for entity in by_spec.values():
+        if entity is None or entity.id in seen:
+            continue
+        seen.add(entity.id)
+        resolved.append(entity)
     return resolved, notes
 
 
-async def fetch_messages_smart(hours: int, source_specs: List[str],
-                               string_session: str, api_id: int, api_hash: str
-                              ) -> List[Dict[str, Any]]:
+def message_row(entity: Any, message: Any, sender: Any = None) -> Optional[Dict[str, Any]]:
+    """バッチ取得とリアルタイム受信で共通の行形式。本文の無いメッセージは None。
+
+    sender は取得済みの送信者 (リアルタイム受信では message.sender が未ロードのことが多い)。
+    どちらも無ければ sender_id を文字列で入れる。
+    """
+    text = (message.message or '').strip()
+    if not text:
+        return None
+    username = getattr(entity, 'username', None) or ''
+    title = getattr(entity, 'title', '') or getattr(entity, 'first_name', '') or ''
+    dt = message.date.replace(tzinfo=UTC)
+    sender = sender or getattr(message, 'sender', None)
+    return {
+        'chat': title or username or str(entity.id),
+        'chat_id': entity.id,
+        'chat_title': title,
+        'chat_username': username,
+        'id': message.id,
+        'date': dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'from': (getattr(sender, 'username', None)
+                 or getattr(sender, 'first_name', '')
+                 or str(getattr(message, 'sender_id', None) or '')),
+        'text': text,
+        'link': f"https://t.me/{username}/{message.id}" if username else None,
+    }
+
+
+class FetchCheckpoint:
+    """チャンネルごとの取得済み最大 id と行を state/fetch_checkpoint.json に保存する。
+
+    窓の開始時刻 (cutoff) が CHECKPOINT_MAX_AGE 以内の次の実行は、保存済みの行を使い、続きの id から取得する。
+    """
+
+    def __init__(self, path: Optional[Path], cutoff: datetime):
+        self.path = Path(path) if path else None
+        self.cutoff = cutoff
+        self.channels: Dict[str, Dict[str, Any]] = {}
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+            saved_cutoff = datetime.fromisoformat(data['cutoff'])
+        except Exception:
+            return
+        if abs(cutoff - saved_cutoff) > CHECKPOINT_MAX_AGE:
+            return
+        cutoff_s = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+        for key, channel in (data.get('channels') or {}).items():
+            rows = [row for row in channel.get('rows') or [] if row.get('date', '') >= cutoff_s]
+            self.channels[key] = {'last_id': int(channel.get('last_id') or 0), 'rows': rows}
+        if self.channels:
+            print(f"[info] resuming fetch from checkpoint ({len(self.channels)} chats)")
+
+    def channel(self, chat_id: int) -> Dict[str, Any]:
+        return self.channels.setdefault(str(chat_id), {'last_id': 0, 'rows': []})
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        payload = {'cutoff': self.cutoff.isoformat(), 'saved_at': utcnow().isoformat(), 'channels': self.channels}
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(payload, ensure_ascii=False), encoding='utf-8')
+        tmp.replace(self.path)
+
+    def clear(self) -> None:
+        if self.path is not None and self.path.exists():
+            self.path.unlink()
+
+
+async def fetch_page(client: TelegramClient, entity: Any, cutoff: datetime, last_id: int) -> Tuple[List[Dict[str, Any]], int, int]:
+    """1 ページ取得し、(行, 最大 id, 取得メッセージ数) を返す。"""
+    rows: List[Dict[str, Any]] = []
+    max_id = last_id
+    seen = 0
+    # 続きは min_id で、初回は窓の開始時刻から古い順に取る
+    iter_kwargs = {'min_id': last_id} if last_id else {'offset_date': cutoff}
+    async for message in client.iter_messages(entity, limit=FETCH_PAGE_SIZE, reverse=True, **iter_kwargs):
+        seen += 1
+        max_id = max(max_id, message.id)
+        if message.date.replace(tzinfo=UTC) < cutoff:
+            continue
+        row = message_row(entity, message)
+        if row is not None:
+            rows.append(row)
+    return rows, max_id, seen
+
+
+async def fetch_channels(client: TelegramClient, entities: List[Any], cutoff: datetime,
+                         checkpoint: Optional[FetchCheckpoint] = None,
+                         start_ids: Optional[Dict[int, int]] = None,
+                         arena: Optional[MessageArena] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """FloodWait を考慮して複数チャンネルを交互にページ取得する。戻り値は (行, 取り切れなかったチャンネル名)。
+
+    FloodWait を受けたチャンネルは待ち明けまで後回しにし、その間隔を次のページにも空ける
+    (成功が続けば縮める)。MAX_FLOOD_WAIT を超える待ちのチャンネルはその回は打ち切り、
+    途中までの行を返す (呼び出し側はチェックポイントを残す)。
+    start_ids を渡すとその id より新しいものだけを取る。arena を渡すと本文はページごとにそこへ移す。
+    """
+    checkpoint = checkpoint or FetchCheckpoint(None, cutoff)
+    start_ids = start_ids or {}
+    states: List[Dict[str, Any]] = []
+    for entity in entities:
+        saved = checkpoint.channel(entity.id)
+        saved['rows'] = pack_rows(saved['rows'], arena)
+        if start_ids.get(entity.id, 0) > saved['last_id']:
+            saved['last_id'] = start_ids[entity.id]
+        states.append({'entity': entity, 'saved': saved, 'ready_at': 0.0, 'delay': 0.0, 'done': False})
+
+    incomplete: List[str] = []
+    flood_sleep = client.flood_sleep_threshold
+    client.flood_sleep_threshold = FETCH_FLOOD_SLEEP_THRESHOLD
+    try:
+        await _run_pages(client, states, cutoff, checkpoint, arena, incomplete)
+    finally:
+        client.flood_sleep_threshold = flood_sleep
+    if incomplete:
+        metrics.incr('fetch.incomplete_chats', len(incomplete))
+    return [row for st in states for row in st['saved']['rows']], incomplete
+
+
+async def _run_pages(client: TelegramClient, states: List[Dict[str, Any]], cutoff: datetime,
+                     checkpoint: FetchCheckpoint, arena: Optional[MessageArena], incomplete: List[str]) -> None:
+    loop_clock = time.monotonic
+    pages = 0
+    while True:
+        pending = [st for st in states if not st['done']]
+        if not pending:
+            break
+        st = min(pending, key=lambda item: item['ready_at'])
+        wait = st['ready_at'] - loop_clock()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        entity = st['entity']
+        saved = st['saved']
+        title = getattr(entity, 'title', '') or getattr(entity, 'username', None) or str(entity.id)
+        try:
+            with metrics.span('fetch.page', chat=title) as sp:
+                rows, max_id, seen = await fetch_page(client, entity, cutoff, saved['last_id'])
+                sp['attrs'].update(msgs=len(rows), seen=seen)
+        except errors.FloodWaitError as exc:
+            seconds = float(getattr(exc, 'seconds', 0) or 0)
+            metrics.incr('fetch.flood_waits')
+            metrics.incr('fetch.flood_wait_sec', seconds)
+            checkpoint.save()
+            if seconds > MAX_FLOOD_WAIT:
+                print(f"[warn] {title}: FloodWait {seconds:.0f}s; 今回は打ち切り (checkpoint に保存)")
+                st['done'] = True
+                incomplete.append(title)
+                continue
+            st['delay'] = min(max(st['delay'] * 2, 1.0), MAX_CHANNEL_DELAY)
+            st['ready_at'] = loop_clock() + seconds + st['delay']
+            print(f"[warn] {title}: FloodWait {seconds:.0f}s; 他のチャンネルを先に取得します")
+            continue
+
+        metrics.incr('fetch.msgs', len(rows))
+        metrics.incr('fetch.chars', sum(len(row['text']) for row in rows))
+        saved['rows'].extend(pack_rows(rows, arena))
+        saved['last_id'] = max_id
+        pages += 1
+        st['delay'] *= DELAY_DECAY
+        st['ready_at'] = loop_clock() + st['delay']
+        if seen < FETCH_PAGE_SIZE:
+            st['done'] = True
+            print(f"[info] {title}: {len(saved['rows'])} msgs")
+            checkpoint.save()
+        elif pages % CHECKPOINT_EVERY_PAGES == 0:
+            checkpoint.save()
+
+
+def watch_sources(client: TelegramClient, entities: List[Any], on_row) -> None:
+    """entities の新着メッセージごとに on_row(row) を呼ぶハンドラを登録する (接続中のクライアントで使う)。"""
+    async def _handler(event):
+        # event.chat_id は -100 付きの peer id なので、行の chat_id はバッチと同じ entity.id に揃える
+        entity = await event.get_chat()
+        # NewMessage では message.sender が入っていないことが多いので、必要ならここで取得する
+        row = message_row(entity, event.message, await event.get_sender())
+        if row is not None:
+            on_row(row)
+
+    client.add_event_handler(_handler, events.NewMessage(chats=entities))
+
+
+def finish_checkpoint(checkpoint: FetchCheckpoint, incomplete: List[str]) -> None:
+    """全チャンネルを取り切れたらチェックポイントを消す。打ち切ったチャンネルがあれば残して次回そこから続ける。"""
+    if not incomplete:
+        checkpoint.clear()
+        return
+    metrics.set_value('fetch.incomplete', incomplete)
+    print(f"[warn] 取り切れなかったチャンネル: {', '.join(incomplete)} (この回のダイジェストは途中までの行で作成)")
+
+
+async def fetch_sources(hours: int, source_specs: List[str],
+                        string_session: str, api_id: int, api_hash: str,
+                        checkpoint_path: Optional[Path] = None
+                       ) -> Tuple[List[Dict[str, Any]], Dict[str, Optional[int]]]:
+    """全 spec の和集合を 1 回だけ取得する。戻り値は (メッセージ, spec -> chat_id)。
+
+    複数の spec が同じチャンネルに解決されても取得は 1 回。
+    """
     cutoff = utcnow() - timedelta(hours=hours)
     rows: List[Dict[str, Any]] = []
 
     async with TelegramClient(StringSession(string_session), api_id, api_hash) as client:
-        entities, notes = await resolve_sources(client, source_specs)
+        by_spec, notes = await resolve_source_map(client, source_specs)
         print('[resolve]', '; '.join(notes))
 
-        for entity in entities:
-            username = getattr(entity, 'username', None) or ''
-            title = getattr(entity, 'title', '') or getattr(entity, 'first_name', '') or ''
-            count = 0
-            async for message in client.iter_messages(entity, offset_date=cutoff, reverse=True):
-                dt = message.date.replace(tzinfo=UTC)
-                if dt < cutoff:
-                    continue
-                text = (message.message or '').strip()
-                if not text:
+        spec_chats: Dict[str, Optional[int]] = {}
+        targets: List[Any] = []
+        for token, entity in by_spec.items():
+            spec_chats[token] = entity.id if entity is not None else None
+            if entity is None or any(entity.id == t.id for t in targets):
+                continue
+            targets.append(entity)
+        checkpoint = FetchCheckpoint(checkpoint_path, cutoff)
+        rows, incomplete = await fetch_channels(client, targets, cutoff, checkpoint, arena=new_arena())
+    finish_checkpoint(checkpoint, incomplete)
+
+    return rows, spec_chats
+
+
+async def fetch_sharded(hours: int, source_specs: List[str], string_sessions: List[str], api_id: int, api_hash: str,
+                        volumes: Optional[Dict[str, int]] = None, checkpoint_path: Optional[Path] = None
+                       ) -> Tuple[List[Dict[str, Any]], Dict[str, Optional[int]]]:
+    """複数アカウントで分担して取得する。各チャットは参加しているアカウントを優先し、
+    前回の件数 (volumes) で負荷を均して 1 アカウントだけに割り当てる。シャードは並行に取得し、
+    行は (日時, chat_id, id) 順の 1 本のストリームにまとめて返す。"""
+    if len(string_sessions) <= 1:
+        return await fetch_sources(hours, source_specs, (string_sessions or [''])[0], api_id, api_hash, checkpoint_path)
+    cutoff = utcnow() - timedelta(hours=hours)
+
+    async with AsyncExitStack() as stack:
+        clients = [await stack.enter_async_context(TelegramClient(StringSession(sess), api_id, api_hash))
+                   for sess in string_sessions]
+        indexes = await asyncio.gather(*(load_dialog_index(client) for client in clients))
+        # 招待リンクは 1 アカウントだけで解決する (全アカウントで ImportChatInvite すると全員が参加してしまう)
+        owners: Dict[str, int] = {}
+        for token in dict.fromkeys(source_specs):
+            invite_hash = _invite_hash(token)
+            if invite_hash:
+                owners[token] = await _invite_owner(clients, invite_hash)
+        resolved = []
+        for i, (client, index) in enumerate(zip(clients, indexes)):
+            specs = [token for token in source_specs if owners.get(token, i) == i]
+            by_spec, notes = await resolve_source_map(client, specs, index)
+            print(f'[resolve] session#{i}:', '; '.join(notes))
+            resolved.append(by_spec)
+
+        spec_chats: Dict[str, Optional[int]] = {}
+        members: Dict[int, List[int]] = {}
+        readable: Dict[int, List[int]] = {}
+        entities: Dict[Tuple[int, int], Any] = {}
+        for token in source_specs:
+            spec_chats.setdefault(token, None)
+            for i, by_spec in enumerate(resolved):
+                entity = by_spec.get(token)
+                if entity is None:
                     continue
-                link = f"https://t.me/{username}/{message.id}" if username else None
-                rows.append({
-                    'chat': title or username or str(entity.id),
-                    'chat_title': title,
-                    'chat_username': username,
-                    'id': message.id,
-                    'date': dt.strftime('%Y-%m-%d %H:%M:%S'),
-                    'from': (getattr(message.sender, 'username', None)
-                             or getattr(message.sender, 'first_name', '')
-                             or ''),
-                    'text': text,
-                    'link': link,
-                })
-                count += 1
-            print(f"[info] {title or username or entity.id}: {count} msgs")
+                spec_chats[token] = entity.id
+                entities[(i, entity.id)] = entity
+                readable.setdefault(entity.id, [])
+                if i not in readable[entity.id]:
+                    readable[entity.id].append(i)
+                if entity.id in indexes[i]['by_id'] and i not in members.setdefault(entity.id, []):
+                    members[entity.id].append(i)
+
+        candidates = {chat: members.get(chat) or sessions for chat, sessions in readable.items()}
+        plan = plan_shards(candidates, volumes or {}, len(clients))
+        metrics.set_value('fetch.shards', {str(i): len(chats) for i, chats in plan.items()})
+
+        # チェックポイントは全シャードで 1 つを共有する (同じループ内なので書き込みは競合しない)
+        checkpoint = FetchCheckpoint(checkpoint_path, cutoff)
+        arena = new_arena()
+        shards = await asyncio.gather(*(
+            fetch_channels(clients[i], [entities[(i, chat)] for chat in plan[i]], cutoff, checkpoint, arena=arena)
+            for i in range(len(clients))
+        ))
+    finish_checkpoint(checkpoint, [title for _, incomplete in shards for title in incomplete])
+
+    rows = [row for shard, _ in shards for row in shard]
+    rows.sort(key=lambda row: (row['date'], row['chat_id'], row['id']))
+    return rows, spec_chats
+
+
+class WarmFetcher:
+    """常駐プロセス用の取得器。接続済みクライアント・ダイアログ索引・チャットごとの取得済み行を保持し、
+    2 回目以降は前回の最大 message id より新しいものだけを取得する。"""
+
+    def __init__(self, client: TelegramClient, dialog_ttl: int = 3600):
+        self.client = client
+        self.dialog_ttl = dialog_ttl
+        self._index: Optional[Dict[str, Any]] = None
+        self._index_at: Optional[datetime] = None
+        self._rows: Dict[int, List[Dict[str, Any]]] = {}
+        self._since: Dict[int, datetime] = {}
+        self._arena: Optional[MessageArena] = new_arena()
+
+    async def dialog_index(self) -> Dict[str, Any]:
+        now = utcnow()
+        if self._index is None or self._index_at is None or (now - self._index_at).total_seconds() > self.dialog_ttl:
+            self._index = await load_dialog_index(self.client)
+            self._index_at = now
+        return self._index
 
+    async def fetch(self, hours: int, source_specs: List[str]) -> Tuple[List[Dict[str, Any]], Dict[str, Optional[int]]]:
+        if not self.client.is_connected():
+            await self.client.connect()
+        cutoff = utcnow() - timedelta(hours=hours)
+        by_spec, notes = await resolve_source_map(self.client, source_specs, await self.dialog_index())
+        print('[resolve]', '; '.join(notes))
+
+        spec_chats: Dict[str, Optional[int]] = {}
+        targets: List[Any] = []
+        start_ids: Dict[int, int] = {}
+        for token, entity in by_spec.items():
+            spec_chats[token] = entity.id if entity is not None else None
+            if entity is None or any(entity.id == t.id for t in targets):
+                continue
+            targets.append(entity)
+            cached = self._rows.get(entity.id)
+            if cached and self._since[entity.id] <= cutoff:
+                start_ids[entity.id] = max(row['id'] for row in cached)
+            else:
+                # 初回、または前回より長い窓を要求されたときは全取得
+                self._rows[entity.id] = []
+                self._since[entity.id] = cutoff
+
+        fresh, _ = await fetch_channels(self.client, targets, cutoff, start_ids=start_ids, arena=self._arena)
+        for row in fresh:
+            self._rows[row['chat_id']].append(row)
+
+        cutoff_s = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+        for entity in targets:
+            self._rows[entity.id] = [row for row in self._rows[entity.id] if row['date'] >= cutoff_s]
+        # 窓から外れた本文が溜まったら領域を詰め直す
+        self._arena = repack(self._rows, self._arena)
+        rows: List[Dict[str, Any]] = []
+        for entity in targets:
+            rows.extend(self._rows[entity.id])
+        return rows, spec_chats
+
+
+async def fetch_messages_smart(hours: int, source_specs: List[str],
+                               string_session: str, api_id: int, api_hash: str
+                              ) -> List[Dict[str, Any]]:
+    rows, _ = await fetch_sources(hours, source_specs, string_session, api_id, api_hash)
     return rows
 
 
@@ -0,0 +1,59 @@
+"""corpus_codec の往復テスト: decode_corpus(encode_corpus(msgs)) が従来の build_prompt_corpus と一致すること。"""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.ai.analysis import build_prompt_corpus
+from src.ai.corpus_codec import approx_tokens, decode_corpus, encode_corpus
+
+# 区切り文字・改行・URL・絵文字など、符号化でつぶれやすい断片
+_ALPHABET = ['a', 'b', ' ', '\n', '¤', '!', '1', '2', 't', 'u', 'n', ':', '#', '|', ',', '-', '🔥', '締', '\\n',
+             'https://x.io/a?b=1 ', 'http://t.me/c/9', '  ', '¤t', '...', '*']
+_BASE = datetime(2026, 10, 19, 1, 2, 3)
+
+
+def _random_messages(rng: random.Random):
+    msgs = []
+    for _ in range(rng.randint(0, 6)):
+        text = ''.join(rng.choice(_ALPHABET) * rng.choice([1, 1, 1, 5]) for _ in range(rng.randint(0, 25)))
+        msgs.append({
+            'date': (_BASE + timedelta(seconds=rng.randint(0, 90000))).strftime('%Y-%m-%d %H:%M:%S'),
+            'id': rng.randint(1, 99999),
+            'chat_title': rng.choice(['Chat A', 'B: x', '¤¤ weird\n', '* star', '']),
+            'chat': 'fallback',
+            'text': text,
+            'tags': {
+                'categories': rng.sample(['emergency', 'airdrops', 'deadlines', 'x_custom'], rng.randint(0, 2)),
+                'topics': rng.sample(['ETH', 'SOL', 'Yield Basis'], rng.randint(0, 2)),
+            },
+        })
+    return msgs
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_roundtrip_matches_prompt_corpus(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        msgs = _random_messages(rng)
+        assert decode_corpus(encode_corpus(msgs)) == build_prompt_corpus(msgs)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_roundtrip_with_recent_marker(seed):
+    rng = random.Random(100 + seed)
+    for _ in range(500):
+        msgs = _random_messages(rng)
+        recent_after = _BASE + timedelta(seconds=rng.randint(0, 90000))
+        assert decode_corpus(encode_corpus(msgs, recent_after)) == build_prompt_corpus(msgs, recent_after)
+
+
+def test_compact_corpus_is_smaller():
+    msgs = [{
+        'date': (_BASE + timedelta(minutes=7 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+        'id': 100000 + i,
+        'chat_title': 'Crypto Kudasai JP Alpha Lounge 🚀',
+        'text': f'HANA airdrop claim is live! https://hana.network/claim?ref=abc{i % 3} before 10/25 12:00 UTC',
+        'tags': {'categories': ['airdrops', 'deadlines'], 'topics': ['HANA']},
+    } for i in range(60)]
+    assert approx_tokens(encode_corpus(msgs)) < approx_tokens(build_prompt_corpus(msgs))
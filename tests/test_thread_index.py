@@ -0,0 +1,47 @@
+"""thread_index.compute_deltas の前回スレッドとの突き合わせ。"""
+from datetime import datetime, timedelta, timezone
+
+from src.ai.thread_index import compute_deltas, load_index
+
+_NOW = datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc)
+
+
+def _thread(title, refs, facts):
+    return {'title': title, 'entity_refs': refs, 'facts': facts}
+
+
+def _previous_index(threads):
+    index, _ = compute_deltas(threads, load_index({}), _NOW - timedelta(hours=6))
+    return index
+
+
+def test_new_thread_before_recurring_one_does_not_take_its_entry():
+    index = _previous_index([_thread('BTC ETF approved', ['BTC'], ['SEC approved'])])
+    threads = [
+        _thread('BTC miner hack', ['BTC'], ['pool drained']),
+        _thread('BTC ETF approved', ['BTC'], ['SEC approved']),
+    ]
+    _, delta = compute_deltas(threads, index, _NOW)
+    assert [t['delta'] for t in threads] == ['new', None]
+    assert delta['new'] == ['BTC miner hack']
+    assert delta['updated'] == []
+    assert delta['resolved'] == []
+
+
+def test_renamed_thread_matches_by_entity_set():
+    index = _previous_index([_thread('ETH upgrade scheduled', ['ETH'], ['mainnet date set'])])
+    threads = [_thread('ETH upgrade date fixed', ['ETH'], ['mainnet date set', 'client releases out'])]
+    _, delta = compute_deltas(threads, index, _NOW)
+    assert threads[0]['delta'] == 'updated'
+    assert delta['new'] == [] and delta['resolved'] == []
+
+
+def test_previous_entry_is_matched_only_once():
+    index = _previous_index([_thread('SOL outage', ['SOL'], ['validators halted'])])
+    threads = [
+        _thread('SOL outage recap', ['SOL'], ['validators halted']),
+        _thread('SOL outage timeline', ['SOL'], ['restart at 14:00']),
+    ]
+    _, delta = compute_deltas(threads, index, _NOW)
+    assert [t['delta'] for t in threads] == [None, 'new']
+    assert delta['new'] == ['SOL outage timeline']